@@ -0,0 +1,340 @@
+"""
+Benchmarks of the dashit_filter hot paths.
+
+Generates synthetic sites-to-reads and sites files, then times
+
+- the scalar quality filters in `dashit_filter.flash`: `poor_structure`,
+  `find_hairpin` and `longest_dinucleotide_run`
+- the batch quality filter `flash_batch.poor_structure_batch`
+- `parse_offtarget_server_response` on a synthetic server response
+- `get_offtargets` against a stand-in offtarget server, the HTTP
+  server of `dashit_filter serve`, on a free local port
+- a whole `dashit_filter` run with quality filtering only, which is
+  dominated by reading the input and writing the kept lines
+
+Each benchmark runs in its own process, so the peak RSS reported is
+that benchmark's alone. Results are printed as a table of guides per
+second and peak RSS, and can be saved as JSON with --json to compare
+runs against each other.
+
+Usage::
+
+    python benchmarks/bench_dashit_filter.py --lines 10000 1000000
+"""
+import argparse
+import json
+import logging
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+SCRIPT = os.path.abspath(__file__)
+REPO_DIR = os.path.dirname(os.path.dirname(SCRIPT))
+
+sys.path.insert(0, REPO_DIR)
+
+from dashit_filter import flash
+from dashit_filter.flash_batch import poor_structure_batch
+
+FILTER_PARAMS = {'gc_frequency': (5, 15),
+                 'homopolymer': 5,
+                 'dinucleotide_repeats': 3,
+                 'hairpin': {'min_inner': 3, 'min_outer': 5}}
+
+# Number of lines generated at once
+GENERATE_CHUNK_SIZE = 1000000
+
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+
+def random_guides(rng, n):
+    """`n` random 20-mers, as an (n, 20) array of ASCII codes"""
+
+    return _BASES[rng.integers(0, 4, size=(n, 20))]
+
+
+def generate_sites_to_reads(filename, num_lines, seed=0):
+    """Write a synthetic sites-to-reads file of `num_lines` guides
+
+    One line in 20 repeats an earlier guide of its chunk, as guides
+    seen in several reads do. Every line lists 1 to 5 read ids.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    with open(filename, 'w') as handle:
+        handle.write(f'Total number of reads: {num_lines * 3}\n')
+        for start in range(0, num_lines, GENERATE_CHUNK_SIZE):
+            n = min(GENERATE_CHUNK_SIZE, num_lines - start)
+            guides = random_guides(rng, n)
+            repeats = rng.random(n) < 0.05
+            guides[repeats] = guides[rng.integers(0, n, size=repeats.sum())]
+            read_ids = rng.integers(0, num_lines * 3, size=(n, 5))
+            num_ids = rng.integers(1, 6, size=n)
+            for guide, ids, k in zip(guides.view('S20').ravel().tolist(),
+                                     read_ids.tolist(), num_ids.tolist()):
+                handle.write('{}\t{}\n'.format(
+                    guide.decode('ascii'), ' '.join(map(str, ids[:k]))))
+
+
+def generate_sites(filename, guides_filename, num_sites, seed=1):
+    """Write a synthetic sites file: a fifth of the guides of
+    `guides_filename`, padded with random sites to `num_sites`"""
+
+    rng = np.random.default_rng(seed)
+
+    with open(guides_filename, 'r') as handle:
+        handle.readline()
+        guides = [line[0:20] for i, line in enumerate(handle)
+                  if i % 5 == 0 and i < num_sites]
+
+    with open(filename, 'w') as handle:
+        for guide in guides:
+            handle.write(guide + '\n')
+        num_random = max(num_sites - len(guides), 0)
+        for start in range(0, num_random, GENERATE_CHUNK_SIZE):
+            n = min(GENERATE_CHUNK_SIZE, num_random - start)
+            for site in random_guides(rng, n).view('S20').ravel().tolist():
+                handle.write(site.decode('ascii') + '\n')
+
+
+def read_guides(filename, limit):
+    """First `limit` guides of a sites-to-reads file"""
+
+    guides = []
+    with open(filename, 'r') as handle:
+        handle.readline()
+        for line in handle:
+            if len(guides) == limit:
+                break
+            guides.append(line[0:20])
+    return guides
+
+
+def timed(function, *args, **kwargs):
+    """Seconds taken to call `function`"""
+
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_poor_structure(inputs, options):
+    guides = read_guides(inputs['sites_to_reads'], options.scalar_limit)
+
+    def run():
+        for guide in guides:
+            flash.poor_structure(guide, FILTER_PARAMS, need_explanation=True)
+
+    return len(guides), timed(run)
+
+
+def bench_find_hairpin(inputs, options):
+    guides = read_guides(inputs['sites_to_reads'], options.scalar_limit)
+
+    def run():
+        for guide in guides:
+            flash.find_hairpin(guide)
+
+    return len(guides), timed(run)
+
+
+def bench_longest_dinucleotide_run(inputs, options):
+    guides = read_guides(inputs['sites_to_reads'], options.scalar_limit)
+
+    def run():
+        for guide in guides:
+            flash.longest_dinucleotide_run(guide)
+
+    return len(guides), timed(run)
+
+
+def bench_poor_structure_batch(inputs, options):
+    guides = read_guides(inputs['sites_to_reads'], options.batch_limit)
+    return len(guides), timed(poor_structure_batch, guides, FILTER_PARAMS,
+                              need_explanation=True)
+
+
+class _Response:
+    """Stand-in for the `requests.Response` of an offtarget query"""
+
+    def __init__(self, content):
+        self.content = content
+
+
+def bench_parse_offtarget_server_response(inputs, options):
+    from dashit_filter.dashit_filter import parse_offtarget_server_response
+
+    guides = read_guides(inputs['sites_to_reads'], options.batch_limit)
+    content = ''.join('{} {}\n'.format(guide, 'true' if i % 5 == 0 else 'false')
+                      for i, guide in enumerate(guides)).encode('ascii')
+    return len(guides), timed(parse_offtarget_server_response,
+                              _Response(content))
+
+
+def bench_get_offtargets(inputs, options):
+    from dashit_filter.dashit_filter import get_offtargets
+    from dashit_filter.server import SitesService, make_server
+
+    service = SitesService(inputs['sites'])
+    service.index((5, 10, 20))
+    server = make_server('localhost:0', service)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    try:
+        guides = read_guides(inputs['sites_to_reads'], options.batch_limit)
+        seconds = timed(get_offtargets, guides, 5, 10, 20,
+                        num_threads=options.threads,
+                        url='http://localhost:{}'.format(server.server_address[1]))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return len(guides), seconds
+
+
+def bench_main(inputs, options):
+    with open(inputs['sites_to_reads'], 'r') as handle:
+        num_lines = sum(1 for line in handle) - 1
+
+    with open(os.devnull, 'w') as devnull:
+        seconds = timed(subprocess.run,
+                        [sys.executable, '-m', 'dashit_filter.dashit_filter',
+                         inputs['sites_to_reads']], cwd=REPO_DIR,
+                        stdout=devnull, stderr=devnull, check=True)
+
+    return num_lines, seconds
+
+
+BENCHMARKS = {
+    'poor_structure': bench_poor_structure,
+    'find_hairpin': bench_find_hairpin,
+    'longest_dinucleotide_run': bench_longest_dinucleotide_run,
+    'poor_structure_batch': bench_poor_structure_batch,
+    'parse_offtarget_server_response': bench_parse_offtarget_server_response,
+    'get_offtargets': bench_get_offtargets,
+    'main': bench_main,
+}
+
+
+def peak_rss_mb(who):
+    """Peak resident set size in MB of this process or its children"""
+
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def run_one(name, inputs, options):
+    """Run benchmark `name` in this process
+
+    Returns
+    -------
+    dict
+        number of guides processed, seconds taken and peak RSS. The
+        time excludes reading the guides in.
+    """
+
+    num_guides, seconds = BENCHMARKS[name](inputs, options)
+
+    rss = peak_rss_mb(resource.RUSAGE_SELF)
+    if name == 'main':
+        rss = peak_rss_mb(resource.RUSAGE_CHILDREN)
+
+    return {'guides': num_guides, 'seconds': seconds, 'peak_rss_mb': rss}
+
+
+def run_isolated(name, inputs, options):
+    """Run benchmark `name` in a fresh process, so its peak RSS isn't
+    inflated by earlier benchmarks"""
+
+    command = [sys.executable, SCRIPT, '--run_one', name,
+               '--inputs', json.dumps(inputs),
+               '--scalar_limit', str(options.scalar_limit),
+               '--batch_limit', str(options.batch_limit),
+               '--threads', str(options.threads)]
+
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True)
+    return json.loads(output.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark dashit_filter on '
+                                     'synthetic sites-to-reads files')
+
+    parser.add_argument('--lines', type=int, nargs='+', default=[10000, 100000],
+                        help='sizes of the sites-to-reads files to generate, '
+                        'in lines, e.g. 10000 100000000')
+
+    parser.add_argument('--benchmarks', nargs='+', choices=list(BENCHMARKS),
+                        default=list(BENCHMARKS),
+                        help='benchmarks to run')
+
+    parser.add_argument('--scalar_limit', type=int, default=100000,
+                        help='most guides given to the scalar quality '
+                        'filters, which are too slow for the largest files')
+
+    parser.add_argument('--batch_limit', type=int, default=10000000,
+                        help='most guides given to the other benchmarks '
+                        'that hold all guides in memory')
+
+    parser.add_argument('--threads', type=int, default=1,
+                        help='threads for get_offtargets')
+
+    parser.add_argument('--work_dir', type=str,
+                        help='directory for the synthetic files, which are '
+                        'reused if present. A temporary directory by default.')
+
+    parser.add_argument('--json', type=str,
+                        help='also save the results to this JSON file')
+
+    parser.add_argument('--run_one', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--inputs', type=str, help=argparse.SUPPRESS)
+
+    options = parser.parse_args()
+
+    if options.run_one is not None:
+        logging.disable(logging.INFO)
+        json.dump(run_one(options.run_one, json.loads(options.inputs), options),
+                  sys.stdout)
+        return
+
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix='dashit_bench')
+    os.makedirs(work_dir, exist_ok=True)
+
+    results = []
+
+    print('{:>10} {:<32} {:>10} {:>10} {:>14} {:>10}'.format(
+        'lines', 'benchmark', 'guides', 'seconds', 'guides/s', 'RSS (MB)'))
+
+    for num_lines in options.lines:
+        inputs = {'sites_to_reads': os.path.join(work_dir, f'sites_to_reads_{num_lines}.txt'),
+                  'sites': os.path.join(work_dir, f'sites_{num_lines}.txt')}
+
+        if not os.path.exists(inputs['sites_to_reads']):
+            generate_sites_to_reads(inputs['sites_to_reads'], num_lines)
+        if not os.path.exists(inputs['sites']):
+            generate_sites(inputs['sites'], inputs['sites_to_reads'],
+                           min(num_lines, options.batch_limit))
+
+        for name in options.benchmarks:
+            result = run_isolated(name, inputs, options)
+            result.update({'lines': num_lines, 'benchmark': name})
+            results.append(result)
+
+            print('{:>10} {:<32} {:>10} {:>10.3f} {:>14.0f} {:>10.1f}'.format(
+                num_lines, name, result['guides'], result['seconds'],
+                result['guides'] / result['seconds'], result['peak_rss_mb']),
+                flush=True)
+
+    if options.json is not None:
+        with open(options.json, 'w') as handle:
+            json.dump(results, handle, indent=2)
+
+
+if __name__ == '__main__':
+    main()
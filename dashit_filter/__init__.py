@@ -0,0 +1,15 @@
+"""
+Filter DASHit guides RNA sequences for quality and on/offtargets.
+
+`DashitFilter` filters guides from Python, see `dashit_filter.session`.
+It is imported when first used, so importing this package stays cheap.
+"""
+
+__all__ = ['DashitFilter']
+
+
+def __getattr__(name):
+    if name == 'DashitFilter':
+        from dashit_filter.session import DashitFilter
+        return DashitFilter
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,236 @@
+"""
+Checkpoints of dashit_filter runs, so a run that was killed, e.g. on a
+preempted cluster node, resumes where it stopped.
+
+A checkpoint directory holds
+
+- ``run.json``, describing the run: the input, on/offtarget files and
+  every option the verdicts depend on. A checkpoint is only resumed by
+  the same run.
+- ``journal``, an append-only log of records, each a header (`RECORD`:
+  kind, payload length, CRC-32 of the payload) followed by the payload.
+  A record of kind `STAGE` holds the verdicts of a completed filtering
+  stage, the guides it filtered out and why; the guides that survived
+  it are those it was given minus those. Its payload is binary: a
+  `STAGE_HEADER` (length of a JSON header, number of guides), the JSON
+  header with the stage, the list of its reasons and the list of
+  guides that aren't 20 bases of A, C, G, T, then the guides, packed as
+  `uint64`, and the `uint32` index of the reason of each, as held by
+  `FilteredGuides`. Other records have a zlib-compressed JSON
+  payload. A record of kind `BATCH` holds a batch of guides the on/offtarget
+  server answered, as indexes into the guides searched and the guides
+  that matched. A record of kind `PLAN` holds the order stages were
+  planned to run in with --stage_order planned, since planning times
+  the quality filter and may not come out the same twice.
+
+Every record is flushed and synced to disk as it is written. A record
+cut short when the run was killed is discarded on resume.
+"""
+import hashlib
+import json
+import logging
+import os
+import struct
+import threading
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+from dashit_filter.guide_set import FilteredGuides
+from dashit_filter.offtarget_client import SearchProgress
+
+log = logging.getLogger(__name__)
+
+RUN_FILENAME = 'run.json'
+JOURNAL_FILENAME = 'journal'
+
+# kind, payload length, CRC-32 of the payload
+RECORD = struct.Struct('<BII')
+
+# Length of the JSON header of a `STAGE` record, number of guides
+STAGE_HEADER = struct.Struct('<II')
+
+STAGE = 1
+BATCH = 2
+PLAN = 3
+
+# Guides hashed at once when computing the key of a search
+SEARCH_KEY_CHUNK_SIZE = 1000000
+
+
+def file_signature(filename):
+    """Path, size and modification time of `filename`, which change
+    whenever it does, without hashing what may be a huge file"""
+
+    path = Path(filename).resolve()
+    stat = path.stat()
+    return [str(path), stat.st_size, stat.st_mtime_ns]
+
+
+def search_key(description, guides):
+    """Key of a search of `guides` for `description`, e.g. offtarget"""
+
+    digest = hashlib.sha256(description.encode('utf-8'))
+    for i in range(0, len(guides), SEARCH_KEY_CHUNK_SIZE):
+        digest.update(','.join(guides[i:i + SEARCH_KEY_CHUNK_SIZE]).encode('ascii'))
+        digest.update(b';')
+    return digest.hexdigest()
+
+
+class Checkpoint:
+    """A checkpoint directory, see the module documentation
+
+    Parameters
+    ----------
+    directory : str
+        checkpoint directory, created if it doesn't exist
+    run : dict
+        JSON serializable description of the run
+
+    Raises
+    ------
+    ValueError
+        if the directory holds the checkpoint of a different run
+    """
+
+    def __init__(self, directory, run):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+
+        # As read back from JSON, e.g. with lists for tuples
+        run = json.loads(json.dumps(run))
+
+        run_path = self.directory / RUN_FILENAME
+        if run_path.exists():
+            with open(run_path, 'r') as handle:
+                if json.load(handle) != run:
+                    raise ValueError(f'{directory} holds the checkpoint of '
+                                     'a different run')
+        else:
+            with open(run_path, 'w') as handle:
+                json.dump(run, handle, indent=2)
+
+        self.stages = {}
+        self.batches = {}
+        self.plan = None
+        journal_path = self.directory / JOURNAL_FILENAME
+        valid_size = self._load(journal_path)
+
+        self.journal = open(journal_path, 'ab')
+        # Drop a record cut short when the last run was killed
+        self.journal.truncate(valid_size)
+
+    def _load(self, path):
+        """Read the records of the journal, returns the size of its
+        valid part"""
+
+        if not path.exists():
+            return 0
+
+        with open(path, 'rb') as handle:
+            data = handle.read()
+
+        position = 0
+        while position + RECORD.size <= len(data):
+            kind, length, crc = RECORD.unpack_from(data, position)
+            payload = data[position + RECORD.size:position + RECORD.size + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                log.info('Discarding a checkpoint record cut short')
+                break
+            if kind == STAGE:
+                stage, filtered = self._decode_stage(payload)
+                self.stages[stage] = filtered
+                position += RECORD.size + length
+                continue
+            record = json.loads(zlib.decompress(payload))
+            if kind == BATCH:
+                self.batches.setdefault(record['search'], []).append(
+                    (record['start'], record['end'], set(record['matched'])))
+            elif kind == PLAN:
+                self.plan = record['order']
+            position += RECORD.size + length
+
+        return position
+
+    @staticmethod
+    def _encode_stage(stage, filtered):
+        packed, codes = filtered.arrays()
+        header = json.dumps({
+            'stage': stage, 'reasons': filtered.reasons,
+            'invalid_guides': filtered.invalid_guides}).encode('utf-8')
+        return (STAGE_HEADER.pack(len(header), len(packed)) + header +
+                packed.astype('<u8').tobytes() + codes.astype('<u4').tobytes())
+
+    @staticmethod
+    def _decode_stage(payload):
+        header_length, num_guides = STAGE_HEADER.unpack_from(payload)
+        position = STAGE_HEADER.size
+        header = json.loads(payload[position:position + header_length])
+        position += header_length
+        packed = np.frombuffer(payload, dtype='<u8', count=num_guides,
+                               offset=position)
+        codes = np.frombuffer(payload, dtype='<u4', count=num_guides,
+                              offset=position + 8 * num_guides)
+        return header['stage'], FilteredGuides.from_arrays(
+            packed, codes, header['reasons'], header['invalid_guides'])
+
+    def _append(self, kind, record):
+        self._write(kind, zlib.compress(json.dumps(record).encode('utf-8')))
+
+    def _write(self, kind, payload):
+        with self.lock:
+            self.journal.write(RECORD.pack(kind, len(payload),
+                                           zlib.crc32(payload)) + payload)
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+
+    def stage_verdicts(self, stage):
+        """Verdicts of `stage` if it completed, a `FilteredGuides` of
+        the guides it filtered, or None"""
+
+        return self.stages.get(stage)
+
+    def record_stage(self, stage, filtered):
+        """Record that `stage` completed, filtering the guides of the
+        `FilteredGuides` `filtered`"""
+
+        self.stages[stage] = filtered
+        self._write(STAGE, self._encode_stage(stage, filtered))
+
+    def planned_order(self):
+        """The planned order of the stages, a list of their names, or
+        None if it wasn't recorded"""
+
+        return self.plan
+
+    def record_plan(self, order):
+        """Record the planned order of the stages"""
+
+        self.plan = list(order)
+        self._append(PLAN, {'order': self.plan})
+
+    def search_progress(self, description, guides):
+        """`SearchProgress` of searching `guides` for `description`,
+        holding the batches already recorded and recording new ones"""
+
+        key = search_key(description, guides)
+
+        def record_batch(start, end, matched):
+            self._append(BATCH, {'search': key, 'start': start, 'end': end,
+                                 'matched': sorted(matched)})
+
+        progress = SearchProgress(len(guides), on_add=record_batch)
+        for start, end, matched in self.batches.get(key, []):
+            progress.add(start, end, matched, recorded=True)
+
+        if len(progress.batches) > 0:
+            log.info(f'Resuming {description} search with '
+                     f'{progress.num_done()} of {len(guides)} guides already '
+                     'searched')
+        return progress
+
+    def close(self):
+        with self.lock:
+            self.journal.close()
@@ -0,0 +1,204 @@
+"""
+Reading and writing gzip and zstd compressed files.
+
+Compressed inputs are recognized by their magic bytes, compressed
+outputs by their extension (.gz, .zst). Inputs are decompressed in a
+background thread, ahead of the reader, so decompression overlaps with
+filtering; zlib and zstd release the GIL while they work.
+
+zstd needs the zstandard package, which is only imported when a zstd
+file is opened.
+"""
+import contextlib
+import gzip
+import io
+import os
+import queue
+import sys
+import threading
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+EXTENSIONS = {'.gz': 'gzip', '.gzip': 'gzip', '.zst': 'zstd', '.zstd': 'zstd'}
+
+COMPRESSIONS = ('gzip', 'zstd')
+
+# Bytes decompressed at once, and decompressed chunks held ahead of the
+# reader
+CHUNK_SIZE = 1 << 20
+QUEUE_SIZE = 16
+
+# gzip level of compressed outputs, 9 is several times slower for
+# little gain on sites-to-reads files
+GZIP_LEVEL = 6
+
+
+def detect_compression(filename):
+    """'gzip' or 'zstd' if `filename` is compressed, from its magic
+    bytes, or None"""
+
+    with open(filename, 'rb') as handle:
+        magic = handle.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def compression_from_name(filename):
+    """'gzip' or 'zstd' if the extension of `filename` is that of a
+    compressed file, or None"""
+
+    return EXTENSIONS.get(os.path.splitext(str(filename))[1].lower())
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise IOError('reading and writing zstd files needs the zstandard '
+                      'package, pip install zstandard')
+    return zstandard
+
+
+class BackgroundReader(io.RawIOBase):
+    """Raw binary stream of the data read from `stream`, read ahead in a
+    background thread
+
+    Parameters
+    ----------
+    stream : file
+        binary file object, e.g. a decompressing reader. It is closed
+        with this stream.
+    """
+
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.chunks = queue.Queue(QUEUE_SIZE)
+        self.chunk = memoryview(b'')
+        self.done = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._read_ahead, daemon=True)
+        self.thread.start()
+
+    def _read_ahead(self):
+        try:
+            while not self.stopping.is_set():
+                chunk = self.stream.read(CHUNK_SIZE)
+                self.chunks.put(chunk)
+                if len(chunk) == 0:
+                    return
+        except Exception as e:
+            self.chunks.put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while len(self.chunk) == 0:
+            if self.done:
+                return 0
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                self.done = True
+                raise IOError(f'error decompressing: {chunk}') from chunk
+            if len(chunk) == 0:
+                self.done = True
+            self.chunk = memoryview(chunk)
+
+        size = min(len(buffer), len(self.chunk))
+        buffer[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopping.set()
+            # Unblock the thread if it's waiting for room in the queue
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.stream.close()
+        super().close()
+
+
+def open_input(filename, mode='rb'):
+    """Open `filename` for reading, decompressing it in a background
+    thread if it's gzip or zstd compressed
+
+    Compressed files can't seek, and their position is that of the
+    decompressed data.
+    """
+
+    compression = detect_compression(filename)
+    if compression is None:
+        return open(filename, mode)
+
+    if compression == 'gzip':
+        stream = gzip.open(filename, 'rb')
+    else:
+        stream = _zstandard().ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), read_across_frames=True, closefd=True)
+
+    handle = io.BufferedReader(BackgroundReader(stream), CHUNK_SIZE)
+    if 'b' in mode:
+        return handle
+    return io.TextIOWrapper(handle)
+
+
+@contextlib.contextmanager
+def open_output(filename=None, compression=None, mode='wb'):
+    """Open `filename`, or stdout if None, for writing, compressing what
+    is written with `compression`
+
+    Parameters
+    ----------
+    filename : str
+        file to write, or None for stdout
+    compression : str
+        'gzip', 'zstd' or None. If None, taken from the extension of
+        `filename`.
+    mode : str
+        'wb' or 'w'
+
+    Yields
+    ------
+    file
+        binary or text file object, depending on `mode`
+    """
+
+    if compression is None and filename is not None:
+        compression = compression_from_name(filename)
+
+    if filename is None:
+        sys.stdout.flush()
+        raw = sys.stdout.buffer
+    else:
+        raw = open(filename, 'wb')
+
+    if compression == 'gzip':
+        handle = gzip.GzipFile(fileobj=raw, mode='wb',
+                               compresslevel=GZIP_LEVEL)
+    elif compression == 'zstd':
+        handle = _zstandard().ZstdCompressor().stream_writer(raw, closefd=False)
+    else:
+        handle = raw
+
+    output = handle if 'b' in mode else io.TextIOWrapper(handle)
+    try:
+        yield output
+    finally:
+        output.flush()
+        if output is not handle:
+            output.detach()
+        if handle is not raw:
+            handle.close()
+        if raw is sys.stdout.buffer:
+            raw.flush()
+        else:
+            raw.close()
@@ -10,61 +10,236 @@ sites-to-reads file (output of =crispr_sites -r=): it simply removes
 lines from this file that match offtargets or have low quality.
 """
 import argparse
+import contextlib
+import functools
+import itertools
 import logging
 import os
-from datetime import datetime
 import re
 import subprocess
 import signal
 import sys
+import tempfile
 import threading
+import time
 import traceback
-import select
+import sqlite3
 import requests
 import atexit
 from requests import ConnectionError
 from pathlib import Path
-from dashit_filter.flash import poor_structure
+from dashit_filter.checkpoint import Checkpoint, file_signature
+from dashit_filter.compression import COMPRESSIONS, open_input, open_output
+from dashit_filter.features import StructureFeatures
+from dashit_filter.encoding import GUIDE_LENGTH
+from dashit_filter.guide_set import CHUNK_SIZE as GUIDE_CHUNK_SIZE
+from dashit_filter.guide_set import INVALID_GUIDE, FilteredGuides, GuideSet
+from dashit_filter.flash_batch import poor_structure_batch, poor_structure_packed
+from dashit_filter.exact_match import ExactMatcher
+from dashit_filter.endpoints import (UNIX_SCHEME, UnixHTTPAdapter, endpoint_url,
+                                     free_port)
+from dashit_filter.index_cache import IndexCache, file_digest
+from dashit_filter.metrics import RunMetrics, profiled, query_estimates
+from dashit_filter.offtarget_client import (RETRIES as OFFTARGET_RETRIES,
+                                            OfftargetClient,
+                                            OfftargetSearchError,
+                                            parse_offtargets)
+from dashit_filter.offtarget_index import OfftargetIndex
+from dashit_filter.server import serve_main
+from dashit_filter.sites_to_reads import MAGIC as SITES_TO_READS_MAGIC
+from dashit_filter.sites_to_reads import (SitesToReads, TextLines, convert_main,
+                                          copy_ranges, is_binary,
+                                          write_keep_mask)
+from dashit_filter.verdict_cache import VerdictCache
+import numpy as np
 from tqdm import tqdm, trange
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 log = logging.getLogger(__name__)
-logging.basicConfig(level=logging.INFO)
 
-def get_offtargets(targets, c5, c10, c20):
+# Port the stock special_ops_crispr_tools offtarget server listens on,
+# it doesn't read the PORT environment variable
+OFFTARGET_SERVER_PORT = 8080
+
+OFFTARGET_SERVER_URL = f'http://localhost:{OFFTARGET_SERVER_PORT}'
+
+# Default seconds the offtarget server may take to build its index
+OFFTARGET_STARTUP_TIMEOUT = 3600
+
+# Number of free ports tried when launching an offtarget server with
+# --offtarget_port auto, in case another process takes a port first
+OFFTARGET_PORT_ATTEMPTS = 3
+
+# Times an offtarget server that dies during a search is relaunched, the
+# search resuming from the batches that completed
+OFFTARGET_RESTARTS = 2
+
+# Radius of exact matches, matched in this process with --backend auto
+EXACT_RADIUS = (5, 10, 20)
+
+# Default GB the sites of an exactly matched site file may take in memory
+EXACT_MAX_MEMORY = 8
+
+# Filtering stages, in the order they run with --stage_order fixed
+STAGES = ('ontarget', 'offtarget', 'quality')
+
+# Quality filtering options --sweep can vary
+SWEEP_PARAMETERS = ('gc_freq_min', 'gc_freq_max', 'homopolymer',
+                    'dinucleotide_repeats', 'hairpin_min_inner',
+                    'hairpin_min_outer')
+
+# Guides the quality filter is timed on when planning the stage order
+PLANNER_SAMPLE_SIZE = 10000
+
+# Estimated seconds per guide on/offtarget servers take to answer exact
+# (5_10_20) and mismatch-tolerant searches, and the share of guides
+# ontarget and offtarget filtering typically reject. Servers can't be
+# timed before they are started, which is what planning tries to avoid,
+# so these rough orders of magnitude are used unless --plan_metrics
+# gives the ones an earlier run measured.
+SERVER_COST_PER_GUIDE = {'exact': 5e-6, 'mismatches': 1e-4}
+ESTIMATED_REJECTION = {'ontarget': 0.5, 'offtarget': 0.1}
+
+# Each thread querying the offtarget server keeps its own
+# `requests.Session`, so connections are kept alive between batches
+_offtarget_sessions = threading.local()
+
+# Set if a launched offtarget server turns out not to read the PORT
+# environment variable, after which no other ports are tried
+_offtarget_port_unsupported = threading.Event()
+
+# Set if the offtarget server turns out not to accept POSTed queries,
+# after which queries are sent as GET requests
+_offtarget_post_unsupported = threading.Event()
+
+# Stage timings and offtarget query latencies of this run, reported
+# with --metrics_out
+run_metrics = RunMetrics()
+
+def offtarget_session():
+    """Return this thread's `requests.Session` for the offtarget server"""
+
+    if not hasattr(_offtarget_sessions, 'session'):
+        session = requests.Session()
+        session.mount(UNIX_SCHEME, UnixHTTPAdapter())
+        _offtarget_sessions.session = session
+    return _offtarget_sessions.session
+
+def get_offtargets(targets, c5, c10, c20, num_threads=1,
+                   url=OFFTARGET_SERVER_URL, retries=OFFTARGET_RETRIES,
+                   batch_size=None, progress=None, alive=None):
     """Get offtargets from a locally running offtarget server
 
+    Guides are sent in batches by an `OfftargetClient`, which retries
+    batches that fail. If the server only answers GET queries, this and
+    all later searches use GET.
+
     Parameters
     ----------
     targets : list
         list of 20-mers to match against offtarget list
     c5, c10, c20 : int
         radius of match, see command line documentation
-    
+    num_threads : int
+        number of batches to have in flight at once
+    url : str
+        base URL of the offtarget server
+    retries : int
+        times a failed batch is retried before giving up
+    batch_size : int
+        guides per batch, adapted to the server's latency if None
+    progress : `SearchProgress`
+        progress of an earlier search of `targets` that failed, to
+        resume it
+    alive : callable
+        if given, returns False once the server is known to be gone, so
+        failed batches aren't retried
+
     Returns
     -------
     dict
        dict keyed on elements of targets, with boolean value
-       indicating if they were offtarget or not
+       indicating if they were offtarget or not. Keys are in the same
+       order as `targets`.
+
+    Raises
+    ------
+    OfftargetSearchError
+        if a batch failed after all retries, with the progress of the
+        search
     """
 
-    # Limits on how long URLs can be for GET requests
-    batch_size = 20000
+    limits = ",".join(map(str, [c5, c10, c20]))
+
+    client = OfftargetClient(
+        url, limits, window=num_threads, retries=retries,
+        batch_size=batch_size,
+        use_post=not _offtarget_post_unsupported.is_set(),
+        on_latency=functools.partial(run_metrics.record_latency,
+                                     'get_offtargets_batch'),
+        alive=alive)
 
-    offtargets = {}
-    
     try:
-        for i in range(0, len(targets), batch_size):
-            url = "http://localhost:8080/search?targets=%s&limits=%s"
-            url = url % (",".join(map(str, targets[i:i+batch_size])), ",".join(map(str, [c5, c10, c20])))
-            offtargets.update(parse_offtarget_server_response(requests.get(url, timeout=600)))
-    except ConnectionError:
-        log.error('Error contacting offtarget server')
-        raise
+        return client.search(targets, progress)
+    finally:
+        if not client.use_post:
+            _offtarget_post_unsupported.set()
+
+def poor_structure_reasons(sequences, filter_parms, jobs=1, executor=None):
+    """Find the unique sequences with poor structure
+
+    Parameters
+    ----------
+    sequences : list
+        sequences to check
+    filter_parms : dict
+        parameters controlling poor structure filtering
+    jobs : int
+        number of worker processes to filter with
+    executor : `concurrent.futures.ProcessPoolExecutor`
+        if given, the `jobs` workers to filter with, instead of starting
+        new ones
 
-    return offtargets
+    Returns
+    -------
+    dict
+        dict keyed on the sequences with poor structure, with the list
+        of reasons as value
+    """
 
-def filter_sites_poor_structure(sequences, filtered_sites, filter_parms):
+    # Workers are sent the sequences joined into one string, so can only
+    # split it again if they are all 20-mers
+    if (jobs > 1 and len(sequences) > 0 and
+            all(len(seq) == GUIDE_LENGTH for seq in sequences)):
+        unique_sequences = list(dict.fromkeys(sequences))
+
+        # A few chunks per worker evens out the load
+        chunk_size = max(-(-len(unique_sequences) // (4 * jobs)), 1000)
+        chunks = [unique_sequences[i:i + chunk_size]
+                  for i in range(0, len(unique_sequences), chunk_size)]
+
+        poor = {}
+        with contextlib.ExitStack() as stack:
+            if executor is None:
+                executor = stack.enter_context(
+                    ProcessPoolExecutor(max_workers=jobs))
+            results = executor.map(poor_structure_packed,
+                                   [''.join(chunk) for chunk in chunks],
+                                   itertools.repeat(filter_parms))
+            for chunk, chunk_poor in zip(chunks, results):
+                for i, reasons in chunk_poor:
+                    poor[chunk[i]] = reasons
+
+        return poor
+
+    explanations = poor_structure_batch(sequences, filter_parms,
+                                        need_explanation=True)
+
+    return {seq: reasons for seq, reasons in zip(sequences, explanations)
+            if len(reasons) > 0}
+
+def filter_sites_poor_structure(sequences, filtered_sites, filter_parms,
+                                jobs=1, verdict_cache=None, executor=None):
     """
     Filter CRISPR sites due to poor structural reasons.
     
@@ -85,6 +260,13 @@ def filter_sites_poor_structure(sequences, filtered_sites, filter_parms):
 	dict containing which sites have been filtered
     filter_parms : dict
 	parameters controlling poor structure filtering
+    jobs : int
+        number of worker processes to filter with
+    verdict_cache : `VerdictCache`
+        if given, only sequences without a cached verdict for
+        `filter_parms` are checked, and their verdicts are cached
+    executor : `concurrent.futures.ProcessPoolExecutor`
+        if given, the `jobs` workers to filter with
     """
 
     log.info('filtering sites for poor structure '
@@ -92,10 +274,25 @@ def filter_sites_poor_structure(sequences, filtered_sites, filter_parms):
 
     initial_num_filtered = len(filtered_sites)
 
+    if verdict_cache is not None:
+        key = verdict_cache.quality_stage_key(filter_parms)
+        cached = verdict_cache.lookup(key, sequences)
+        unseen = [seq for seq in dict.fromkeys(sequences) if seq not in cached]
+        log.info(f'{len(cached)} sites have cached quality verdicts')
+
+        poor = poor_structure_reasons(unseen, filter_parms, jobs=jobs,
+                                      executor=executor)
+        verdict_cache.store(key, {seq: poor.get(seq, []) for seq in unseen})
+
+        poor.update((seq, reasons) for seq, reasons in cached.items()
+                    if len(reasons) > 0)
+    else:
+        poor = poor_structure_reasons(sequences, filter_parms, jobs=jobs,
+                                      executor=executor)
+
     for seq in sequences:
-        reasons = poor_structure(seq, filter_parms, need_explanation=True)
-        if len(reasons) > 0:
-            filtered_sites.update({seq: reasons})
+        if seq in poor:
+            filtered_sites.update({seq: poor[seq]})
 
     log.info('removed {} sites from consideration due to poor '
 	     'structure'.format(len(filtered_sites) - initial_num_filtered))
@@ -124,10 +321,73 @@ def kill_offtarget_server(proc):
         the offtarget server process, as returned by `launch_offtarget_server`
     """
 
-    atexit.unregister(kill_external_process)
+    atexit.unregister(proc.cleanup_handler)
     proc.kill()
 
-def launch_offtarget_server(offtarget_filename):
+class OfftargetServerOutput:
+    """Reads the output of an offtarget server process in a background
+    thread
+
+    Reading in a thread means waiting for the server's output blocks
+    instead of polling, can time out, and keeps draining the server's
+    output for as long as it runs.
+
+    Parameters
+    ----------
+    proc : `subprocess.Popen`
+        the offtarget server process, with stdout a pipe
+    """
+
+    def __init__(self, proc):
+        self.proc = proc
+        self.lines = []
+        self.finished = False
+        self.condition = threading.Condition()
+        self.launched = time.monotonic()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            line = str(line, 'utf-8', 'replace')
+            with self.condition:
+                self.lines.append(line)
+                self.condition.notify_all()
+        with self.condition:
+            self.finished = True
+            self.condition.notify_all()
+
+    def elapsed(self):
+        """Seconds since the server was launched"""
+
+        return time.monotonic() - self.launched
+
+    def line(self, i, deadline):
+        """Wait for line `i` of the output
+
+        Parameters
+        ----------
+        i : int
+            index of the line
+        deadline : float
+            `time.monotonic` time to wait until
+
+        Returns
+        -------
+        str
+            the line, or None if the server's output ended or the
+            deadline passed first
+        """
+
+        with self.condition:
+            while len(self.lines) <= i and not self.finished:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.lines[i] if len(self.lines) > i else None
+
+def launch_offtarget_server(offtarget_filename, port=OFFTARGET_SERVER_PORT,
+                            startup_timeout=OFFTARGET_STARTUP_TIMEOUT):
     """Launch the off target filtering server.
 
     Parameters
@@ -135,6 +395,14 @@ def launch_offtarget_server(offtarget_filename):
     offtarget_filename : str
 	filename containing off target CRISPR sites, as generated by
 	`special_ops_crispr_tools/crispr_sites`
+    port : int
+        port the server listens on, passed to it in the PORT
+        environment variable. The stock offtarget server ignores it and
+        always listens on `OFFTARGET_SERVER_PORT`, other ports need an
+        offtarget build that reads PORT.
+    startup_timeout : float
+        seconds the server may take to build its index and start
+        answering queries
 
     Returns
     -------
@@ -143,25 +411,37 @@ def launch_offtarget_server(offtarget_filename):
     starting the server.
     """
 
-    if check_offtarget_running():
-        log.error('An on/offtarget filtering server is already running on the '
-                  'default port. Kill all offtarget servers before running '
+    if check_offtarget_running(port):
+        log.error('An on/offtarget filtering server is already running on '
+                  f'port {port}. Kill all offtarget servers before running '
                   'dashit_filter')
         log.error('e.g., killall offtarget')
         return None
     
+    # A build ignoring PORT listens on the stock port instead, which is
+    # only told apart from another server if none answered there before
+    stock_port = None
+    if (port != OFFTARGET_SERVER_PORT and
+            not check_offtarget_running(OFFTARGET_SERVER_PORT)):
+        stock_port = OFFTARGET_SERVER_PORT
+
     offtarget_env = os.environ.copy()
     offtarget_env['HOST'] = 'file://' + str(Path(offtarget_filename).resolve())
+    offtarget_env['PORT'] = str(port)
 
-    log.info('Launching offtarget with HOST = {}'.format(offtarget_env['HOST']))
+    log.info('Launching offtarget with HOST = {}, PORT = {}'.format(
+        offtarget_env['HOST'], offtarget_env['PORT']))
 
     proc = subprocess.Popen(['/usr/bin/env', 'offtarget'], env=offtarget_env,
                             stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
 
-    atexit.register(kill_external_process, proc=proc)
-    
-    stdout_poll = select.poll()
-    stdout_poll.register(proc.stdout)
+    # Each server gets its own handler, so that shutting down one
+    # server doesn't unregister the cleanup of another
+    proc.cleanup_handler = functools.partial(kill_external_process, proc=proc)
+    atexit.register(proc.cleanup_handler)
+
+    output = OfftargetServerOutput(proc)
+    deadline = time.monotonic() + startup_timeout
 
     # To detect if the offtarget server is running, we read from the
     # stdout/stderr of the offtarget process to see if the expected
@@ -169,57 +449,116 @@ def launch_offtarget_server(offtarget_filename):
     expected_lines = [ 'ingesting', 'computing', 'index',
                        'max', 'occupied', 'starting server']
 
-    server_started = False
-    
-    while server_started is False:
-        i = 0
-        output_lines = []
-        if stdout_poll.poll(1):
-            for line in proc.stdout:
-                line = str(line, 'utf-8')
-                output_lines.append(line)
-
-                if not expected_lines[i] in line:
-                    log.error("Error while launching offtarget server")
-                    log.error("Expected the offtarget server to output a "
-                              f"line containing {expected_lines[i]}, but the "
-                              f"offtarget process output {line}")
-                    log.error("Complete output from the offtarget "
-                              f"process: {output_lines}")
-
-                    # Attempt to display better help messages
-                    if 'env' in line:
-                        log.error("Is offtarget in your path and working?")
-                    elif 'Query' in line:
-                        # The query line reports which Query caused an
-                        # error, read the next line to see what the
-                        # error actually was
-                        next_line = str(proc.stdout.readline(), 'utf-8')
-
-                        if ('received target query for string with length != 20'
-                            in next_line):
-                            # This error occurs when a file with
-                            # something other than 20-mers is fed into
-                            # the offtarget server
-                            log.error(f"{offtarget_filename} is not the right "
-                                      "format. Does this file contain only "
-                                      "20-mers? It should be the output of "
-                                      "crispr_sites run on a FASTA file")
-
-                    proc.terminate()
-                    return None
-                else:
-                    log.info(f"Correct offtarget server output: {line.strip()}")
-
-                i += 1
+    for i, expected_line in enumerate(expected_lines):
+        line = output.line(i, deadline)
+
+        if line is None:
+            if proc.poll() is not None or output.finished:
+                log.error("The offtarget server exited while starting, "
+                          f"complete output: {output.lines}")
+            else:
+                log.error(f"The offtarget server didn't start within "
+                          f"{startup_timeout} seconds, output so far: "
+                          f"{output.lines}")
+            kill_offtarget_server(proc)
+            return None
+
+        if not expected_line in line:
+            log.error("Error while launching offtarget server")
+            log.error("Expected the offtarget server to output a "
+                      f"line containing {expected_line}, but the "
+                      f"offtarget process output {line}")
+            log.error("Complete output from the offtarget "
+                      f"process: {output.lines}")
+
+            # Attempt to display better help messages
+            if 'env' in line:
+                log.error("Is offtarget in your path and working?")
+            elif 'Query' in line:
+                # The query line reports which Query caused an
+                # error, read the next line to see what the
+                # error actually was
+                next_line = output.line(i + 1, time.monotonic() + 10) or ''
+
+                if ('received target query for string with length != 20'
+                    in next_line):
+                    # This error occurs when a file with
+                    # something other than 20-mers is fed into
+                    # the offtarget server
+                    log.error(f"{offtarget_filename} is not the right "
+                              "format. Does this file contain only "
+                              "20-mers? It should be the output of "
+                              "crispr_sites run on a FASTA file")
+
+            kill_offtarget_server(proc)
+            return None
+
+        log.info(f"Offtarget server output after {output.elapsed():.1f}s: "
+                 f"{line.strip()}")
+
+    # The server reports it is starting just before it starts
+    # listening, so give it a moment to answer
+    answered = wait_for_offtarget_server(
+        proc, port, timeout=max(deadline - time.monotonic(), 10),
+        stock_port=stock_port)
+
+    if answered != port:
+        if answered is not None:
+            log.error(f"The offtarget server was launched on port {port} but "
+                      f"listens on port {answered}: this offtarget build "
+                      "ignores the PORT environment variable")
+        else:
+            log.error(f"The offtarget server isn't answering on port {port}, "
+                      f"complete output: {output.lines}")
+        if port != OFFTARGET_SERVER_PORT:
+            _offtarget_port_unsupported.set()
+            log.error(f"The stock offtarget server only listens on port "
+                      f"{OFFTARGET_SERVER_PORT}. Rerun with --offtarget_port "
+                      f"{OFFTARGET_SERVER_PORT}, or with an offtarget build "
+                      "that reads PORT, or match sites without launching "
+                      "servers with --backend embedded or a server started "
+                      "with dashit_filter serve and --offtarget_endpoint")
+        kill_offtarget_server(proc)
+        return None
 
-                if i >= len(expected_lines):
-                    log.info("Offtarget succesfully started")
-                    server_started = True
-                    break
+    log.info(f"Offtarget succesfully started in {output.elapsed():.1f}s")
 
     return proc
 
+def wait_for_offtarget_server(proc, port, timeout=10, stock_port=None):
+    """Wait until the offtarget server answers queries on `port`
+
+    Parameters
+    ----------
+    proc : `subprocess.Popen`
+        the offtarget server process
+    port : int
+        port the server should be listening on
+    timeout : float
+        seconds to wait
+    stock_port : int
+        if given, also check this port, where an offtarget build that
+        ignores the PORT environment variable listens instead
+
+    Returns
+    -------
+    int
+        the port the server answered on, or None if it didn't within
+        `timeout` seconds or exited
+    """
+
+    deadline = time.monotonic() + timeout
+    delay = 0.01
+
+    while True:
+        for candidate in (port, stock_port):
+            if candidate is not None and check_offtarget_running(candidate):
+                return candidate
+        if time.monotonic() > deadline or proc.poll() is not None:
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
 def check_offtarget_alive(offtarget_proc):
     """
     Check that the offtarget server process is running. Log errors if not.
@@ -248,17 +587,25 @@ def check_offtarget_alive(offtarget_proc):
         return offtarget_proc
 
 
-def check_offtarget_running():
+def check_offtarget_running(port=OFFTARGET_SERVER_PORT):
     """
     Check to see if an offtarget server that we didn't start is
     running
 
+    Parameters
+    ----------
+    port : int
+        port to check
     """
 
+    # A query for a single guide, which any offtarget server answers
     try:
-        get_offtargets(["ACGT" * 5], 5, 9, 18)
+        offtarget_session().get(f'http://localhost:{port}/search',
+                                params={'targets': 'ACGT' * 5,
+                                        'limits': '5,9,18'},
+                                timeout=10)
         return True
-    except ConnectionError:
+    except requests.RequestException:
         return False
 
 def parse_offtarget_server_response(response):
@@ -273,10 +620,9 @@ def parse_offtarget_server_response(response):
 
     Returns
     -------
-    offtargets : defaultdict
+    offtargets : set
 
-    dictionary where `offtargets[site] == True` if `site` is an
-    offtarget
+    set of the sites that matched an offtarget
 
 
     Note
@@ -289,27 +635,1563 @@ def parse_offtarget_server_response(response):
     Here the sites are the CRISPR sites we asked about, and the text
     `true` and `false` indicates whether or not the site matched an
     offtarget.
+
+    Usually only a few sites match, so rather than decoding and
+    splitting the whole body we search the raw bytes for lines ending
+    in `true` and only decode those sites.
+    """
+
+    return parse_offtargets(response.content)
+
+class OfftargetServerBackend:
+    """On/offtarget matching with the external offtarget server
+
+    Parameters
+    ----------
+    sites_filename : str
+        filename containing CRISPR sites, as generated by
+        `special_ops_crispr_tools/crispr_sites`
+    radius : tuple
+        (c5, c10, c20) radius of match, see command line documentation
+    num_threads : int
+        number of batches of guides to have in flight at once
+    cache : `IndexCache`
+        if given, the server ingests a cached, deduplicated copy of the
+        sites file
+    port : int
+        port the server listens on. If None, a free port is picked
+        when the server is launched.
+    startup_timeout : float
+        seconds the server may take to start
+    retries : int
+        times a failed batch of guides is retried
+    batch_size : int
+        guides per batch, adapted to the server's latency if None
+    search_progress : callable
+        if given, called with the guides of each search to get the
+        `SearchProgress` to resume it from, e.g. from a `Checkpoint`
     """
 
-    offtargets = defaultdict(bool)
+    def __init__(self, sites_filename, radius, num_threads=1, cache=None,
+                 port=OFFTARGET_SERVER_PORT,
+                 startup_timeout=OFFTARGET_STARTUP_TIMEOUT,
+                 retries=OFFTARGET_RETRIES, batch_size=None,
+                 search_progress=None):
+        self.sites_filename = sites_filename
+        self.radius = radius
+        self.num_threads = num_threads
+        self.retries = retries
+        self.batch_size = batch_size
+        self.search_progress = search_progress
+        self.cache = cache
+        self.port = port
+        self.startup_timeout = startup_timeout
+        self.proc = None
+
+    def start(self):
+        """Launch the offtarget server, returns False if it failed to start"""
+
+        log.info(f'Launching the offtarget server for {self.sites_filename}, '
+                 'this may take a while')
+
+        sites_filename = self.sites_filename
+        if self.cache is not None:
+            try:
+                sites_filename = self.cache.sites_file(sites_filename)
+            except (IOError, ValueError) as e:
+                log.error(f'Error caching {self.sites_filename}: {e}')
+                return False
+
+        if self.port is not None:
+            self.proc = launch_offtarget_server(
+                sites_filename, port=self.port,
+                startup_timeout=self.startup_timeout)
+            return self.proc is not None
+
+        for attempt in range(OFFTARGET_PORT_ATTEMPTS):
+            self.port = free_port()
+            self.proc = launch_offtarget_server(
+                sites_filename, port=self.port,
+                startup_timeout=self.startup_timeout)
+            if self.proc is not None:
+                return True
+            if _offtarget_port_unsupported.is_set():
+                break
+            log.info('Retrying the offtarget server on another port')
 
-    for line in response.text.split('\n'):
-        if line[-4:] == 'true':
-            offtargets[line[0:20]] = True
+        return False
 
-    return offtargets
+    def search(self, guides):
+        """Match guides against the sites, see `get_offtargets`
+
+        If the server dies during the search it is relaunched, and the
+        search resumes from the batches that completed.
+        """
+
+        progress = None
+        if self.search_progress is not None:
+            progress = self.search_progress(guides)
+
+        for restart in range(OFFTARGET_RESTARTS + 1):
+            try:
+                return get_offtargets(guides, *self.radius,
+                                      num_threads=self.num_threads,
+                                      url=f'http://localhost:{self.port}',
+                                      retries=self.retries,
+                                      batch_size=self.batch_size,
+                                      progress=progress,
+                                      alive=lambda: self.proc.poll() is None)
+            except OfftargetSearchError as e:
+                if restart == OFFTARGET_RESTARTS or self.proc.poll() is None:
+                    log.error(f'Error contacting offtarget server: {e}')
+                    raise
+                progress = e.progress
+                log.warning(f'The offtarget server exited with '
+                            f'{progress.num_done()} of {len(guides)} guides '
+                            'searched, relaunching it')
+                atexit.unregister(self.proc.cleanup_handler)
+                if not self.start():
+                    raise
+
+    def close(self):
+        """Shut down the offtarget server"""
+
+        kill_offtarget_server(self.proc)
+
+class EmbeddedBackend:
+    """On/offtarget matching in this process with an `OfftargetIndex`
+
+    Parameters
+    ----------
+    sites_filename : str
+        filename containing CRISPR sites, as generated by
+        `special_ops_crispr_tools/crispr_sites`
+    radius : tuple
+        (c5, c10, c20) radius of match, see command line documentation
+    cache : `IndexCache`
+        if given, the index is memory-mapped from this cache instead of
+        being rebuilt
+    """
+
+    def __init__(self, sites_filename, radius, cache=None):
+        self.sites_filename = sites_filename
+        self.radius = radius
+        self.cache = cache
+        self.index = None
+
+    def start(self):
+        """Build the index, returns False if the sites file can't be read"""
+
+        log.info(f'Indexing sites in {self.sites_filename}')
+
+        try:
+            if self.cache is not None:
+                self.index = self.cache.load_index(self.sites_filename,
+                                                   self.radius)
+            else:
+                self.index = OfftargetIndex.from_file(self.sites_filename,
+                                                      self.radius)
+        except (IOError, ValueError) as e:
+            log.error(f'Error indexing {self.sites_filename}: {e}')
+            return False
+
+        return True
+
+    def search(self, guides):
+        """Match guides against the sites
+
+        Returns
+        -------
+        dict
+            dict keyed on the guides that matched a site, in the same
+            order as `guides`, with value True
+        """
+
+        matched = self.index.search(guides)
+        return {guide: True for guide, is_match in zip(guides, matched.tolist())
+                if is_match}
+
+    def close(self):
+        """Release the index"""
+
+        self.index = None
+
+class ExactBackend:
+    """Exact (5_10_20) on/offtarget matching in this process with an
+    `ExactMatcher`, which needs no index
+
+    Parameters
+    ----------
+    sites_filename : str
+        filename containing CRISPR sites, as generated by
+        `special_ops_crispr_tools/crispr_sites`
+    max_memory : int
+        bytes the sites may take in memory. Larger site files are
+        matched with a Bloom filter and a second pass over the file.
+    """
+
+    def __init__(self, sites_filename, max_memory):
+        self.sites_filename = sites_filename
+        self.max_memory = max_memory
+        self.matcher = None
+
+    def start(self):
+        """Read the sites, returns False if the sites file can't be read"""
+
+        log.info(f'Reading sites in {self.sites_filename}')
+
+        try:
+            self.matcher = ExactMatcher(self.sites_filename, self.max_memory)
+        except (IOError, ValueError) as e:
+            log.error(f'Error reading {self.sites_filename}: {e}')
+            return False
+
+        return True
+
+    def search(self, guides):
+        """Match guides against the sites
+
+        Returns
+        -------
+        dict
+            dict keyed on the guides that matched a site, in the same
+            order as `guides`, with value True
+        """
+
+        matched = self.matcher.search(guides)
+        return {guide: True for guide, is_match in zip(guides, matched.tolist())
+                if is_match}
+
+    def search_packed(self, packed):
+        """Boolean array, True for the `uint64` packed guides that
+        matched a site"""
+
+        return self.matcher.search_packed(packed)
+
+    def close(self):
+        """Release the sites"""
+
+        self.matcher = None
+
+class RemoteBackend:
+    """On/offtarget matching with an already running server, e.g. one
+    started with `dashit_filter serve`
+
+    Parameters
+    ----------
+    endpoint : str
+        endpoint of the server, see `dashit_filter.endpoints`
+    sites_filename : str
+        filename containing the CRISPR sites the server should be
+        serving
+    radius : tuple
+        (c5, c10, c20) radius of match, see command line documentation
+    num_threads : int
+        number of batches of guides to have in flight at once
+    cache : `IndexCache`
+        if given, used to look up the digest of `sites_filename`
+    retries : int
+        times a failed batch of guides is retried
+    batch_size : int
+        guides per batch, adapted to the server's latency if None
+    search_progress : callable
+        if given, called with the guides of each search to get the
+        `SearchProgress` to resume it from, e.g. from a `Checkpoint`
+    """
+
+    def __init__(self, endpoint, sites_filename, radius, num_threads=1,
+                 cache=None, retries=OFFTARGET_RETRIES, batch_size=None,
+                 search_progress=None):
+        self.endpoint = endpoint
+        self.sites_filename = sites_filename
+        self.radius = radius
+        self.num_threads = num_threads
+        self.retries = retries
+        self.batch_size = batch_size
+        self.search_progress = search_progress
+        self.cache = cache
+        self.url = None
+
+    def start(self):
+        """Check the server is serving `sites_filename`, returns False
+        if it isn't or can't be reached"""
+
+        try:
+            self.url = endpoint_url(self.endpoint)
+            response = offtarget_session().get(self.url + '/info', timeout=60)
+            info = response.json() if response.ok else None
+        except (ValueError, ConnectionError) as e:
+            log.error(f'Error contacting {self.endpoint}: {e}')
+            return False
+
+        if info is None or 'sha256' not in info:
+            log.error(f'{self.endpoint} does not say which sites file it is '
+                      'serving, was it started with dashit_filter serve?')
+            return False
+
+        if self.cache is not None:
+            digest = self.cache.sites_digest(self.sites_filename)
+        else:
+            digest = file_digest(self.sites_filename)
+
+        if info['sha256'] != digest:
+            log.error(f'{self.endpoint} is serving {info.get("sites_file")}, '
+                      f'whose contents differ from {self.sites_filename}')
+            return False
+
+        log.info(f'Using {self.endpoint}, serving {info.get("sites_file")}')
+        return True
+
+    def search(self, guides):
+        """Match guides against the sites, see `get_offtargets`"""
+
+        try:
+            return get_offtargets(guides, *self.radius,
+                                  num_threads=self.num_threads, url=self.url,
+                                  retries=self.retries,
+                                  batch_size=self.batch_size,
+                                  progress=(None if self.search_progress is None
+                                            else self.search_progress(guides)))
+        except OfftargetSearchError as e:
+            log.error(f'Error contacting {self.endpoint}: {e}')
+            raise
+
+    def close(self):
+        """Nothing to do, the server keeps running for other clients"""
+
+class CachedBackend:
+    """On/offtarget matching that remembers which guides matched in a
+    `VerdictCache`
+
+    The wrapped backend is only started once guides without a cached
+    verdict are searched, so reruns over guides already seen never
+    start it.
+
+    Parameters
+    ----------
+    backend : `OfftargetServerBackend`, `EmbeddedBackend` or `RemoteBackend`
+        backend to search guides without a cached verdict with, not
+        yet started
+    verdict_cache : `VerdictCache`
+        cache of verdicts
+    key : str
+        stage key of the sites and radius `backend` matches against
+    description : str
+        what the sites are used for, e.g. ontarget, used in log messages
+    """
+
+    def __init__(self, backend, verdict_cache, key, description):
+        self.backend = backend
+        self.verdict_cache = verdict_cache
+        self.key = key
+        self.description = description
+        self.started = False
+
+    def start(self):
+        """Nothing to do, the wrapped backend is started when needed"""
+
+        return True
+
+    def search(self, guides):
+        """Match guides against the sites, see `EmbeddedBackend.search`"""
+
+        cached = self.verdict_cache.lookup(self.key, guides)
+        unseen = [guide for guide in dict.fromkeys(guides)
+                  if guide not in cached]
+
+        log.info(f'{len(cached)} guides have cached {self.description} '
+                 f'verdicts, searching {len(unseen)}')
+
+        if len(unseen) > 0:
+            if not self.started:
+                # Reported as a startup of its own rather than as part of
+                # the queries that needed it
+                with run_metrics.stage(self.description + '_startup'):
+                    start_backend(self.backend, self.description)
+                self.started = True
+
+            matched = self.backend.search(unseen)
+            self.verdict_cache.store(self.key, {guide: guide in matched
+                                                for guide in unseen})
+            cached.update((guide, True) for guide in matched)
+
+        return {guide: True for guide in guides if cached.get(guide)}
+
+    def close(self):
+        """Shut down the wrapped backend, if it was started"""
+
+        if self.started:
+            self.backend.close()
+
+def start_backend(backend, description):
+    """Start `backend`, exits if it can't be started"""
+
+    if not backend.start():
+        log.error(f'Error starting {description} filtering backend')
+        sys.exit(1)
+
+def open_verdict_cache(args):
+    """The `VerdictCache` selected with --verdict_cache, or None"""
+
+    if args.verdict_cache is None:
+        return None
+
+    try:
+        return VerdictCache(args.verdict_cache)
+    except sqlite3.Error as e:
+        log.error(f'Error opening verdict cache {args.verdict_cache}: {e}')
+        sys.exit(1)
+
+def open_checkpoint(args, filter_parms, ontarget_radius, offtarget_radius):
+    """The `Checkpoint` selected with --checkpoint_dir, or None. Exits if
+    it is the checkpoint of a different run."""
+
+    if args.checkpoint_dir is None:
+        return None
+
+    try:
+        run = {'input': file_signature(args.input),
+               'ontarget': (None if args.ontarget is None
+                            else file_signature(args.ontarget)),
+               'ontarget_radius': list(ontarget_radius),
+               'offtarget': (None if args.offtarget is None
+                             else file_signature(args.offtarget)),
+               'offtarget_radius': list(offtarget_radius),
+               'filter_parms': filter_parms,
+               'pipelined': args.pipelined,
+               'stage_order': args.stage_order}
+        checkpoint = Checkpoint(args.checkpoint_dir, run)
+    except (IOError, ValueError) as e:
+        log.error(f'Error opening checkpoint {args.checkpoint_dir}: {e}')
+        sys.exit(1)
+
+    return checkpoint
+
+def completed_stage(checkpoint, stage):
+    """Verdicts of `stage` if `checkpoint` records that it completed, a
+    `FilteredGuides` of the guides it filtered, else None"""
+
+    if checkpoint is None:
+        return None
+
+    verdicts = checkpoint.stage_verdicts(stage)
+    if verdicts is not None:
+        log.info(f'Skipping {stage} filtering, completed before in '
+                 f'{checkpoint.directory}')
+    return verdicts
+
+def replay_stage(verdicts, candidate_guides, filtered_guides):
+    """Add the `verdicts` of a completed stage to `filtered_guides`
+
+    Returns
+    -------
+    `GuideSet`
+        the candidate guides that aren't filtered
+    """
+
+    filtered_guides.update(verdicts)
+    return candidate_guides.difference(verdicts.guides())
+
+def record_stage(checkpoint, stage, filtered_guides, num_filtered_before):
+    """Record in `checkpoint`, if given, that `stage` completed, having
+    added the guides after the first `num_filtered_before` of
+    `filtered_guides`"""
+
+    if checkpoint is not None:
+        checkpoint.record_stage(stage,
+                                filtered_guides.since(num_filtered_before))
+
+def parse_stage_order(order):
+    """Parse --stage_order: fixed, planned, or a comma separated list of
+    the stages"""
+
+    if order in ('fixed', 'planned'):
+        return order
+
+    stages = order.split(',')
+    if sorted(stages) != sorted(STAGES):
+        raise argparse.ArgumentTypeError(
+            f'invalid stage order {order}, should be fixed, planned or '
+            f'{",".join(STAGES)} in any order')
+    return stages
+
+def plan_stages(stages, candidate_guides, filter_parms, radii, jobs=1,
+                estimates=None):
+    """Order filtering stages so that guides are rejected as cheaply as
+    possible
+
+    Running a stage that costs c per guide and rejects a share r of its
+    guides before one with c' and r' is cheaper when c / r < c' / r', so
+    stages are sorted on c / r. The cost and rejection rate of the
+    quality stage are measured on a sample of the guides; those of the
+    on/offtarget stages are taken from `estimates`, or estimated from
+    their radius.
+
+    Parameters
+    ----------
+    stages : list
+        names of the stages to order
+    candidate_guides : `GuideSet`
+        guides to filter
+    filter_parms : dict
+        parameters controlling poor structure filtering
+    radii : dict
+        (c5, c10, c20) radius of match of the ontarget and offtarget
+        stages
+    jobs : int
+        number of processes quality filtering runs in
+    estimates : dict
+        (seconds per guide, share rejected) of on/offtarget stages, as
+        measured by an earlier run, see `metrics.query_estimates`
+
+    Returns
+    -------
+    list
+        the stages, in the order to run them
+    """
+
+    if estimates is None:
+        estimates = {}
+
+    step = max(len(candidate_guides) // PLANNER_SAMPLE_SIZE, 1)
+    sample = candidate_guides[::step].strings(0, PLANNER_SAMPLE_SIZE)
+
+    ranks = {}
+    for stage in stages:
+        if stage == 'quality':
+            start = time.perf_counter()
+            rejected = poor_structure_reasons(sample, filter_parms)
+            cost = ((time.perf_counter() - start) / max(len(sample), 1) /
+                    max(jobs, 1))
+            rejection = len(rejected) / max(len(sample), 1)
+        elif stage in estimates:
+            cost, rejection = estimates[stage]
+        else:
+            exact = tuple(radii[stage]) == EXACT_RADIUS
+            cost = SERVER_COST_PER_GUIDE['exact' if exact else 'mismatches']
+            rejection = ESTIMATED_REJECTION[stage]
+        log.info(f'{stage} filtering costs about {cost * 1e6:.1f} us per '
+                 f'guide and rejects about {rejection:.0%} of guides')
+        ranks[stage] = cost / max(rejection, 1e-6)
+
+    return sorted(stages, key=ranks.get)
+
+def stage_order(args, candidate_guides, filter_parms, radii, checkpoint=None):
+    """The stages to run, in the order selected with --stage_order
+
+    Stages whose sites file wasn't given are left out. A planned order
+    is recorded in `checkpoint`, if given, so a resumed run keeps it.
+    """
+
+    stages = [stage for stage in STAGES
+              if stage == 'quality' or getattr(args, stage) is not None]
+
+    if args.stage_order == 'fixed':
+        return stages
+
+    if args.stage_order != 'planned':
+        return [stage for stage in args.stage_order if stage in stages]
+
+    order = None if checkpoint is None else checkpoint.planned_order()
+    if order is None:
+        estimates = None
+        if args.plan_metrics is not None:
+            try:
+                estimates = query_estimates(args.plan_metrics)
+            except (OSError, ValueError) as e:
+                log.error(f'Error reading --plan_metrics: {e}')
+                sys.exit(1)
+
+        with run_metrics.stage('plan'):
+            order = plan_stages(stages, candidate_guides, filter_parms, radii,
+                                jobs=args.jobs, estimates=estimates)
+        if checkpoint is not None:
+            checkpoint.record_plan(order)
+
+    log.info(f'Filtering stages will run in the order {", ".join(order)}')
+    return order
+
+def sites_backend(args, sites_filename, radius, description, endpoint=None,
+                  port_offset=0, checkpoint=None):
+    """The on/offtarget matching backend selected with --backend, not
+    yet started
+
+    Parameters are those of `start_sites_backend`.
+
+    Returns
+    -------
+    `OfftargetServerBackend`, `EmbeddedBackend`, `ExactBackend` or
+    `RemoteBackend`
+
+    Raises
+    ------
+    ValueError
+        if the backend selected can't match `radius`
+    """
+
+    cache = None
+    if args.index_cache is not None:
+        cache = IndexCache(args.index_cache,
+                           int(args.index_cache_size * 1024**3))
+
+    search_progress = None
+    if checkpoint is not None:
+        search_progress = functools.partial(checkpoint.search_progress,
+                                            description)
+
+    if endpoint is not None:
+        return RemoteBackend(endpoint, sites_filename, radius,
+                             num_threads=args.offtarget_threads,
+                             cache=cache, retries=args.offtarget_retries,
+                             batch_size=args.offtarget_batch_size,
+                             search_progress=search_progress)
+
+    if args.backend == 'exact' or (args.backend == 'auto' and
+                                   tuple(radius) == EXACT_RADIUS):
+        if tuple(radius) != EXACT_RADIUS:
+            raise ValueError(f'--backend exact only matches the 5_10_20 '
+                             f'radius, not the {description} radius '
+                             f'{"_".join(map(str, radius))}')
+        return ExactBackend(sites_filename,
+                            int(args.exact_max_memory * 1024**3))
+
+    if args.backend == 'embedded':
+        return EmbeddedBackend(sites_filename, radius, cache=cache)
+
+    return OfftargetServerBackend(
+        sites_filename, radius, num_threads=args.offtarget_threads,
+        cache=cache,
+        port=(None if args.offtarget_port == 'auto'
+              else args.offtarget_port + port_offset),
+        startup_timeout=args.offtarget_startup_timeout,
+        retries=args.offtarget_retries,
+        batch_size=args.offtarget_batch_size,
+        search_progress=search_progress)
+
+def launches_server(args, radius, endpoint=None):
+    """Whether `sites_backend` launches an offtarget server for
+    `radius`. The stock offtarget server always listens on
+    `OFFTARGET_SERVER_PORT`."""
+
+    return endpoint is None and (args.backend == 'server' or
+                                 (args.backend == 'auto' and
+                                  tuple(radius) != EXACT_RADIUS))
+
+def launch_plan(args, stages, radii):
+    """How to start the backends of the on/offtarget `stages` together
+
+    Only backends that launch an offtarget server, see
+    `launches_server`, listen on a port of their own: --offtarget_port
+    for the first and the next port for the second. The stock offtarget
+    server only listens on `OFFTARGET_SERVER_PORT`, so two servers
+    launched on that port have to run one at a time instead.
+
+    Parameters
+    ----------
+    args : `argparse.Namespace`
+        parsed command line arguments
+    stages : list
+        the stages, in the order they run
+    radii : dict
+        (c5, c10, c20) radius of match of each stage
+
+    Returns
+    -------
+    tuple
+        (port_offsets, one_at_a_time): the port offset of each stage, as
+        passed to `start_sites_backend`, and whether their servers must
+        run one at a time
+    """
+
+    launching = [stage for stage in stages
+                 if launches_server(args, radii[stage],
+                                    getattr(args, f'{stage}_endpoint'))]
+
+    port_offsets = {stage: 0 for stage in stages}
+    if args.offtarget_port == OFFTARGET_SERVER_PORT and len(launching) == 2:
+        return port_offsets, True
+
+    port_offsets.update((stage, i) for i, stage in enumerate(launching))
+    return port_offsets, False
+
+def start_sites_backend(args, sites_filename, radius, description,
+                        endpoint=None, port_offset=0, verdict_cache=None,
+                        checkpoint=None):
+    """Start the on/offtarget matching backend selected with --backend
+
+    Parameters
+    ----------
+    args : `argparse.Namespace`
+        parsed command line arguments
+    sites_filename : str
+        filename containing the CRISPR sites to match against
+    radius : tuple
+        (c5, c10, c20) radius of match
+    description : str
+        what the sites are used for, e.g. ontarget, used in log messages
+    endpoint : str
+        if given, use the server already running on this endpoint
+    port_offset : int
+        if an offtarget server is launched, it listens on --offtarget_port
+        plus this, so servers launched at once get different ports.
+        Ignored with --offtarget_port auto.
+    verdict_cache : `VerdictCache`
+        if given, the backend is wrapped in a `CachedBackend`
+    checkpoint : `Checkpoint`
+        if given, batches of guides searched by an on/offtarget server
+        are recorded in it, and searches resume from the batches
+        recorded
+
+    Returns
+    -------
+    `OfftargetServerBackend`, `EmbeddedBackend`, `ExactBackend`,
+    `RemoteBackend` or `CachedBackend`, ready to search. Exits if the
+    backend can't be started.
+    """
+
+    try:
+        backend = sites_backend(args, sites_filename, radius, description,
+                                endpoint=endpoint, port_offset=port_offset,
+                                checkpoint=checkpoint)
+    except ValueError as e:
+        log.error(str(e))
+        sys.exit(1)
+
+    if verdict_cache is not None:
+        try:
+            key = verdict_cache.sites_stage_key(sites_filename, radius)
+        except IOError as e:
+            log.error(f'Error reading {sites_filename}: {e}')
+            sys.exit(1)
+        return CachedBackend(backend, verdict_cache, key, description)
+
+    start_backend(backend, description)
+
+    return backend
+
+def search_guides(backend, guides):
+    """Search the `GuideSet` `guides` with `backend`, a chunk at a time
+    so only one chunk is held as strings
+
+    Returns
+    -------
+    `numpy.ndarray`
+        boolean array, True for the guides that matched
+    """
+
+    if hasattr(backend, 'search_packed'):
+        # Exact matching looks up the packed guides as they are. Guides
+        # that aren't 20 bases of A, C, G, T are flagged beyond the bits
+        # of any site, so never match, as with `search`.
+        return backend.search_packed(guides.packed)
+
+    matched = np.zeros(len(guides), dtype=bool)
+
+    for start in range(0, len(guides), GUIDE_CHUNK_SIZE):
+        chunk = guides.strings(start, start + GUIDE_CHUNK_SIZE)
+        try:
+            found = backend.search(chunk)
+        except:
+            log.error(f"Error getting offtargets from offtarget server")
+            raise
+        matched[start:start + len(chunk)] = np.fromiter(
+            (guide in found for guide in chunk), dtype=bool, count=len(chunk))
+
+    return matched
+
+def filter_ontargets(candidate_guides, filtered_guides, backend,
+                     ontarget_filename):
+    """Filter out guides that don't match an ontarget
+
+    Parameters
+    ----------
+    candidate_guides : `GuideSet`
+        guides to check
+    filtered_guides : `FilteredGuides`
+        guides that aren't ontargets are added to this, with the reason
+        they were filtered
+    backend : `OfftargetServerBackend`, `EmbeddedBackend` or `RemoteBackend`
+        started backend matching the ontarget sites
+    ontarget_filename : str
+        file the ontarget sites came from, for the filtering reason
+
+    Returns
+    -------
+    `GuideSet`
+        the candidate guides that are ontargets
+    """
+
+    log.info('Filtering ontarget guides')
+
+    ontargets = search_guides(backend, candidate_guides)
+
+    filtered_guides.add(candidate_guides[~ontargets],
+                        'not ontarget in {}'.format(ontarget_filename))
+
+    log.info('{} guides were not ontargets '
+             'in {}'.format(int((~ontargets).sum()), ontarget_filename))
+
+    return candidate_guides[ontargets]
+
+def filter_offtargets(candidate_guides, filtered_guides, backend,
+                      offtarget_filename):
+    """Filter out guides that match an offtarget
+
+    Parameters
+    ----------
+    candidate_guides : `GuideSet`
+        guides to check
+    filtered_guides : `FilteredGuides`
+        guides that are offtargets are added to this, with the reason
+        they were filtered
+    backend : `OfftargetServerBackend`, `EmbeddedBackend` or `RemoteBackend`
+        started backend matching the offtarget sites
+    offtarget_filename : str
+        file the offtarget sites came from, for the filtering reason
+
+    Returns
+    -------
+    `GuideSet`
+        the candidate guides that aren't filtered
+    """
+
+    log.info('Filtering offtarget guides')
+
+    offtargets = search_guides(backend, candidate_guides)
+
+    filtered_guides.add(candidate_guides[offtargets],
+                        'offtarget against {}'.format(offtarget_filename))
+
+    log.info('{} guides matched against offtargets '
+             'in {}'.format(int(offtargets.sum()), offtarget_filename))
+
+    return candidate_guides[~offtargets]
+
+def filter_quality(candidate_guides, filtered_guides, filter_parms, jobs=1,
+                   verdict_cache=None, executor=None):
+    """Filter out guides with poor structure, see
+    `filter_sites_poor_structure`, a chunk at a time so only one chunk
+    is held as strings
+
+    Parameters
+    ----------
+    candidate_guides : `GuideSet`
+        guides to check
+    filtered_guides : `FilteredGuides`
+        guides with poor structure are added to this, with the reasons
+        they were filtered
+    filter_parms : dict
+        parameters controlling poor structure filtering
+    jobs : int
+        number of worker processes to filter with
+    verdict_cache : `VerdictCache`
+        if given, cache of verdicts to reuse and update
+    executor : `concurrent.futures.ProcessPoolExecutor`
+        if given, the `jobs` workers to filter with
+
+    Returns
+    -------
+    `GuideSet`
+        the candidate guides that aren't filtered
+    """
+
+    poor = np.zeros(len(candidate_guides), dtype=bool)
+
+    for start in range(0, len(candidate_guides), GUIDE_CHUNK_SIZE):
+        chunk = candidate_guides.strings(start, start + GUIDE_CHUNK_SIZE)
+        rejected = {}
+        filter_sites_poor_structure(chunk, rejected, filter_parms, jobs=jobs,
+                                    verdict_cache=verdict_cache,
+                                    executor=executor)
+        chunk_poor = np.fromiter((guide in rejected for guide in chunk),
+                                 dtype=bool, count=len(chunk))
+        filtered_guides.add(candidate_guides[start:start + len(chunk)][chunk_poor],
+                            list(rejected.values()))
+        poor[start:start + len(chunk)] = chunk_poor
+
+    return candidate_guides[~poor]
+
+def sequential_filter(candidate_guides, filtered_guides, args, filter_parms,
+                      ontarget_radius, offtarget_radius, order,
+                      verdict_cache=None, checkpoint=None):
+    """Run the ontarget, offtarget and quality filters one after the
+    other, each on the guides that survived the ones before
+
+    Parameters
+    ----------
+    candidate_guides : `GuideSet`
+        guides to filter
+    filtered_guides : `FilteredGuides`
+        filtered guides are added to this, with the reasons the first
+        stage that rejected them gave
+    args : `argparse.Namespace`
+        parsed command line arguments
+    filter_parms : dict
+        parameters controlling poor structure filtering
+    ontarget_radius, offtarget_radius : tuple
+        (c5, c10, c20) radii of match
+    order : list
+        names of the stages to run, in order, see `stage_order`
+    verdict_cache : `VerdictCache`
+        if given, cache of verdicts to reuse and update
+    checkpoint : `Checkpoint`
+        if given, stages it records as completed are skipped, and
+        stages that complete are recorded
+    """
+
+    radii = {'ontarget': ontarget_radius, 'offtarget': offtarget_radius}
+
+    for stage in order:
+        verdicts = completed_stage(checkpoint, stage)
+        if verdicts is not None:
+            candidate_guides = replay_stage(verdicts, candidate_guides,
+                                            filtered_guides)
+            continue
+
+        num_filtered_before = len(filtered_guides)
+
+        if stage == 'quality':
+            log.info('Filtering guides for quality')
+            with run_metrics.stage('quality',
+                                   guides_in=len(candidate_guides)) as metrics, \
+                    profiled(args.profile_quality):
+                candidate_guides = filter_quality(candidate_guides,
+                                                  filtered_guides, filter_parms,
+                                                  jobs=args.jobs,
+                                                  verdict_cache=verdict_cache)
+                metrics['guides_out'] = len(candidate_guides)
+        else:
+            # Note: ontarget filtering uses the offtarget server, but
+            # with a list of ontargets
+            sites_filename = getattr(args, stage)
+            with run_metrics.stage(stage + '_startup'):
+                backend = start_sites_backend(
+                    args, sites_filename, radii[stage], stage,
+                    endpoint=getattr(args, stage + '_endpoint'),
+                    verdict_cache=verdict_cache, checkpoint=checkpoint)
+
+            filter_stage = (filter_ontargets if stage == 'ontarget'
+                            else filter_offtargets)
+            with run_metrics.stage(stage + '_queries',
+                                   guides_in=len(candidate_guides)) as metrics:
+                candidate_guides = filter_stage(candidate_guides,
+                                                filtered_guides, backend,
+                                                sites_filename)
+                metrics['guides_out'] = len(candidate_guides)
+
+            log.info(f'Shutting down {stage} filtering backend')
+            backend.close()
+
+        record_stage(checkpoint, stage, filtered_guides, num_filtered_before)
+
+def pipelined_filter(candidate_guides, filtered_guides, args, filter_parms,
+                     ontarget_radius, offtarget_radius, order,
+                     verdict_cache=None, checkpoint=None):
+    """Run the ontarget, offtarget and quality filters concurrently
+
+    The ontarget and offtarget backends are started at the same time,
+    on separate ports, and the quality filter runs on every guide while
+    they start. Two offtarget servers launched on the default port are
+    started one after the other instead, see `launch_plan`.
+
+    The results, including the order guides are added to
+    `filtered_guides`, are the same as running the stages one after
+    the other in `order`: guides are only sent to the backends of
+    stages after the quality stage if they passed it, and only reported
+    as having poor structure if they passed the stages before it.
+
+    Parameters
+    ----------
+    candidate_guides : `GuideSet`
+        guides to filter
+    filtered_guides : `FilteredGuides`
+        filtered guides are added to this, with the reasons they were
+        filtered
+    args : `argparse.Namespace`
+        parsed command line arguments
+    filter_parms : dict
+        parameters controlling poor structure filtering
+    ontarget_radius, offtarget_radius : tuple
+        (c5, c10, c20) radii of match
+    order : list
+        names of the stages to run, in order, see `stage_order`
+    verdict_cache : `VerdictCache`
+        if given, cache of verdicts to reuse and update
+    checkpoint : `Checkpoint`
+        if given, stages it records as completed are skipped, and
+        stages that complete are recorded
+    """
+
+    def start(stage):
+        with run_metrics.stage(stage + '_startup'):
+            return start_sites_backend(
+                args, getattr(args, stage), radii[stage], stage,
+                endpoint=getattr(args, f'{stage}_endpoint'),
+                port_offset=port_offsets[stage], verdict_cache=verdict_cache,
+                checkpoint=checkpoint)
+
+    radii = {'ontarget': ontarget_radius, 'offtarget': offtarget_radius}
+    verdicts = {stage: completed_stage(checkpoint, stage)
+                for stage in ('ontarget', 'offtarget')
+                if getattr(args, stage) is not None}
+
+    # Stages whose backend needs starting, in the order they run
+    to_start = [stage for stage in order
+                if stage in verdicts and verdicts[stage] is None]
+    port_offsets, one_at_a_time = launch_plan(args, to_start, radii)
+
+    if one_at_a_time:
+        log.info(f'The ontarget and offtarget servers would both listen on '
+                 f'port {OFFTARGET_SERVER_PORT}, the only port the stock '
+                 'offtarget server listens on, so the second one is launched '
+                 'once the first is shut down. Pass --offtarget_port auto, '
+                 'with an offtarget build that reads the PORT environment '
+                 'variable, to launch them together.')
+        to_start = to_start[:1]
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {stage: executor.submit(start, stage) for stage in to_start}
+
+        quality_filtered = FilteredGuides()
+        quality_verdicts = None
+        if 'quality' in order:
+            quality_verdicts = completed_stage(checkpoint, 'quality')
+        if quality_verdicts is not None:
+            quality_filtered.update(quality_verdicts)
+        elif 'quality' in order:
+            log.info('Filtering guides for quality while on/offtarget '
+                     'backends start')
+            with run_metrics.stage('quality',
+                                   guides_in=len(candidate_guides)) as stage, \
+                    profiled(args.profile_quality):
+                stage['guides_out'] = len(filter_quality(
+                    candidate_guides, quality_filtered, filter_parms,
+                    jobs=args.jobs, verdict_cache=verdict_cache))
+            record_stage(checkpoint, 'quality', quality_filtered, 0)
+
+        for stage in order:
+            if stage == 'quality':
+                # Only guides that survived the stages before are
+                # reported as having poor structure
+                filtered_guides.update(quality_filtered.subset(candidate_guides))
+                candidate_guides = candidate_guides.difference(
+                    quality_filtered.guides())
+            elif verdicts[stage] is not None:
+                candidate_guides = replay_stage(verdicts[stage],
+                                                candidate_guides,
+                                                filtered_guides)
+            else:
+                num_filtered_before = len(filtered_guides)
+                if stage not in futures:
+                    futures[stage] = executor.submit(start, stage)
+                backend = futures[stage].result()
+                filter_stage = (filter_ontargets if stage == 'ontarget'
+                                else filter_offtargets)
+                with run_metrics.stage(stage + '_queries',
+                                       guides_in=len(candidate_guides)) as metrics:
+                    candidate_guides = filter_stage(candidate_guides,
+                                                    filtered_guides, backend,
+                                                    getattr(args, stage))
+                    metrics['guides_out'] = len(candidate_guides)
+                log.info(f'Shutting down {stage} filtering backend')
+                backend.close()
+                record_stage(checkpoint, stage, filtered_guides,
+                             num_filtered_before)
+
+def parse_radius(radius, name):
+    """Parse an L_M_N radius string, as given to --offtarget_radius
+
+    Parameters
+    ----------
+    radius : str
+        radius string, e.g. 5_10_20
+    name : str
+        which radius this is, used in error messages
+
+    Returns
+    -------
+    tuple
+        (c5, c10, c20) integers. Exits if the radius string is invalid.
+    """
+
+    try:
+        c5, c10, c20 = map(int, radius.split('_'))
+    except ValueError:
+        log.error(f"Invalid {name} radius string {radius}")
+        sys.exit(1)
+
+    return c5, c10, c20
+
+def parse_port(port):
+    """Parse --offtarget_port, a port number or auto"""
+
+    if port == 'auto':
+        return port
+
+    try:
+        return int(port)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid port {port}, should be a '
+                                         'number or auto')
+
+def parse_batch_size(batch_size):
+    """Parse --offtarget_batch_size, None for auto"""
+
+    if batch_size == 'auto':
+        return None
+    try:
+        return int(batch_size)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid batch size {batch_size}, '
+                                         'should be a number or auto')
+
+def quality_filter_parms(settings):
+    """The `filter_parms` of quality filtering, from a dict of the values
+    of the quality filtering options, e.g. vars() of the parsed command
+    line arguments"""
+
+    return {'gc_frequency': (settings['gc_freq_min'], settings['gc_freq_max']),
+            'homopolymer': settings['homopolymer'],
+            'dinucleotide_repeats': settings['dinucleotide_repeats'],
+            'hairpin': {'min_inner': settings['hairpin_min_inner'],
+                        'min_outer': settings['hairpin_min_outer']}}
+
+def parse_sweep(sweep):
+    """Parse --sweep, a quality filtering option and a comma separated
+    list of its values, e.g. homopolymer=4,5,6"""
+
+    name, _, values = sweep.partition('=')
+    if name not in SWEEP_PARAMETERS:
+        raise argparse.ArgumentTypeError(
+            f'invalid sweep {sweep}, should be one of '
+            f'{", ".join(SWEEP_PARAMETERS)}, =, and a list of values')
+    try:
+        return name, [int(value) for value in values.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid sweep {sweep}, values '
+                                         'should be comma separated numbers')
+
+def sweep_settings(args):
+    """Every combination of the values given with --sweep, as a list of
+    dicts of the values of the quality filtering options. Options not
+    swept keep the value they were given."""
+
+    values = {name: [getattr(args, name)] for name in SWEEP_PARAMETERS}
+    values.update(args.sweep)
+
+    return [dict(zip(SWEEP_PARAMETERS, setting))
+            for setting in itertools.product(*values.values())]
+
+def open_features(filename, guides):
+    """`StructureFeatures` of the `GuideSet` `guides`: read from
+    `filename` if it holds theirs, else computed, and saved to
+    `filename` if given"""
+
+    if filename is not None and os.path.exists(filename):
+        try:
+            features = StructureFeatures.load(filename)
+        except (IOError, ValueError, KeyError) as e:
+            log.error(f'Error reading features {filename}: {e}')
+            sys.exit(1)
+        if np.array_equal(features.guides.packed, guides.packed):
+            log.info(f'Read structure features of {len(guides)} guides from '
+                     f'{filename}')
+            return features
+        log.warning(f'{filename} holds the features of other guides, '
+                    'replacing them')
+
+    log.info(f'Computing structure features of {len(guides)} guides')
+    with run_metrics.stage('features', guides_in=len(guides)):
+        features = StructureFeatures.extract(guides)
+
+    if filename is not None:
+        try:
+            features.save(filename)
+        except IOError as e:
+            log.error(f'Error writing features {filename}: {e}')
+            sys.exit(1)
+
+    return features
+
+def sweep_quality(args, guides, line_counts, filtered_guides):
+    """Evaluate quality filtering with every setting of --sweep
+
+    The structure features of the guides are computed once, or read
+    from --features, and each setting is evaluated on them. The number
+    of guides and lines that survive each setting is written to
+    --sweep_report, or logged.
+
+    Parameters
+    ----------
+    args : `argparse.Namespace`
+        parsed command line arguments
+    guides : `GuideSet`
+        all the guides of the input
+    line_counts : `numpy.ndarray`
+        number of lines of the input with each guide
+    filtered_guides : `FilteredGuides`
+        guides the other stages filtered. Those the setting selected
+        with --sweep_select filters are added, with their reasons.
+
+    Returns
+    -------
+    bool
+        True if a setting was selected with --sweep_select
+    """
+
+    features = open_features(args.features, guides)
+    candidates = ~filtered_guides.guides().contains(guides.packed)
+    settings = sweep_settings(args)
+
+    # Features are computed from the packed bases, the guides that aren't
+    # 20 bases of A, C, G, T are checked as strings instead
+    invalid = np.flatnonzero(guides.packed & INVALID_GUIDE)
+    invalid_guides = guides[invalid].strings()
+
+    def poor(filter_parms):
+        poor = features.poor(filter_parms)
+        poor[invalid] = poor_structure_batch(invalid_guides, filter_parms)
+        return poor
+
+    columns = ('setting',) + SWEEP_PARAMETERS + ('guides_kept', 'lines_kept')
+    rows = []
+    with run_metrics.stage('sweep', settings=len(settings),
+                           guides_in=int(candidates.sum())):
+        for i, setting in enumerate(settings):
+            kept = candidates & ~poor(quality_filter_parms(setting))
+            rows.append([i] + list(setting.values()) +
+                        [int(kept.sum()), int(line_counts[kept].sum())])
+
+    if args.sweep_report is not None:
+        with open_output(args.sweep_report, mode='w') as handle:
+            handle.write('\t'.join(columns) + '\n')
+            for row in rows:
+                handle.write('\t'.join(map(str, row)) + '\n')
+    else:
+        for row in rows:
+            log.info('Sweep ' + ', '.join(f'{column} {value}' for column, value
+                                          in zip(columns, row)))
+
+    if args.sweep_select is None:
+        return False
+
+    filter_parms = quality_filter_parms(settings[args.sweep_select])
+    log.info(f'Filtering guides with sweep setting {args.sweep_select}, '
+             f'{filter_parms}')
+
+    # Only the guides it rejects are checked again, for their reasons
+    filter_quality(guides[candidates & poor(filter_parms)],
+                   filtered_guides, filter_parms, jobs=args.jobs)
+
+    return True
+
+def write_filtered_text(input_filename, header, lines, keep, output_handle):
+    """Write the header line and the lines of a text sites-to-reads file
+    where `keep` is True, copying the file's bytes directly
+
+    Parameters
+    ----------
+    input_filename : str
+        the text sites-to-reads file
+    header : str
+        its header line, written out unchanged
+    lines : `TextLines`
+        index of the file's lines
+    keep : `numpy.ndarray`
+        boolean array, True for the lines to write
+    output_handle : file
+        binary file the lines are written to
+
+    Returns
+    -------
+    int
+        number of bytes written
+    """
+
+    # Write out first line always
+    output_handle.write(header.encode('utf-8'))
+
+    starts, ends = lines.kept_ranges(keep)
+    with open_input(input_filename, 'rb') as input_handle:
+        return len(header) + copy_ranges(input_handle, output_handle,
+                                         starts, ends)
+
+def write_filtered_explanation(output_handle, filtered_guides):
+    """Write rows of the --filtered_explanation CSV
+
+    Parameters
+    ----------
+    output_handle : file
+        handle the CSV is being written to
+    filtered_guides : `FilteredGuides` or dict
+        filtered guides, or dict keyed on them, with the reason(s) each
+        guide was filtered
+    """
+
+    for guide, reasons in filtered_guides.items():
+        output_handle.write('{}, {}\n'.format(guide, reasons))
+
+def filter_stream_stage(input_handle, output_handle, explanation_handle,
+                        reject, chunk_size):
+    """Run one filtering stage over a sites-to-reads file, a chunk at a time
+
+    Lines are read `chunk_size` at a time, so memory use is bounded by
+    the chunk size and not by the size of the input.
+
+    Parameters
+    ----------
+    input_handle : file
+        sites-to-reads lines to filter, positioned after the header line
+    output_handle : file
+        lines whose guides pass this stage are written here
+    explanation_handle : file
+        rows for rejected guides are written here, may be None
+    reject : callable
+        called with a list of unique guides, returns a dict keyed on
+        the rejected guides with the reason they were rejected
+    chunk_size : int
+        number of lines to process at once
+
+    Returns
+    -------
+    tuple
+        (number of lines read, number of lines written)
+    """
+
+    num_in = 0
+    num_out = 0
+
+    while True:
+        lines = list(itertools.islice(input_handle, chunk_size))
+        if len(lines) == 0:
+            break
+
+        rejected = reject(list(dict.fromkeys(line[0:20] for line in lines)))
+
+        for line in lines:
+            if line[0:20] not in rejected:
+                output_handle.write(line)
+                num_out += 1
+
+        num_in += len(lines)
+
+        if explanation_handle is not None:
+            write_filtered_explanation(explanation_handle, rejected)
+
+    return num_in, num_out
+
+def stream_filter(input_handle, header, args, filter_parms,
+                  verdict_cache=None):
+    """Filter a sites-to-reads file with memory bounded by --stream_chunk_size
+
+    Each stage (ontarget, offtarget, quality, or as ordered with
+    --stage_order) makes one chunked pass over the lines that survived
+    the previous stage, spooling its survivors to a temporary file. Only
+    one filtering backend runs at a time, exactly as in the default
+    mode. The final stage writes straight to stdout or --output.
+
+    Parameters
+    ----------
+    input_handle : file
+        the input sites-to-reads file, positioned after the header line
+    header : str
+        header line of the input, written out unchanged
+    args : `argparse.Namespace`
+        parsed command line arguments
+    filter_parms : dict
+        parameters controlling poor structure filtering
+    verdict_cache : `VerdictCache`
+        if given, cache of verdicts to reuse and update
+    """
+
+    radii = {'ontarget': parse_radius(args.ontarget_radius, 'ontarget'),
+             'offtarget': parse_radius(args.offtarget_radius, 'offtarget')}
+
+    def ontarget_reject(guides):
+        ontargets = backend.search(guides)
+        return {guide: 'not ontarget in {}'.format(args.ontarget)
+                for guide in guides if guide not in ontargets}
+
+    def offtarget_reject(guides):
+        offtargets = backend.search(guides)
+        return {guide: 'offtarget against {}'.format(args.offtarget)
+                for guide in offtargets}
+
+    def quality_reject(guides):
+        rejected = {}
+        filter_sites_poor_structure(guides, rejected, filter_parms,
+                                    jobs=args.jobs,
+                                    verdict_cache=verdict_cache)
+        return rejected
+
+    # (description, sites file needing a backend, rejection function)
+    stages = []
+    if args.ontarget is not None:
+        stages.append(('ontarget', args.ontarget, ontarget_reject))
+    if args.offtarget is not None:
+        stages.append(('offtarget', args.offtarget, offtarget_reject))
+    stages.append(('quality', None, quality_reject))
+
+    if args.stage_order != 'fixed':
+        stages.sort(key=lambda stage: args.stage_order.index(stage[0]))
+
+    with contextlib.ExitStack() as outputs:
+        explanation_handle = None
+        if args.filtered_explanation is not None:
+            explanation_handle = outputs.enter_context(
+                open_output(args.filtered_explanation, mode='w'))
+            explanation_handle.write('candidate guide, why it was filtered out\n')
+
+        output = outputs.enter_context(
+            open_output(args.output, args.output_compression, mode='w'))
+
+        stage_input = input_handle
+
+        for i, (description, sites_filename, reject) in enumerate(stages):
+            if i == len(stages) - 1:
+                stage_output = output
+                stage_output.write(header)
+            else:
+                stage_output = tempfile.TemporaryFile('w+')
+
+            backend = None
+            if sites_filename is not None:
+                with run_metrics.stage(description + '_startup'):
+                    backend = start_sites_backend(
+                        args, sites_filename, radii[description], description,
+                        endpoint=getattr(args, description + '_endpoint'),
+                        verdict_cache=verdict_cache)
+
+            log.info(f'Streaming guides through {description} filtering')
+
+            stage_name = description if backend is None else description + '_queries'
+            with run_metrics.stage(stage_name) as stage, \
+                    profiled(args.profile_quality if backend is None else None):
+                num_in, num_out = filter_stream_stage(stage_input, stage_output,
+                                                      explanation_handle, reject,
+                                                      args.stream_chunk_size)
+                stage.update({'lines_in': num_in, 'lines_out': num_out})
+
+            log.info(f'{description} filtering kept {num_out} out of {num_in} '
+                     'lines')
+
+            if backend is not None:
+                log.info(f'Shutting down {description} filtering backend')
+                backend.close()
+
+            stage_input.close()
+
+            if stage_output is not output:
+                stage_output.seek(0)
+                stage_input = stage_output
+
+def build_parser():
+    """The command line parser of dashit_filter"""
 
-def main():
     parser = argparse.ArgumentParser(description='Filter guides in a '
                                      'sites-to-reads file based on offtargets '
-                                     'and quality')
+                                     'and quality. Run dashit_filter serve '
+                                     '--help to serve on/offtarget indexes '
+                                     'to many runs, and dashit_filter '
+                                     'convert --help to convert '
+                                     'sites-to-reads files to binary.')
 
     parser.add_argument('input', type=str, help='input sites-to-reads file to '
-                        'filter. Generated by crispr_sites -r')
+                        'filter. Generated by crispr_sites -r, possibly gzip '
+                        'or zstd compressed, or converted to binary by '
+                        'dashit_filter convert, in which case the filtered '
+                        'file is written in binary too.')
+
+    parser.add_argument('--output', type=str,
+                        help='write the filtered sites-to-reads file here '
+                        'instead of to stdout. Compressed if it ends in .gz '
+                        'or .zst.')
+
+    parser.add_argument('--output_compression', choices=COMPRESSIONS,
+                        help='compress the filtered sites-to-reads file, '
+                        'e.g. when writing to stdout')
+
+    parser.add_argument('--keep_mask', type=str,
+                        help='instead of writing the filtered sites-to-reads '
+                        'file to stdout, write a bitmap of which of its lines '
+                        'are kept to this file. dashit_filter convert can '
+                        'apply it.')
 
     parser.add_argument('--filtered_explanation', type=str,
                         help='output file listing which guides were '
-                        'disqualified and why. CSV format.')
+                        'disqualified and why. CSV format, compressed if it '
+                        'ends in .gz or .zst.')
+
+    parser.add_argument('--pipelined', action='store_true',
+                        help='start the ontarget and offtarget filtering '
+                        'backends at the same time, on separate ports, and '
+                        'filter guides for quality while they start. The '
+                        'output is the same as without this option. The '
+                        'stock offtarget server only listens on port 8080, '
+                        'so two offtarget servers are only launched at the '
+                        'same time with --offtarget_port other than 8080.')
+
+    parser.add_argument('--stage_order', type=parse_stage_order,
+                        default='fixed',
+                        help='order to run the filtering stages in: fixed '
+                        '(ontarget, offtarget, quality), planned to run the '
+                        'stages that reject guides most cheaply first, '
+                        'timing the quality filter on a sample of guides, '
+                        'or a comma separated list such as '
+                        'quality,ontarget,offtarget. Each stage only filters '
+                        'the guides that passed the stages before, so the '
+                        'same lines are kept whatever the order, but a guide '
+                        'rejected by several stages is listed in '
+                        '--filtered_explanation with the reasons of the first '
+                        'one, so with an order other than fixed the reason '
+                        'given for a guide may differ from that of the fixed '
+                        'order.')
+
+    parser.add_argument('--plan_metrics', type=str,
+                        help='--metrics_out report of an earlier run over the '
+                        'same on/offtarget sites and radii. With '
+                        '--stage_order planned, the on/offtarget stages are '
+                        'ordered on the time per guide and share of guides '
+                        'rejected it measured, rather than on rough '
+                        'estimates from their radius.')
+
+    parser.add_argument('--stream', action='store_true',
+                        help='filter the input in chunks of '
+                        '--stream_chunk_size lines so that memory use does '
+                        'not grow with the size of the input. A guide that '
+                        'appears in several chunks may be listed more than '
+                        'once in --filtered_explanation.')
+
+    parser.add_argument('--stream_chunk_size', type=int, default=500000,
+                        help='number of lines processed at once with '
+                        '--stream')
+
+    parser.add_argument('--metrics_out', type=str,
+                        help='write a JSON report of the run to this file: '
+                        'wall time, CPU time, peak RSS and guide and byte '
+                        'counts of each stage, and latencies of the batches '
+                        'of guides sent to on/offtarget servers')
+
+    parser.add_argument('--profile_quality', type=str,
+                        help='profile quality filtering with cProfile and '
+                        'save the statistics to this file, for pstats. '
+                        'With --jobs, work done in worker processes is not '
+                        'profiled.')
+
+    parser.add_argument('--verdict_cache', type=str,
+                        help='SQLite database remembering whether each guide '
+                        'passed each filtering stage, keyed by the on/'
+                        'offtarget file contents, radius and quality '
+                        'parameters. Reruns only filter guides not seen '
+                        'before, and skip starting on/offtarget backends if '
+                        'there are none.')
+
+    parser.add_argument('--checkpoint_dir', type=str,
+                        help='directory in which to checkpoint the run: the '
+                        'verdicts of each filtering stage and each batch of '
+                        'guides answered by the on/offtarget server. Rerun '
+                        'the same command to resume a run that was killed '
+                        'where it stopped.')
 
     offtarget_group = parser.add_argument_group('offtarget filtering',
                                                 'options to filter offtargets')
@@ -330,6 +2212,85 @@ def main():
                                  'allow up to 2 mismatches in the last 10 '
                                  'positions')
 
+    offtarget_group.add_argument('--offtarget_endpoint', type=str,
+                                 help='match offtargets with a server already '
+                                 'running on this endpoint, started with '
+                                 'dashit_filter serve, instead of starting '
+                                 'one: a port, host:port or '
+                                 'unix:/path/to/socket. The server must be '
+                                 'serving the --offtarget file.')
+
+    offtarget_group.add_argument('--backend',
+                                 choices=['auto', 'server', 'embedded', 'exact'],
+                                 default='auto',
+                                 help='how guides are matched against on/'
+                                 'offtarget sites. server launches the '
+                                 'external offtarget server; embedded builds '
+                                 'an index in this process, which avoids the '
+                                 'server startup for small and medium sized '
+                                 'site files; exact looks guides up in a hash '
+                                 'set of the sites in this process, for the '
+                                 '5_10_20 radius only. auto uses exact for '
+                                 'the 5_10_20 radius and server otherwise')
+
+    offtarget_group.add_argument('--exact_max_memory', type=float,
+                                 default=EXACT_MAX_MEMORY,
+                                 help='maximum GB the sites of an on/offtarget '
+                                 'file may take in memory with --backend '
+                                 'exact. Larger files are matched with a '
+                                 'Bloom filter of their sites and a second '
+                                 'pass over the file')
+
+    offtarget_group.add_argument('--index_cache', type=str,
+                                 help='directory in which to cache indexes of '
+                                 'on/offtarget site files, keyed by file '
+                                 'contents and radius, so later runs against '
+                                 'the same files start quickly')
+
+    offtarget_group.add_argument('--index_cache_size', type=float, default=20,
+                                 help='maximum size of --index_cache in GB; '
+                                 'least recently used indexes are removed '
+                                 'beyond this')
+
+    offtarget_group.add_argument('--offtarget_port', type=parse_port,
+                                 default=OFFTARGET_SERVER_PORT,
+                                 help='port to launch the offtarget server '
+                                 'on, or auto to use any free port so that '
+                                 'several dashit_filter runs can share a '
+                                 'host. With --pipelined the ontarget and '
+                                 'offtarget servers use this port and the '
+                                 'next one. The port is passed in the PORT '
+                                 'environment variable: the stock offtarget '
+                                 'server ignores it and always listens on '
+                                 '8080, other ports need an offtarget build '
+                                 'that reads it.')
+
+    offtarget_group.add_argument('--offtarget_startup_timeout', type=float,
+                                 default=OFFTARGET_STARTUP_TIMEOUT,
+                                 help='seconds the offtarget server may take '
+                                 'to build its index and start answering '
+                                 'queries before giving up')
+
+    offtarget_group.add_argument('--offtarget_threads', type=int, default=1,
+                                 help='number of batches of guides to send '
+                                 'to the on/offtarget server at once')
+
+    offtarget_group.add_argument('--offtarget_retries', type=int,
+                                 default=OFFTARGET_RETRIES,
+                                 help='times a batch of guides the '
+                                 'on/offtarget server failed to answer is '
+                                 'retried, waiting twice as long before '
+                                 'each retry. A server launched by '
+                                 'dashit_filter that dies is relaunched and '
+                                 'the search resumes where it stopped.')
+
+    offtarget_group.add_argument('--offtarget_batch_size',
+                                 type=parse_batch_size, default=None,
+                                 help='guides sent to the on/offtarget server '
+                                 'per query, or auto (the default) to size '
+                                 'batches to the time the server takes to '
+                                 'answer them')
+
     ontarget_group = parser.add_argument_group('ontarget filtering',
                                                'options to filter ontargets')
 
@@ -340,6 +2301,11 @@ def main():
     ontarget_group.add_argument('--ontarget_radius', type=str, default='5_10_20',
                                 help='Radius used for matching ontargets. Same '
                                 'format as --offtarget_radius.')
+
+    ontarget_group.add_argument('--ontarget_endpoint', type=str,
+                                help='match ontargets with a server already '
+                                'running on this endpoint. Same format as '
+                                '--offtarget_endpoint.')
     
     filtering_group = parser.add_argument_group('quality filtering',
 						'options for how guides are '
@@ -377,24 +2343,87 @@ def main():
 				 'oooooIIIooooo, where the o are reverse '
 				 'complements and ooooo is the outer hairpin')
 
+    filtering_group.add_argument('--jobs', type=int, default=1,
+                                 help='number of processes to filter guides '
+                                 'for quality with')
+
+    filtering_group.add_argument('--sweep', type=parse_sweep, action='append',
+                                 default=[],
+                                 help='instead of filtering with one setting '
+                                 'of the options above, evaluate every '
+                                 'combination of the values given, e.g. '
+                                 '--sweep homopolymer=4,5,6 --sweep '
+                                 'gc_freq_min=4,5. Guides are filtered for '
+                                 'on/offtargets once and the structure of '
+                                 'each guide is computed once; the number of '
+                                 'guides and lines each setting keeps is '
+                                 'written to --sweep_report.')
+
+    filtering_group.add_argument('--sweep_report', type=str,
+                                 help='TSV file to write the guides and lines '
+                                 'each --sweep setting keeps to, instead of '
+                                 'logging them')
+
+    filtering_group.add_argument('--sweep_select', type=int,
+                                 help='write the filtered sites-to-reads file '
+                                 'and --filtered_explanation of this --sweep '
+                                 'setting, numbered from 0 as in '
+                                 '--sweep_report. Without it, --sweep only '
+                                 'reports.')
+
+    filtering_group.add_argument('--features', type=str,
+                                 help='file of the structure features of the '
+                                 'guides of the input, for --sweep: read if '
+                                 'it holds them, else computed and written '
+                                 'there, so later sweeps over the same input '
+                                 'skip computing them')
+
+    return parser
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        serve_main(sys.argv[2:])
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'convert':
+        convert_main(sys.argv[2:])
+        return
 
-    start_time = datetime.now()
+    args = build_parser().parse_args()
 
-    args = parser.parse_args()
+    filter_parms = quality_filter_parms(vars(args))
 
-    filter_parms = { 'gc_frequency': (args.gc_freq_min, args.gc_freq_max),
-		     'homopolymer': args.homopolymer,
-		     'dinucleotide_repeats': args.dinucleotide_repeats,
-		     'hairpin': { 'min_inner': args.hairpin_min_inner,
-				  'min_outer': args.hairpin_min_outer } }
+    if args.sweep_select is not None and not args.sweep:
+        log.error('--sweep_select selects one of the settings of --sweep')
+        sys.exit(1)
 
+    if args.sweep_select is not None and not (
+            0 <= args.sweep_select < len(sweep_settings(args))):
+        log.error(f'--sweep_select {args.sweep_select} is not one of the '
+                  f'{len(sweep_settings(args))} settings of --sweep')
+        sys.exit(1)
+
+    ontarget_radius = parse_radius(args.ontarget_radius, 'ontarget')
+    offtarget_radius = parse_radius(args.offtarget_radius, 'offtarget')
+
+    sites = None
     try:
-        input_handle = open(args.input, 'r')
-    except IOError:
+        if is_binary(args.input):
+            sites = SitesToReads(args.input)
+            num_reads_line = sites.header_line
+        else:
+            input_handle = open_input(args.input, 'r')
+            num_reads_line = input_handle.readline()
+    except (IOError, ValueError, UnicodeDecodeError):
         log.error('Error opening input file {}'.format(args.input))
         sys.exit(1)
 
-    num_reads_line = input_handle.readline()
+    if sites is None and num_reads_line.startswith(SITES_TO_READS_MAGIC.decode()):
+        log.error(f'{args.input} is a compressed binary sites-to-reads file, '
+                  'decompress it first')
+        sys.exit(1)
 
     # Parse how many reads are represented in the sites-to-reads file
     match = re.search(r': (\d)+', num_reads_line)
@@ -405,122 +2434,137 @@ def main():
 
     num_reads = int(match.group(1))
 
-    log.info('Reading in candidate guides from {}'.format(args.input))
-
-    candidate_guides = []
+    verdict_cache = open_verdict_cache(args)
 
-    filtered_guides = {}
-    
-    for line in tqdm(input_handle.readlines()):
-        candidate_guides.append(line[0:20])
+    if args.stream and sites is not None:
+        log.error('--stream filters text sites-to-reads files, but '
+                  f'{args.input} is binary')
+        sys.exit(1)
 
-    initial_num_candidate_guides = len(candidate_guides)
+    if args.stream and args.checkpoint_dir is not None:
+        log.error('--checkpoint_dir checkpoints whole stages, which --stream '
+                  'does not run')
+        sys.exit(1)
 
-    input_handle.close()
+    if args.stream and args.stage_order == 'planned':
+        log.error('--stage_order planned samples all the guides, which '
+                  '--stream does not read at once, give the order instead')
+        sys.exit(1)
 
-    # Ontarget filtering
-    #
-    # Note: ontarget filtering uses the offtarget server, but with a
-    # list of ontargets
-    if args.ontarget is not None:
-        log.info('Launching ontarget filtering server')
-        ontarget_proc = launch_offtarget_server(args.ontarget)
+    if args.stream and args.sweep:
+        log.error('--sweep evaluates every setting on all the guides at once, '
+                  'which --stream does not read')
+        sys.exit(1)
 
-        if ontarget_proc is None:
-            log.error('Error starting ontarget filtering server')
-            sys.exit(1)
+    if args.stream:
+        stream_filter(input_handle, num_reads_line, args, filter_parms,
+                      verdict_cache=verdict_cache)
+        if args.metrics_out is not None:
+            run_metrics.write(args.metrics_out)
+        return
 
-        log.info('Filtering ontarget guides')
+    log.info('Reading in candidate guides from {}'.format(args.input))
 
-        try:
-            c5, c10, c20 = map(int, args.ontarget_radius.split('_'))
-        except ValueError:
-            log.error(f"Invalid ontarget radius string {args.ontarget_radius}")
-            sys.exit(1)
+    filtered_guides = FilteredGuides()
+
+    # Several lines may share a guide, each guide is only filtered once
+    with run_metrics.stage('input_parse') as stage:
+        if sites is not None:
+            num_lines = len(sites)
+            candidate_guides = sites.unique_guides()
+        else:
+            # Record where each line starts and which guide it has, so
+            # the kept lines can be copied out without reading them again
+            input_handle.close()
+            try:
+                with open_input(args.input, 'rb') as binary_handle, \
+                        tqdm(unit='B', unit_scale=True) as progress:
+                    header_size = len(binary_handle.readline())
+                    lines = TextLines(binary_handle, header_size,
+                                      progress=progress.update)
+            except ValueError as e:
+                log.error(f'Error reading {args.input}: {e}')
+                sys.exit(1)
+            num_lines = len(lines)
+            candidate_guides = lines.guides
+        stage.update({'bytes_read': os.path.getsize(args.input),
+                      'lines_in': num_lines,
+                      'guides_out': len(candidate_guides)})
+
+    log.info(f'Read {len(candidate_guides)} unique guides from {num_lines} '
+             'lines')
 
-        try:
-            ontargets = get_offtargets(
-                candidate_guides, c5, c10, c20)
-        except:
-            log.error(f"Error getting offtargets from offtarget server")
-            raise
+    initial_num_candidate_guides = len(candidate_guides)
 
-        log.info('Updating list of candidate guides')
-        for guide in tqdm(candidate_guides):
-            if guide not in ontargets:
-                filtered_guides[guide] = ('not ontarget in '
-                                          '{}'.format(args.ontarget))
-
-        candidate_guides = list(ontargets)
-                
-        log.info('{} guides were not ontargets '
-                 'in {}'.format(len(filtered_guides), args.ontarget))
-        log.info('Killing ontarget server')
-        kill_offtarget_server(ontarget_proc)
-    else:
-        log.info('ontarget file not specified with --ontarget, will not '
-                 'perform any ontarget filtering')
-        
-    if args.offtarget is not None:
-        log.info('Launching offtarget filtering server, this may take a while')
-        offtarget_proc = launch_offtarget_server(args.offtarget)
+    checkpoint = open_checkpoint(args, filter_parms, ontarget_radius,
+                                 offtarget_radius)
 
-        if offtarget_proc is None:
-            log.error("Error starting offtarget filtering server")
-            sys.exit(1)
-    
-        log.info('Filtering offtarget guides')
+    for stage in ('ontarget', 'offtarget'):
+        if getattr(args, stage) is None:
+            log.info(f'{stage} file not specified with --{stage}, will not '
+                     f'perform any {stage} filtering')
 
-        try:
-            c5, c10, c20 = map(int, args.ontarget_radius.split('_'))
-        except ValueError:
-            log.error(f"Invalid ontarget radius string {args.ontarget_radius}")
-            sys.exit(1)
+    order = stage_order(args, candidate_guides, filter_parms,
+                        {'ontarget': ontarget_radius,
+                         'offtarget': offtarget_radius}, checkpoint)
 
-        try:
-            offtargets = get_offtargets(
-                candidate_guides, c5, c10, c20)
-        except:
-            log.error(f"Error getting offtargets from offtarget server")
-            raise
+    if args.sweep:
+        # Quality filtering is evaluated for every setting of the sweep
+        # once the other stages are done
+        order = [stage for stage in order if stage != 'quality']
 
-        num_filtered_before = len(filtered_guides)
-        
-        for guide in offtargets:
-            filtered_guides[guide] = ('offtarget against '
-                                      '{}'.format(args.offtarget))
-
-        log.info('{} guides matched against offtargets '
-                 'in {}'.format(len(filtered_guides) - num_filtered_before, args.offtarget))
-        log.info('Killing offtarget server')
-        kill_offtarget_server(offtarget_proc)
-            
-        candidate_guides = [g for g in candidate_guides if g not in filtered_guides]            
+    if args.pipelined:
+        pipelined_filter(candidate_guides, filtered_guides, args, filter_parms,
+                         ontarget_radius, offtarget_radius, order,
+                         verdict_cache=verdict_cache, checkpoint=checkpoint)
     else:
-        log.info('offtarget file not specified with --offtarget, will not '
-                 'perform any offtarget filtering')
-
-    # Do quality filtering
-    log.info('Filtering guides for quality')
-
-    filter_sites_poor_structure(candidate_guides, filtered_guides, filter_parms)
+        sequential_filter(candidate_guides, filtered_guides, args, filter_parms,
+                          ontarget_radius, offtarget_radius, order,
+                          verdict_cache=verdict_cache, checkpoint=checkpoint)
+
+    if args.sweep and not sweep_quality(
+            args, candidate_guides,
+            (lines if sites is None else sites).line_counts(),
+            filtered_guides):
+        if checkpoint is not None:
+            checkpoint.close()
+        if args.metrics_out is not None:
+            run_metrics.write(args.metrics_out)
+        return
 
     log.info('Done filtering guides, removed {} out of {} '
              'guides'.format(len(filtered_guides), initial_num_candidate_guides))
 
-    with open(args.input, 'r') as input_handle:
-        # Write out first line always
-        sys.stdout.write(input_handle.readline())
+    if checkpoint is not None:
+        checkpoint.close()
+
+    with run_metrics.stage('output_write') as stage:
+        keep = (lines if sites is None else sites).keep_mask(
+            filtered_guides.guides())
+        bytes_written = 0
+        if args.keep_mask is not None:
+            write_keep_mask(args.keep_mask, keep)
+        else:
+            with open_output(args.output, args.output_compression) as output:
+                if sites is not None:
+                    bytes_written = sites.write_subset(output, keep)
+                else:
+                    bytes_written = write_filtered_text(
+                        args.input, num_reads_line, lines, keep, output)
+        num_lines_out = int(keep.sum())
 
-        for line in input_handle.readlines():
-            if line[0:20] not in filtered_guides:
-                sys.stdout.write(line)
-        
         if args.filtered_explanation is not None:
-            with open(args.filtered_explanation, 'w') as output_handle:
+            with open_output(args.filtered_explanation,
+                             mode='w') as output_handle:
                 output_handle.write('candidate guide, why it was filtered out\n')
-                for guide in filtered_guides:
-                    output_handle.write('{}, {}\n'.format(guide, filtered_guides[guide]))
+                write_filtered_explanation(output_handle, filtered_guides)
+
+        stage.update({'bytes_read': os.path.getsize(args.input),
+                      'bytes_written': bytes_written,
+                      'lines_out': num_lines_out})
+
+    if args.metrics_out is not None:
+        run_metrics.write(args.metrics_out)
 
 if __name__ == '__main__':
     main()
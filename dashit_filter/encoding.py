@@ -0,0 +1,126 @@
+"""
+2-bit encoding of guide k-mers.
+
+Bases are encoded as A=0, C=1, G=2, T=3. With this choice the
+complement of a base is simply ``3 - base`` and, once packed into
+integers, encoded guides sort in the same order as their strings.
+"""
+import numpy as np
+
+GUIDE_LENGTH = 20
+
+# Code used for any character that is not one of A, C, G, T
+INVALID_BASE = 255
+
+_BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for _code, _base in enumerate(b'ACGT'):
+    _BASE_CODES[_base] = _code
+
+
+def encode_bases(raw):
+    """2-bit base codes of a `uint8` array of characters, with
+    `INVALID_BASE` for characters other than A, C, G, T"""
+
+    return _BASE_CODES[raw]
+
+
+def encode_kmers(kmers, k=GUIDE_LENGTH):
+    """Encode k-mers as a matrix of 2-bit base codes
+
+    Parameters
+    ----------
+    kmers : list
+        list of k-mer strings, or of bytes
+    k : int
+        length of every k-mer
+
+    Returns
+    -------
+    `numpy.ndarray`
+        (len(kmers), k) array of `uint8` base codes. Characters other
+        than A, C, G, T are encoded as `INVALID_BASE`.
+    """
+
+    if any(len(kmer) != k for kmer in kmers):
+        raise ValueError(f'all k-mers must have length {k}')
+
+    if len(kmers) > 0 and isinstance(kmers[0], bytes):
+        raw = b''.join(kmers)
+    else:
+        raw = ''.join(kmers).encode('ascii', 'replace')
+
+    return encode_bases(np.frombuffer(raw, dtype=np.uint8)).reshape(len(kmers), k)
+
+
+def pack_codes(codes):
+    """Pack a matrix of 2-bit base codes into integers
+
+    The first base of each k-mer ends up in the most significant bits,
+    so packed k-mers sort in the same order as their strings.
+
+    Parameters
+    ----------
+    codes : `numpy.ndarray`
+        (n, k) array of base codes as returned by `encode_kmers`, with
+        k <= 32. Invalid bases must be replaced before packing.
+
+    Returns
+    -------
+    `numpy.ndarray`
+        length n array of `uint64`
+    """
+
+    k = codes.shape[1]
+    packed = np.zeros(len(codes), dtype=np.uint64)
+
+    for i in range(k):
+        packed |= codes[:, i].astype(np.uint64) << np.uint64(2 * (k - 1 - i))
+
+    return packed
+
+
+def unpack_codes(packed, k=GUIDE_LENGTH):
+    """Unpack packed k-mers into a matrix of 2-bit base codes
+
+    Parameters
+    ----------
+    packed : `numpy.ndarray`
+        array of `uint64` packed k-mers, as returned by `pack_codes`
+    k : int
+        length of every k-mer
+
+    Returns
+    -------
+    `numpy.ndarray`
+        (len(packed), k) array of `uint8` base codes
+    """
+
+    packed = np.asarray(packed, dtype=np.uint64)
+    codes = np.empty((len(packed), k), dtype=np.uint8)
+
+    for i in range(k):
+        codes[:, i] = (packed >> np.uint64(2 * (k - 1 - i))) & np.uint64(3)
+
+    return codes
+
+
+def unpack_kmers(packed, k=GUIDE_LENGTH):
+    """Convert packed k-mers back to strings
+
+    Parameters
+    ----------
+    packed : `numpy.ndarray`
+        array of `uint64` packed k-mers, as returned by `pack_codes`
+    k : int
+        length of every k-mer
+
+    Returns
+    -------
+    list
+        list of k-mer strings
+    """
+
+    codes = unpack_codes(packed, k)
+    raw = np.frombuffer(b'ACGT', dtype=np.uint8)[codes].tobytes().decode('ascii')
+
+    return [raw[i:i + k] for i in range(0, len(raw), k)]
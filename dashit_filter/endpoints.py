@@ -0,0 +1,131 @@
+"""
+Endpoints of on/offtarget servers.
+
+An endpoint is written either as a TCP port (``8081``), a host and port
+(``localhost:8081``), an HTTP URL (``http://localhost:8081``) or a Unix
+domain socket (``unix:/tmp/offtarget.sock``). `requests` has no
+built-in support for Unix domain sockets, so `UnixHTTPAdapter` provides
+it for URLs of the form ``http+unix://<quoted socket path>/...``.
+"""
+import socket
+from urllib.parse import quote, unquote, urlparse
+
+import urllib3
+from requests.adapters import HTTPAdapter
+
+UNIX_PREFIX = 'unix:'
+UNIX_SCHEME = 'http+unix://'
+
+
+def parse_endpoint(endpoint):
+    """Parse an endpoint string
+
+    Parameters
+    ----------
+    endpoint : str
+        endpoint, see the module documentation
+
+    Returns
+    -------
+    tuple
+        ('unix', socket path) or ('tcp', (host, port))
+    """
+
+    if endpoint.startswith(UNIX_PREFIX):
+        return 'unix', endpoint[len(UNIX_PREFIX):]
+
+    if '://' in endpoint:
+        parsed = urlparse(endpoint)
+        return 'tcp', (parsed.hostname or 'localhost', parsed.port or 80)
+
+    host, _, port = endpoint.rpartition(':')
+    try:
+        return 'tcp', (host or 'localhost', int(port))
+    except ValueError:
+        raise ValueError(f'invalid endpoint {endpoint}')
+
+
+def free_port(host='localhost'):
+    """A TCP port on `host` that nothing is listening on
+
+    The port is only free when this returns, so whatever binds it may
+    still lose a race with another process.
+    """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((host, 0))
+        return sock.getsockname()[1]
+
+
+def endpoint_url(endpoint):
+    """Base URL used to send requests to `endpoint`"""
+
+    kind, address = parse_endpoint(endpoint)
+
+    if kind == 'unix':
+        return UNIX_SCHEME + quote(address, safe='')
+
+    return 'http://{}:{}'.format(*address)
+
+
+def _timeout_seconds(timeout):
+    """urllib3 may pass a sentinel rather than a number as a timeout"""
+
+    return timeout if isinstance(timeout, (int, float)) else None
+
+
+class UnixHTTPConnection(urllib3.connection.HTTPConnection):
+    """HTTP connection over a Unix domain socket"""
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__('localhost')
+        self.socket_path = socket_path
+        self.unix_timeout = _timeout_seconds(timeout)
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.unix_timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class UnixHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    """Pool of `UnixHTTPConnection` to one socket"""
+
+    def __init__(self, socket_path, timeout=None, maxsize=1):
+        super().__init__('localhost', timeout=timeout, maxsize=maxsize)
+        self.socket_path = socket_path
+
+    def _new_conn(self):
+        return UnixHTTPConnection(self.socket_path,
+                                  timeout=self.timeout.connect_timeout)
+
+
+class UnixHTTPAdapter(HTTPAdapter):
+    """`requests` transport adapter for ``http+unix://`` URLs"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.unix_pools = {}
+
+    def get_connection(self, url, proxies=None):
+        socket_path = unquote(urlparse(url).netloc)
+
+        if socket_path not in self.unix_pools:
+            self.unix_pools[socket_path] = UnixHTTPConnectionPool(
+                socket_path, maxsize=self._pool_maxsize)
+
+        return self.unix_pools[socket_path]
+
+    def get_connection_with_tls_context(self, request, verify, proxies=None,
+                                        cert=None):
+        return self.get_connection(request.url, proxies)
+
+    def request_url(self, request, proxies):
+        return request.path_url
+
+    def close(self):
+        super().close()
+        for pool in self.unix_pools.values():
+            pool.close()
+        self.unix_pools.clear()
@@ -0,0 +1,215 @@
+"""
+Exact matching of guides against CRISPR sites, for the 5_10_20 radius.
+
+With a radius that allows no mismatches, matching guides against a
+sites file is a set intersection, so no index or server is needed:
+`PackedHashSet` holds the sites, packed 2 bits per base, in an open
+addressing hash table, built as the sites file is read and looked up
+with vectorized probes.
+
+Sites files too large for a hash set in memory are matched by
+`ExactMatcher` in two passes instead: the first adds every site to a
+`BloomFilter` of about 10 bits a site, the second streams the file
+again and confirms which of the guides the Bloom filter lets through
+really are sites. Guides the Bloom filter rejects never match, and
+when none pass the second pass is skipped.
+"""
+import logging
+import os
+
+import numpy as np
+
+from dashit_filter.encoding import GUIDE_LENGTH
+from dashit_filter.guide_set import GuideSet, pack_guides
+from dashit_filter.offtarget_index import read_site_chunks
+
+log = logging.getLogger(__name__)
+
+# Marks empty slots of a `PackedHashSet`, packed 20-mers use 40 bits
+EMPTY = np.uint64(2**64 - 1)
+
+# Odd 64-bit multipliers of the multiplicative hashes
+HASH_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+SECOND_HASH_MULTIPLIER = np.uint64(0xC2B2AE3D27D4EB4F)
+
+# Bytes taken by each site in a `PackedHashSet`, kept at most half full
+HASH_SET_BYTES_PER_SITE = 16
+
+# Bits and hashes per site of a `BloomFilter`, for a false positive
+# rate of about 1%
+BLOOM_BITS_PER_SITE = 10
+BLOOM_NUM_HASHES = 7
+
+
+def estimate_num_sites(filename):
+    """Upper bound on the number of sites in a sites file, from its size"""
+
+    return os.path.getsize(filename) // (GUIDE_LENGTH + 1) + 1
+
+
+class PackedHashSet:
+    """Hash set of packed 20-mers, with linear probing
+
+    Parameters
+    ----------
+    capacity : int
+        number of keys expected. The table grows if more are added.
+    """
+
+    def __init__(self, capacity=0):
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.bits = max(int(2 * capacity).bit_length(), 4)
+        self.slots = np.full(1 << self.bits, EMPTY, dtype=np.uint64)
+        self.mask = np.uint64((1 << self.bits) - 1)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def _slots_of(self, keys):
+        return (keys * HASH_MULTIPLIER) >> np.uint64(64 - self.bits)
+
+    def add(self, keys):
+        """Add the `uint64` packed 20-mers `keys`"""
+
+        keys = np.unique(np.asarray(keys, dtype=np.uint64))
+        if 2 * (self.size + len(keys)) > len(self.slots):
+            old = self.slots[self.slots != EMPTY]
+            self._allocate(self.size + len(keys))
+            self._insert(old)
+        self._insert(keys)
+
+    def _insert(self, keys):
+        slots = self._slots_of(keys)
+        while len(keys) > 0:
+            # Keys probing an empty slot claim it; when several claim
+            # the same slot one wins and the others probe on
+            empty = self.slots[slots] == EMPTY
+            self.slots[slots[empty]] = keys[empty]
+            self.size += int(empty.sum())
+            claimed = self.slots[slots] == keys
+            self.size -= int((empty & ~claimed).sum())
+            keys = keys[~claimed]
+            slots = (slots[~claimed] + np.uint64(1)) & self.mask
+
+    def contains(self, keys):
+        """Boolean array, True for the `uint64` packed 20-mers `keys`
+        in the set"""
+
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = np.zeros(len(keys), dtype=bool)
+
+        probing = np.arange(len(keys))
+        slots = self._slots_of(keys)
+        while len(probing) > 0:
+            values = self.slots[slots]
+            found[probing[values == keys[probing]]] = True
+            more = (values != keys[probing]) & (values != EMPTY)
+            probing = probing[more]
+            slots = (slots[more] + np.uint64(1)) & self.mask
+
+        return found
+
+
+class BloomFilter:
+    """Bloom filter of packed 20-mers
+
+    Parameters
+    ----------
+    capacity : int
+        number of keys expected
+    """
+
+    def __init__(self, capacity):
+        self.num_bits = max(capacity * BLOOM_BITS_PER_SITE, 64)
+        self.bits = np.zeros(-(-self.num_bits // 8), dtype=np.uint8)
+
+    def _positions(self, keys):
+        # Double hashing: the i-th position is h1 + i * h2
+        first = (keys * HASH_MULTIPLIER) >> np.uint64(20)
+        second = ((keys * SECOND_HASH_MULTIPLIER) >> np.uint64(20)) | np.uint64(1)
+        num_bits = np.uint64(self.num_bits)
+        for i in range(BLOOM_NUM_HASHES):
+            yield (first + np.uint64(i) * second) % num_bits
+
+    def add(self, keys):
+        keys = np.asarray(keys, dtype=np.uint64)
+        for positions in self._positions(keys):
+            np.bitwise_or.at(self.bits, positions >> np.uint64(3),
+                             np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+
+    def contains(self, keys):
+        """Boolean array, False for keys certainly not added"""
+
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = np.ones(len(keys), dtype=bool)
+        for positions in self._positions(keys):
+            found &= (self.bits[positions >> np.uint64(3)] >>
+                      (positions & np.uint64(7)).astype(np.uint8)) & 1 == 1
+        return found
+
+
+class ExactMatcher:
+    """Exact matching of guides against the sites of a sites file
+
+    Parameters
+    ----------
+    filename : str
+        sites file, as read by `offtarget_index.read_sites`
+    max_memory : int
+        bytes the hash set of the sites may take. Larger sites files are
+        matched with a Bloom filter and a second pass over the file.
+    """
+
+    def __init__(self, filename, max_memory):
+        self.filename = filename
+
+        capacity = estimate_num_sites(filename)
+        self.sites = None
+        self.bloom = None
+
+        if capacity * HASH_SET_BYTES_PER_SITE <= max_memory:
+            self.sites = PackedHashSet(capacity)
+            for chunk in read_site_chunks(filename):
+                self.sites.add(chunk)
+            log.info(f'Read {len(self.sites)} unique sites from {filename}')
+        else:
+            log.info(f'{filename} is too large to hold in memory, matching '
+                     'it with a Bloom filter and a second pass')
+            self.bloom = BloomFilter(capacity)
+            for chunk in read_site_chunks(filename):
+                self.bloom.add(chunk)
+
+    def search_packed(self, packed):
+        """Boolean array, True for the `uint64` packed guides that are
+        sites"""
+
+        if self.sites is not None:
+            return self.sites.contains(packed)
+
+        candidates = np.unique(packed[self.bloom.contains(packed)])
+        log.info(f'{len(candidates)} of {len(packed)} guides passed the Bloom '
+                 f'filter of {self.filename}')
+        if len(candidates) == 0:
+            return np.zeros(len(packed), dtype=bool)
+
+        candidates = GuideSet(candidates)
+        matched = [np.zeros(0, dtype=np.uint64)]
+        for chunk in read_site_chunks(self.filename):
+            matched.append(chunk[candidates.contains(chunk)])
+
+        return GuideSet(np.unique(np.concatenate(matched))).contains(packed)
+
+    def search(self, guides):
+        """Boolean array, True for the guides, a list of 20-mers, that are
+        sites. Guides with other bases than A, C, G, T never match."""
+
+        valid = np.array([len(guide) == GUIDE_LENGTH and
+                          not guide.strip('ACGT') for guide in guides],
+                         dtype=bool)
+        matched = np.zeros(len(guides), dtype=bool)
+        matched[valid] = self.search_packed(pack_guides(
+            [guide for guide, is_valid in zip(guides, valid) if is_valid]))
+        return matched
@@ -0,0 +1,227 @@
+"""
+Structure features of guides, computed once and compared against many
+quality filtering settings.
+
+For each guide, `StructureFeatures` holds the integers the quality
+filters of `flash.poor_structure` compare against their thresholds:
+
+- ``gc_count``, the number of G and C bases
+- ``longest_run``, the longest homopolymer
+- ``dinucleotide_run``, the longest dinucleotide repeat
+- ``hairpin_outer`` and ``hairpin_perfect_outer``, for each inner gap
+  of 0 to 20 bases, the longest outer arm of a hairpin window with that
+  gap whose arms are complementary at all but at most one position, and
+  at every position
+
+A hairpin window with outer arm ``o`` is checked when ``o >=
+min_outer``, and matches when at least ``max(o - 1, min_outer)`` of its
+positions are complementary. So a guide has a hairpin for some
+--hairpin_min_inner and --hairpin_min_outer exactly when, for some gap
+of at least min_inner, ``hairpin_outer > min_outer`` or
+``hairpin_perfect_outer >= min_outer``, and every setting can be
+checked from the features alone.
+
+Features are saved in a .npz file, one array per feature, along with
+the packed guides they were computed for.
+"""
+import numpy as np
+
+from dashit_filter.encoding import GUIDE_LENGTH, unpack_codes
+from dashit_filter.flash import generate_hairpin_bounds
+from dashit_filter.flash_batch import longest_true_run
+from dashit_filter.guide_set import GuideSet
+
+FEATURES_VERSION = 1
+
+# Guides whose features are computed at once, bounds the size of
+# temporary arrays
+CHUNK_SIZE = 16384
+
+
+class HairpinArms:
+    """Every hairpin window with a non-empty outer arm, for computing the
+    hairpin features
+
+    The pairs of positions (i, j), i < j, an arm compares are ordered on
+    i + j, then on j - i, so the pairs of a window are consecutive: a
+    window of offset ``f``, outer arm ``o`` and inner gap ``g`` compares
+    the pairs with i + j = 2f + 2o + g - 1 and j - i from g + 1 to
+    2o + g - 1. Its number of complementary pairs is then a difference
+    of cumulative sums over the ordered pairs.
+    """
+
+    def __init__(self, k=GUIDE_LENGTH):
+        self.k = k
+
+        columns = {}
+        left, right = [], []
+        for total in range(1, 2 * k - 2):
+            for distance in range(2 - total % 2, k, 2):
+                i, j = (total - distance) // 2, (total + distance) // 2
+                if i >= 0 and j < k:
+                    columns[i, j] = len(left)
+                    left.append(i)
+                    right.append(j)
+        self.left = np.array(left, dtype=np.intp)
+        self.right = np.array(right, dtype=np.intp)
+
+        # Windows sorted on their inner gap, so the windows of each gap
+        # are consecutive
+        windows = sorted(generate_hairpin_bounds((k, 1, 0)),
+                         key=lambda window: window[1])
+        self.starts = np.array([columns[offset + outer - 1,
+                                        offset + outer + inner]
+                                for outer, inner, offset in windows],
+                               dtype=np.intp)
+        self.ends = np.array([columns[offset, offset + 2 * outer + inner - 1] + 1
+                              for outer, inner, offset in windows],
+                             dtype=np.intp)
+        self.outers = np.array([outer for outer, _, _ in windows],
+                               dtype=np.uint8)
+        inners = [inner for _, inner, _ in windows]
+        self.gaps = sorted(set(inners))
+        self.gap_starts = [inners.index(gap) for gap in self.gaps]
+        self.gap_ends = self.gap_starts[1:] + [len(inners)]
+
+    def longest_arms(self, codes):
+        """Hairpin features of a chunk of guides
+
+        Parameters
+        ----------
+        codes : `numpy.ndarray`
+            (n, 20) array of 2-bit base codes
+
+        Returns
+        -------
+        tuple
+            (hairpin_outer, hairpin_perfect_outer), (n, 21) `uint8`
+            arrays of the longest outer arm of each inner gap
+        """
+
+        # Guides along the last axis, so sums over pairs and windows run
+        # over contiguous rows
+        codes = np.ascontiguousarray(codes.T)
+        complementary = ((codes[self.left] + codes[self.right]) == 3).view(np.uint8)
+        totals = np.zeros((len(self.left) + 1, codes.shape[1]), dtype=np.uint8)
+        for i, row in enumerate(complementary):
+            np.add(totals[i], row, out=totals[i + 1])
+        matches = totals[self.ends] - totals[self.starts]
+        outers = self.outers[:, None]
+
+        near = (matches + 1 >= outers) * outers
+        perfect = (matches == outers) * outers
+
+        # Windows with an empty outer arm always match
+        outer = np.zeros((codes.shape[1], self.k + 1), dtype=np.uint8)
+        perfect_outer = np.zeros((codes.shape[1], self.k + 1), dtype=np.uint8)
+
+        for gap, start, end in zip(self.gaps, self.gap_starts, self.gap_ends):
+            outer[:, gap] = near[start:end].max(axis=0)
+            perfect_outer[:, gap] = perfect[start:end].max(axis=0)
+
+        return outer, perfect_outer
+
+
+class StructureFeatures:
+    """Structure features of guides, see the module documentation
+
+    Parameters
+    ----------
+    guides : `GuideSet`
+        the guides
+    gc_count, longest_run, dinucleotide_run : `numpy.ndarray`
+        `uint8` features of each guide
+    hairpin_outer, hairpin_perfect_outer : `numpy.ndarray`
+        (len(guides), 21) `uint8` hairpin features of each guide
+    """
+
+    def __init__(self, guides, gc_count, longest_run, dinucleotide_run,
+                 hairpin_outer, hairpin_perfect_outer):
+        self.guides = guides
+        self.gc_count = gc_count
+        self.longest_run = longest_run
+        self.dinucleotide_run = dinucleotide_run
+        self.hairpin_outer = hairpin_outer
+        self.hairpin_perfect_outer = hairpin_perfect_outer
+        # Longest arms of the gaps of at least each min_inner
+        self._longest_arms = {}
+
+    @classmethod
+    def extract(cls, guides):
+        """Compute the features of the `GuideSet` `guides`"""
+
+        arms = HairpinArms()
+        n = len(guides)
+
+        gc_count = np.zeros(n, dtype=np.uint8)
+        longest_run = np.zeros(n, dtype=np.uint8)
+        dinucleotide_run = np.zeros(n, dtype=np.uint8)
+        hairpin_outer = np.zeros((n, GUIDE_LENGTH + 1), dtype=np.uint8)
+        hairpin_perfect_outer = np.zeros((n, GUIDE_LENGTH + 1), dtype=np.uint8)
+
+        for start in range(0, n, CHUNK_SIZE):
+            chunk = slice(start, start + CHUNK_SIZE)
+            codes = unpack_codes(guides.packed[chunk])
+
+            # As in flash_batch.structure_features
+            gc_count[chunk] = ((codes == 1) | (codes == 2)).sum(axis=1)
+            longest_run[chunk] = longest_true_run(codes[:, 1:] == codes[:, :-1]) + 1
+            dinucleotide_run[chunk] = longest_true_run(
+                codes[:, 2:] == codes[:, :-2]) // 2 + 1
+            hairpin_outer[chunk], hairpin_perfect_outer[chunk] = \
+                arms.longest_arms(codes)
+
+        return cls(guides, gc_count, longest_run, dinucleotide_run,
+                   hairpin_outer, hairpin_perfect_outer)
+
+    @classmethod
+    def load(cls, filename):
+        """Read features saved by `save`
+
+        Raises
+        ------
+        ValueError
+            if `filename` isn't a features file of this version
+        """
+
+        with np.load(filename) as data:
+            if 'version' not in data or int(data['version']) != FEATURES_VERSION:
+                raise ValueError(f'{filename} is not a version '
+                                 f'{FEATURES_VERSION} features file')
+            return cls(GuideSet(data['guides']), data['gc_count'],
+                       data['longest_run'], data['dinucleotide_run'],
+                       data['hairpin_outer'], data['hairpin_perfect_outer'])
+
+    def save(self, filename):
+        # Through a handle, as np.savez adds .npz to file names without it
+        with open(filename, 'wb') as handle:
+            np.savez(handle, version=FEATURES_VERSION,
+                     guides=self.guides.packed, gc_count=self.gc_count,
+                     longest_run=self.longest_run,
+                     dinucleotide_run=self.dinucleotide_run,
+                     hairpin_outer=self.hairpin_outer,
+                     hairpin_perfect_outer=self.hairpin_perfect_outer)
+
+    def _arms_from(self, min_inner):
+        if min_inner not in self._longest_arms:
+            self._longest_arms[min_inner] = (
+                self.hairpin_outer[:, min_inner:].max(axis=1),
+                self.hairpin_perfect_outer[:, min_inner:].max(axis=1))
+        return self._longest_arms[min_inner]
+
+    def poor(self, filter_parms):
+        """Boolean array, True for the guides with poor structure with
+        `filter_parms`, as `flash.poor_structure` decides"""
+
+        gc_freq_min, gc_freq_max = filter_parms['gc_frequency']
+        poor = ((self.gc_count < gc_freq_min) | (self.gc_count > gc_freq_max) |
+                (self.longest_run > filter_parms['homopolymer']) |
+                (self.dinucleotide_run > filter_parms['dinucleotide_repeats']))
+
+        min_inner = max(filter_parms['hairpin']['min_inner'], 0)
+        min_outer = filter_parms['hairpin']['min_outer']
+        if min_inner <= GUIDE_LENGTH:
+            outer, perfect_outer = self._arms_from(min_inner)
+            poor |= (outer > min_outer) | (perfect_outer >= min_outer)
+
+        return poor
@@ -1,7 +1,6 @@
 import itertools
 import time
 import sys
-import requests
 from collections import defaultdict
 
 
@@ -112,6 +111,62 @@ def generate_hairpin_bounds(args):
             yield (outer_left, inner, offset_left)
 
 
+# Translation tables to base 4 digits of each base and of its
+# complement. Other characters, including digits, become 'x' so that
+# parsing them fails.
+_BASE_DIGITS = str.maketrans({**{str(d): 'x' for d in range(10)},
+                              'A': '0', 'C': '1', 'G': '2', 'T': '3'})
+_COMPLEMENT_DIGITS = str.maketrans({**{str(d): 'x' for d in range(10)},
+                                    'A': '3', 'C': '2', 'G': '1', 'T': '0'})
+
+# Low bit of the 2 bits of each of the 20 bases of an encoded 20-mer
+_LOW_BITS = int('01' * 20, 2)
+
+if hasattr(int, 'bit_count'):
+    _popcount = int.bit_count
+else:
+    def _popcount(x):
+        return bin(x).count('1')
+
+
+def hairpin_windows(k, min_outer, min_inner, windows={}):
+    """Precomputed integer tables for `find_hairpin`
+
+    Bases are encoded 2 bits each, first base in the most significant
+    bits. A hairpin window compares kmer[offset + j] with the complement
+    of kmer[k3 - 1 - j], which is position (k - k3 + j) of the reverse
+    complement of the kmer. Shifting the encoded reverse complement by
+    `shift` = k - k3 - offset positions lines those up with the left
+    arm, so one xor compares every pair of the window, and windows with
+    the same shift share the xor.
+
+    Returns
+    -------
+    tuple
+        (shifts, windows), where `shifts` lists the distinct shifts and
+        `windows` lists (index into shifts, mask of the left arm's low
+        bits, maximum mismatches, outer, inner, offset) in the order of
+        `generate_hairpin_bounds`
+    """
+
+    key = (k, min_outer, min_inner)
+    if key not in windows:
+        shifts = []
+        table = []
+        for outer, inner, offset in generate_hairpin_bounds(key):
+            shift = k - (offset + outer + inner + outer) - offset
+            if shift not in shifts:
+                shifts.append(shift)
+            mask = 0
+            for i in range(offset, offset + outer):
+                mask |= 1 << (2 * (k - 1 - i))
+            table.append((shifts.index(shift), mask,
+                          outer - max(outer - 1, min_outer),
+                          outer, inner, offset))
+        windows[key] = (shifts, table)
+    return windows[key]
+
+
 def find_hairpin(kmer, min_inner=3, min_outer=5, hairpin_bounds={}):
     k = 20
     #
@@ -136,8 +191,42 @@ def find_hairpin(kmer, min_inner=3, min_outer=5, hairpin_bounds={}):
     #
     # The total number of l-partitions of k is Binomial(l + k - 1, l - 1).
     # In this case, Binomial(24, 4) = 10626, but only 70 satisfy the hairpin
-    # constraints.  We cache those 70.
+    # constraints.  We cache those 70, see hairpin_windows.
+    #
+    # The kmer and its reverse complement are encoded once as 40-bit
+    # integers, and each window is checked with a mask and a popcount.
+    # Kmers with other characters than A, C, G, T are checked with
+    # strings, by find_hairpin_strings.
     #
+    # int also takes whitespace, underscores and signs, so the kmer is
+    # checked before encoding rather than relying on it to raise
+    if len(kmer) != k or kmer.strip('ACGT'):
+        return find_hairpin_strings(kmer, min_inner, min_outer, hairpin_bounds)
+
+    encoded = int(kmer.translate(_BASE_DIGITS), 4)
+    rc = int(kmer[::-1].translate(_COMPLEMENT_DIGITS), 4)
+
+    shifts, windows = hairpin_windows(k, min_outer, min_inner)
+    mismatches = []
+    for shift in shifts:
+        diff = encoded ^ ((rc << (2 * shift)) if shift >= 0 else (rc >> (-2 * shift)))
+        mismatches.append((diff | (diff >> 1)) & _LOW_BITS)
+
+    for shift_index, mask, max_mismatches, outer, inner, offset in windows:
+        if _popcount(mismatches[shift_index] & mask) <= max_mismatches:
+            k1 = offset + outer
+            k2 = k1 + inner
+            k3 = k2 + outer
+            return (("-" * offset) + kmer[offset:k1] + ("-" * inner) +
+                    kmer[k2:k3] + ((20 - k3) * "-"))
+    return ""
+
+
+def find_hairpin_strings(kmer, min_inner=3, min_outer=5, hairpin_bounds={}):
+    # find_hairpin, comparing characters of the kmer with those of the
+    # reverse complement one by one. Needed for kmers containing
+    # characters other than A, C, G, T.
+    k = 20
     cache_key = (k, min_outer, min_inner)
     if cache_key not in hairpin_bounds:
         hairpin_bounds[cache_key] = list(generate_hairpin_bounds(cache_key))
@@ -0,0 +1,258 @@
+"""
+Vectorized versions of the structure filters in `dashit_filter.flash`.
+
+`poor_structure_batch` evaluates the same GC frequency, homopolymer,
+dinucleotide repeat and hairpin checks as `flash.poor_structure`, but
+on a whole batch of 20-mers at once using 2-bit encoded numpy arrays.
+Results, including the explanation strings, are identical to calling
+`flash.poor_structure` on each guide.
+"""
+import numpy as np
+
+from dashit_filter.encoding import encode_kmers, INVALID_BASE, GUIDE_LENGTH
+from dashit_filter.flash import poor_structure, generate_hairpin_bounds
+
+# Number of guides evaluated at once, bounds the size of temporary arrays
+CHUNK_SIZE = 65536
+
+
+class HairpinTable:
+    """Precomputed hairpin windows for one (min_outer, min_inner) setting
+
+    Every hairpin window compares the bases of its left arm with the
+    reverse complement of its right arm. All (left, right) position
+    pairs of all windows are stored contiguously so the complement
+    checks for a batch of guides are one fancy-indexing operation,
+    followed by a segmented sum per window. Windows with an empty outer
+    arm, only checked with a min_outer of 0, have no pairs and always
+    match.
+    """
+
+    def __init__(self, min_outer, min_inner, k=GUIDE_LENGTH):
+        self.bounds = list(generate_hairpin_bounds((k, min_outer, min_inner)))
+
+        left, right, starts, required = [], [], [], []
+
+        for outer, inner, offset in self.bounds:
+            starts.append(len(left))
+            # complementary_pattern compares left[i] against the
+            # reverse complement of right, i.e. the complement of
+            # right[outer - 1 - i]
+            k3 = offset + outer + inner + outer
+            for i in range(outer):
+                left.append(offset + i)
+                right.append(k3 - 1 - i)
+            required.append(max(outer - 1, min_outer))
+
+        self.left = np.array(left, dtype=np.intp)
+        self.right = np.array(right, dtype=np.intp)
+        self.starts = np.array(starts, dtype=np.intp)
+        self.required = np.array(required, dtype=np.uint8)
+        # Windows with at least one pair, whose pairs run from their
+        # start to the start of the next such window
+        self.paired = np.flatnonzero(
+            np.array([outer for outer, _, _ in self.bounds], dtype=np.intp) > 0)
+
+    def first_hairpin(self, codes):
+        """Index of the first hairpin window matching each guide
+
+        Parameters
+        ----------
+        codes : `numpy.ndarray`
+            (n, 20) array of 2-bit base codes
+
+        Returns
+        -------
+        `numpy.ndarray`
+            index into `self.bounds` of the first matching window for
+            each guide, or -1 if the guide has no hairpin
+        """
+
+        if len(self.bounds) == 0:
+            return np.full(len(codes), -1, dtype=np.intp)
+
+        hits = np.ones((len(codes), len(self.bounds)), dtype=bool)
+        if len(self.paired) > 0:
+            complementary = (codes[:, self.left] + codes[:, self.right]) == 3
+            matches = np.add.reduceat(complementary.view(np.uint8),
+                                      self.starts[self.paired], axis=1)
+            hits[:, self.paired] = matches >= self.required[self.paired]
+
+        return np.where(hits.any(axis=1), hits.argmax(axis=1), -1)
+
+    def explanation(self, kmer, window):
+        """Explanation string for `kmer` matching hairpin `window`, in
+        the same format as `flash.find_hairpin`"""
+
+        outer, inner, offset = self.bounds[window]
+        k1 = offset + outer
+        k2 = k1 + inner
+        k3 = k2 + outer
+
+        return (("-" * offset) + kmer[offset:k1] + ("-" * inner) +
+                kmer[k2:k3] + ((GUIDE_LENGTH - k3) * "-"))
+
+
+_hairpin_tables = {}
+
+
+def hairpin_table(min_outer, min_inner):
+    """Return the cached `HairpinTable` for these hairpin parameters"""
+
+    key = (min_outer, min_inner)
+    if key not in _hairpin_tables:
+        _hairpin_tables[key] = HairpinTable(min_outer, min_inner)
+    return _hairpin_tables[key]
+
+
+def longest_true_run(mask):
+    """Length of the longest run of True values in each row of `mask`"""
+
+    run = np.zeros(len(mask), dtype=np.uint8)
+    longest = np.zeros(len(mask), dtype=np.uint8)
+
+    for column in mask.T:
+        run = (run + 1) * column
+        np.maximum(longest, run, out=longest)
+
+    return longest
+
+
+def structure_features(codes, table):
+    """Compute the structure features used by `poor_structure`
+
+    Parameters
+    ----------
+    codes : `numpy.ndarray`
+        (n, 20) array of 2-bit base codes, all valid
+    table : `HairpinTable`
+        hairpin windows to check
+
+    Returns
+    -------
+    tuple
+        (gc_count, longest_run, dinucleotide_run, hairpin) arrays, where
+        `hairpin` is the index of the first matching hairpin window or -1
+    """
+
+    gc_count = ((codes == 1) | (codes == 2)).sum(axis=1)
+    longest_run = longest_true_run(codes[:, 1:] == codes[:, :-1]) + 1
+    # See flash.longest_dinucleotide_run: a run of z positions where
+    # kmer[n] == kmer[n-2] gives a dinucleotide run of 1 + z // 2
+    dinucleotide_run = longest_true_run(codes[:, 2:] == codes[:, :-2]) // 2 + 1
+    hairpin = table.first_hairpin(codes)
+
+    return gc_count, longest_run, dinucleotide_run, hairpin
+
+
+def poor_structure_batch(kmers, filter_params, need_explanation=False):
+    """Filter a batch of 20-mer protospacers for poor structure
+
+    Parameters
+    ----------
+    kmers : list
+        list of 20-mers
+    filter_params : dict
+        parameters controlling poor structure filtering, as for
+        `flash.poor_structure`
+    need_explanation : bool
+        if True, return the list of reasons each guide was filtered
+
+    Returns
+    -------
+    `numpy.ndarray` or list
+        boolean array, True where a guide has poor structure. If
+        `need_explanation` is True, instead a list with the reasons
+        list `flash.poor_structure` returns for each guide.
+    """
+
+    kmers = list(kmers)
+
+    gc_freq_min, gc_freq_max = filter_params['gc_frequency']
+    homopolymer = filter_params['homopolymer']
+    dinucleotide_repeats = filter_params['dinucleotide_repeats']
+    table = hairpin_table(filter_params['hairpin']['min_outer'],
+                          filter_params['hairpin']['min_inner'])
+
+    poor = np.zeros(len(kmers), dtype=bool)
+    explanations = [[] for _ in kmers] if need_explanation else None
+
+    for start in range(0, len(kmers), CHUNK_SIZE):
+        chunk = kmers[start:start + CHUNK_SIZE]
+        codes = encode_kmers(chunk)
+        invalid = (codes == INVALID_BASE).any(axis=1)
+
+        gc_count, longest_run, dinucleotide_run, hairpin = structure_features(
+            np.where(invalid[:, None], 0, codes), table)
+
+        bad_gc = (gc_count < gc_freq_min) | (gc_count > gc_freq_max)
+        bad_homopolymer = longest_run > homopolymer
+        bad_dinucleotide = dinucleotide_run > dinucleotide_repeats
+        has_hairpin = hairpin >= 0
+
+        chunk_poor = bad_gc | bad_homopolymer | bad_dinucleotide | has_hairpin
+        chunk_poor[invalid] = False
+
+        poor[start:start + len(chunk)] = chunk_poor
+
+        if need_explanation:
+            rows = np.flatnonzero(chunk_poor)
+            for i, gc, run, dinucleotide, window in zip(
+                    rows.tolist(), bad_gc[rows].tolist(),
+                    bad_homopolymer[rows].tolist(),
+                    bad_dinucleotide[rows].tolist(), hairpin[rows].tolist()):
+                reasons = explanations[start + i]
+                if gc:
+                    reasons.append('gc_frequency')
+                if run:
+                    reasons.append(f'homopolymer>{homopolymer}')
+                if dinucleotide:
+                    reasons.append(f'dinucleotide_repeats>{dinucleotide_repeats}')
+                if window >= 0:
+                    reasons.append('hairpin:' +
+                                   table.explanation(chunk[i], window))
+
+        # Guides with characters outside ACGT can't be 2-bit encoded,
+        # fall back to the scalar filter for them
+        for i in np.flatnonzero(invalid):
+            if need_explanation:
+                explanations[start + i] = poor_structure(
+                    chunk[i], filter_params, need_explanation=True)
+                poor[start + i] = len(explanations[start + i]) > 0
+            else:
+                poor[start + i] = poor_structure(chunk[i], filter_params)
+
+    if need_explanation:
+        return explanations
+
+    return poor
+
+
+def poor_structure_packed(packed_kmers, filter_params):
+    """Run `poor_structure_batch` on guides packed into one string
+
+    Sending guides to worker processes as a single string, rather than
+    a list of strings, keeps the cost of pickling them small.
+
+    Parameters
+    ----------
+    packed_kmers : str
+        concatenated 20-mers
+    filter_params : dict
+        parameters controlling poor structure filtering
+
+    Returns
+    -------
+    list
+        (index, reasons) for each guide with poor structure, where
+        index is the guide's position in `packed_kmers`
+    """
+
+    kmers = [packed_kmers[i:i + GUIDE_LENGTH]
+             for i in range(0, len(packed_kmers), GUIDE_LENGTH)]
+
+    explanations = poor_structure_batch(kmers, filter_params,
+                                        need_explanation=True)
+
+    return [(i, reasons) for i, reasons in enumerate(explanations)
+            if len(reasons) > 0]
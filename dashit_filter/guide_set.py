@@ -0,0 +1,306 @@
+"""
+Compact in-memory sets of guides.
+
+Guides are held 2 bits per base in `uint64` arrays, as packed by
+`dashit_filter.encoding`, instead of as Python strings: 8 bytes a guide
+instead of about 70, and a few more for a sorted copy used for
+membership tests. A `GuideSet` keeps its guides in the order they were
+given, so filtering stages report guides in the same order as the
+sites-to-reads file. `FilteredGuides` pairs filtered guides with small
+integer codes into a table of the reasons they were filtered, since
+only a few distinct reasons are given.
+
+Guides that aren't 20 bases of A, C, G, T, as a sites-to-reads file may
+have, can't be packed. A set keeps them as strings in a short side list,
+`invalid_guides`, and in their place in its order the index into that
+list, flagged with `INVALID_GUIDE`. They are handed to backends and the
+quality filter as strings like the others, so they are kept or filtered
+as any guide is. Sets compared with one another must share the list, as
+the sets selected from one set do.
+
+Guides are only converted to strings a chunk at a time, where they are
+handed to on/offtarget backends and the quality filter or written out.
+"""
+import numpy as np
+
+from dashit_filter.encoding import (GUIDE_LENGTH, INVALID_BASE, encode_kmers,
+                                    pack_codes, unpack_kmers)
+
+# Guides converted between strings and packed integers at once
+CHUNK_SIZE = 1000000
+
+# Flags the packed value of a guide that isn't 20 bases of A, C, G, T,
+# whose other bits index the list of such guides. Packed guides only
+# use the low 40 bits.
+INVALID_GUIDE = np.uint64(1 << 63)
+
+
+def pack_guides(guides):
+    """Pack a list of 20-mers, as strings or bytes, into a `uint64` array
+
+    Raises
+    ------
+    ValueError
+        if a guide isn't 20 bases of A, C, G, T
+    """
+
+    packed = np.zeros(len(guides), dtype=np.uint64)
+    for start in range(0, len(guides), CHUNK_SIZE):
+        codes = encode_kmers(guides[start:start + CHUNK_SIZE])
+        if (codes == INVALID_BASE).any():
+            raise ValueError('guides with bases other than A, C, G, T are '
+                             'not supported')
+        packed[start:start + len(codes)] = pack_codes(codes)
+    return packed
+
+
+class GuideSet:
+    """Distinct guides, packed, in a fixed order
+
+    Parameters
+    ----------
+    packed : `numpy.ndarray`
+        `uint64` packed guides, with no duplicates
+    invalid_guides : list
+        the guides that aren't 20 bases of A, C, G, T, as strings,
+        indexed by the packed values flagged with `INVALID_GUIDE`
+    """
+
+    def __init__(self, packed=(), invalid_guides=None):
+        self.packed = np.asarray(packed, dtype=np.uint64)
+        self.invalid_guides = [] if invalid_guides is None else invalid_guides
+        self._sorted = None
+
+    @classmethod
+    def from_strings(cls, guides):
+        """`GuideSet` of a list of distinct guides, as strings or bytes"""
+
+        lengths = np.fromiter(map(len, guides), dtype=np.int64,
+                              count=len(guides))
+        invalid = lengths != GUIDE_LENGTH
+        packed = np.zeros(len(guides), dtype=np.uint64)
+
+        # Only guides of 20 characters can be encoded
+        full_length = np.flatnonzero(~invalid)
+        kmers = (guides if len(full_length) == len(guides)
+                 else [guides[i] for i in full_length.tolist()])
+        for start in range(0, len(kmers), CHUNK_SIZE):
+            codes = encode_kmers(kmers[start:start + CHUNK_SIZE])
+            chunk = full_length[start:start + len(codes)]
+            chunk_invalid = (codes == INVALID_BASE).any(axis=1)
+            codes[chunk_invalid] = 0
+            packed[chunk] = pack_codes(codes)
+            invalid[chunk] = chunk_invalid
+
+        invalid_guides = []
+        for i in np.flatnonzero(invalid).tolist():
+            guide = guides[i]
+            invalid_guides.append(guide.decode('ascii', 'replace')
+                                  if isinstance(guide, bytes) else guide)
+        packed[invalid] = INVALID_GUIDE | np.arange(len(invalid_guides),
+                                                    dtype=np.uint64)
+        return cls(packed, invalid_guides)
+
+    def __len__(self):
+        return len(self.packed)
+
+    def __getitem__(self, index):
+        """The guides selected by a slice, boolean mask or index array,
+        as a `GuideSet`"""
+
+        return GuideSet(self.packed[index], self.invalid_guides)
+
+    def __iter__(self):
+        for start in range(0, len(self), CHUNK_SIZE):
+            yield from self.strings(start, start + CHUNK_SIZE)
+
+    def strings(self, start=0, end=None):
+        """The guides from `start` to `end` as a list of strings"""
+
+        packed = self.packed[start:end]
+        guides = unpack_kmers(packed)
+        for i in np.flatnonzero(packed & INVALID_GUIDE).tolist():
+            guides[i] = self.invalid_guides[int(packed[i] & ~INVALID_GUIDE)]
+        return guides
+
+    def contains(self, packed):
+        """Boolean array, True for the `uint64` packed guides in this set"""
+
+        packed = np.asarray(packed, dtype=np.uint64)
+        if len(self) == 0:
+            return np.zeros(len(packed), dtype=bool)
+
+        if self._sorted is None:
+            self._sorted = np.sort(self.packed)
+
+        positions = np.searchsorted(self._sorted, packed)
+        positions[positions == len(self._sorted)] = 0
+        return self._sorted[positions] == packed
+
+    def intersection(self, other):
+        """The guides also in the `GuideSet` `other`, in this set's order"""
+
+        return self[other.contains(self.packed)]
+
+    def difference(self, other):
+        """The guides not in the `GuideSet` `other`, in this set's order"""
+
+        return self[~other.contains(self.packed)]
+
+
+class FilteredGuides:
+    """Guides filtered out, in the order they were filtered, each with
+    the reason it was filtered
+
+    Reasons are strings, or lists of strings for guides with poor
+    structure, stored once each in `reasons` and referred to by index.
+    Guides that aren't 20 bases of A, C, G, T index `invalid_guides`, as
+    in a `GuideSet`.
+    """
+
+    def __init__(self):
+        self.reasons = []
+        self.invalid_guides = []
+        self._reason_codes = {}
+        self._packed = [np.zeros(0, dtype=np.uint64)]
+        self._codes = [np.zeros(0, dtype=np.uint32)]
+
+    @classmethod
+    def from_arrays(cls, packed, codes, reasons, invalid_guides=None):
+        """`FilteredGuides` of `uint64` packed guides, each filtered for
+        the reason of index `codes` in the list `reasons`, as returned
+        by `arrays`, `reasons` and `invalid_guides`"""
+
+        filtered = cls()
+        for reason in reasons:
+            filtered.reason_code(reason)
+        if invalid_guides is not None:
+            filtered.invalid_guides = invalid_guides
+        filtered._packed = [np.asarray(packed, dtype=np.uint64)]
+        filtered._codes = [np.asarray(codes, dtype=np.uint32)]
+        return filtered
+
+    def __len__(self):
+        return sum(len(packed) for packed in self._packed)
+
+    def reason_code(self, reason):
+        """The code of `reason`, added to `reasons` if it's new"""
+
+        key = tuple(reason) if isinstance(reason, list) else reason
+        code = self._reason_codes.get(key)
+        if code is None:
+            code = self._reason_codes[key] = len(self.reasons)
+            self.reasons.append(reason)
+        return code
+
+    def _own_packed(self, packed, invalid_guides):
+        """`packed` guides of a set listing its invalid guides in
+        `invalid_guides`, with those indexing `invalid_guides` of this
+        one instead"""
+
+        if invalid_guides is self.invalid_guides:
+            return packed
+        flagged = np.flatnonzero(packed & INVALID_GUIDE)
+        if len(flagged) == 0 or invalid_guides == self.invalid_guides:
+            return packed
+        if len(self.invalid_guides) == 0:
+            self.invalid_guides = invalid_guides
+            return packed
+
+        self.invalid_guides = list(self.invalid_guides)
+        indexes = {guide: i for i, guide in enumerate(self.invalid_guides)}
+        packed = packed.copy()
+        for i in flagged.tolist():
+            guide = invalid_guides[int(packed[i] & ~INVALID_GUIDE)]
+            if guide not in indexes:
+                indexes[guide] = len(self.invalid_guides)
+                self.invalid_guides.append(guide)
+            packed[i] = INVALID_GUIDE | np.uint64(indexes[guide])
+        return packed
+
+    def _consolidate(self):
+        if len(self._packed) > 1:
+            self._packed = [np.concatenate(self._packed)]
+            self._codes = [np.concatenate(self._codes)]
+        return self._packed[0], self._codes[0]
+
+    def add(self, guides, reasons):
+        """Add the guides of the `GuideSet` `guides`, filtered for
+        `reasons`: one reason for all of them, or a list with the
+        reason of each"""
+
+        if isinstance(reasons, str):
+            codes = np.full(len(guides), self.reason_code(reasons),
+                            dtype=np.uint32)
+        else:
+            codes = np.fromiter(map(self.reason_code, reasons),
+                                dtype=np.uint32, count=len(guides))
+        self._packed.append(self._own_packed(guides.packed,
+                                             guides.invalid_guides))
+        self._codes.append(codes)
+
+    def update(self, filtered):
+        """Add the guides of another `FilteredGuides`, or of a dict keyed
+        on guides with the reason they were filtered as value"""
+
+        if isinstance(filtered, dict):
+            self.add(GuideSet.from_strings(list(filtered)),
+                     list(filtered.values()))
+            return
+
+        packed, codes = filtered._consolidate()
+        recode = np.array([self.reason_code(reason)
+                           for reason in filtered.reasons], dtype=np.uint32)
+        self._packed.append(self._own_packed(packed, filtered.invalid_guides))
+        self._codes.append(recode[codes] if len(recode) > 0 else codes)
+
+    def arrays(self):
+        """(packed, codes) `numpy.ndarray` of the filtered guides and the
+        indexes of their reasons in `reasons`"""
+
+        return self._consolidate()
+
+    def guides(self):
+        """The filtered guides, as a `GuideSet`"""
+
+        return GuideSet(self._consolidate()[0], self.invalid_guides)
+
+    def subset(self, guides):
+        """The filtered guides also in the `GuideSet` `guides`, as a
+        `FilteredGuides`"""
+
+        packed, codes = self._consolidate()
+        selected = guides.contains(packed)
+
+        subset = FilteredGuides()
+        subset.reasons = self.reasons
+        subset._reason_codes = self._reason_codes
+        subset.invalid_guides = self.invalid_guides
+        subset._packed = [packed[selected]]
+        subset._codes = [codes[selected]]
+        return subset
+
+    def since(self, start):
+        """The guides filtered from the `start`-th one on, as a
+        `FilteredGuides`"""
+
+        packed, codes = self._consolidate()
+
+        since = FilteredGuides()
+        since.reasons = self.reasons
+        since._reason_codes = self._reason_codes
+        since.invalid_guides = self.invalid_guides
+        since._packed = [packed[start:]]
+        since._codes = [codes[start:]]
+        return since
+
+    def items(self, start=0):
+        """(guide, reason) pairs of the filtered guides from the
+        `start`-th one on"""
+
+        packed, codes = self._consolidate()
+        for chunk in range(start, len(packed), CHUNK_SIZE):
+            guides = GuideSet(packed[chunk:chunk + CHUNK_SIZE],
+                              self.invalid_guides).strings()
+            yield from zip(guides, map(self.reasons.__getitem__,
+                                       codes[chunk:chunk + CHUNK_SIZE].tolist()))
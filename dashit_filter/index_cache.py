@@ -0,0 +1,173 @@
+"""
+On-disk cache of on/offtarget site indexes.
+
+Indexes are stored under a cache directory, one subdirectory per entry,
+keyed by the SHA-256 of the sites file contents (and the radius, for
+`OfftargetIndex` entries). Entries are written to a temporary directory
+and renamed into place, so concurrent runs sharing a cache never see a
+partially written entry. Each use of an entry updates its modification
+time, and the least recently used entries are removed once the cache
+grows past its size limit.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+from dashit_filter.encoding import unpack_kmers
+from dashit_filter.offtarget_index import OfftargetIndex, read_sites
+
+log = logging.getLogger(__name__)
+
+# Number of bytes hashed at once
+HASH_BLOCK_SIZE = 1 << 20
+
+# Number of sites written at once when materializing a sites file
+WRITE_CHUNK_SIZE = 1000000
+
+
+def file_digest(filename):
+    """SHA-256 hex digest of the contents of `filename`"""
+
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as handle:
+        for block in iter(lambda: handle.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def directory_size(path):
+    """Total size in bytes of the files under `path`"""
+
+    return sum(f.stat().st_size for f in Path(path).rglob('*') if f.is_file())
+
+
+class IndexCache:
+    """Cache of site indexes, see the module documentation
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory holding the cache, created if it doesn't exist
+    max_bytes : int
+        size the cache is trimmed to after adding an entry
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def sites_digest(self, filename):
+        """Content digest of a sites file
+
+        Hashing a large sites file takes a while, so digests are
+        remembered alongside the file's size and modification time and
+        only recomputed when those change.
+        """
+
+        path = Path(filename).resolve()
+        stat = path.stat()
+        memo_name = hashlib.sha256(str(path).encode('utf-8')).hexdigest()
+        memo_path = self.cache_dir / 'digests' / (memo_name + '.json')
+
+        try:
+            with open(memo_path, 'r') as handle:
+                memo = json.load(handle)
+            if memo['size'] == stat.st_size and memo['mtime'] == stat.st_mtime_ns:
+                return memo['digest']
+        except (IOError, ValueError, KeyError):
+            pass
+
+        log.info(f'Hashing {filename}')
+        digest = file_digest(path)
+
+        memo_path.parent.mkdir(exist_ok=True)
+        with tempfile.NamedTemporaryFile('w', dir=memo_path.parent,
+                                         delete=False) as handle:
+            json.dump({'size': stat.st_size, 'mtime': stat.st_mtime_ns,
+                       'digest': digest}, handle)
+        os.replace(handle.name, memo_path)
+
+        return digest
+
+    def _entry(self, name, build):
+        """Return the directory of cache entry `name`, calling
+        `build(directory)` to create it if it isn't cached"""
+
+        entry = self.cache_dir / name
+
+        if entry.is_dir():
+            log.info(f'Using cached index {entry}')
+            os.utime(entry)
+            return entry
+
+        staging = Path(tempfile.mkdtemp(prefix='.' + name, dir=self.cache_dir))
+        try:
+            build(staging)
+            os.rename(staging, entry)
+        except OSError:
+            # Another run added this entry while we were building it
+            if not entry.is_dir():
+                raise
+        finally:
+            if staging.exists():
+                shutil.rmtree(staging, ignore_errors=True)
+
+        log.info(f'Cached index in {entry}')
+        self.evict(keep=entry)
+
+        return entry
+
+    def load_index(self, sites_filename, radius):
+        """Return an `OfftargetIndex` of `sites_filename`, memory-mapped
+        from the cache, building and caching it first if needed"""
+
+        name = '{}_{}_{}_{}'.format(self.sites_digest(sites_filename), *radius)
+
+        def build(directory):
+            OfftargetIndex.from_file(sites_filename, radius).save(directory)
+
+        return OfftargetIndex.load(self._entry(name, build), radius)
+
+    def sites_file(self, sites_filename):
+        """Return the path of a cached copy of `sites_filename` with
+        duplicate sites removed, for the offtarget server to ingest"""
+
+        name = '{}_sites'.format(self.sites_digest(sites_filename))
+
+        def build(directory):
+            skipped_sites = []
+            sites = read_sites(sites_filename, skipped_sites)
+            with open(directory / 'sites.txt', 'w') as handle:
+                for i in range(0, len(sites), WRITE_CHUNK_SIZE):
+                    for site in unpack_kmers(sites[i:i + WRITE_CHUNK_SIZE]):
+                        handle.write(site + '\n')
+                # Sites that can't be packed are kept verbatim
+                for site in dict.fromkeys(skipped_sites):
+                    handle.write(site + '\n')
+
+        return str(self._entry(name, build) / 'sites.txt')
+
+    def evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in
+        `max_bytes`. The entry `keep` is never removed."""
+
+        entries = [(entry.stat().st_mtime, entry)
+                   for entry in self.cache_dir.iterdir()
+                   if entry.is_dir() and not entry.name.startswith('.')
+                   and entry.name != 'digests']
+        sizes = {entry: directory_size(entry) for _, entry in entries}
+        total = sum(sizes.values())
+
+        for _, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if keep is not None and entry == keep:
+                continue
+            log.info(f'Evicting cached index {entry}')
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= sizes[entry]
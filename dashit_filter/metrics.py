@@ -0,0 +1,214 @@
+"""
+Per-stage metrics of a dashit_filter run.
+
+`RunMetrics` records, for each stage of a run (reading the input,
+starting and querying the on/offtarget backends, quality filtering,
+writing the output), its wall time, the CPU time of the whole process
+while it ran, the peak RSS of the process when it finished, and
+counters set by the stage such as the number of guides in and out and
+bytes read and written. It also collects latency samples, e.g. of each
+batch sent to the offtarget server, summarized as percentiles and a
+histogram with power of two millisecond buckets.
+
+A stage may start within another in the same thread, as when a backend
+behind a verdict cache is only started by the first query needing it:
+its time is then reported under the inner stage only, and left out of
+the outer one.
+
+The report is a JSON document, written with --metrics_out. The
+on/offtarget stages of a report can be read back with
+`query_estimates`, for --stage_order planned to order the stages of a
+later run on what they measured.
+"""
+import contextlib
+import json
+import math
+import os
+import resource
+import sys
+import threading
+import time
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, in bytes"""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def latency_summary(samples):
+    """Summarize latencies in seconds as percentiles and a histogram
+
+    Returns
+    -------
+    dict
+        count, total, min, max and p50/p90/p99 in seconds, and
+        `histogram_ms`, the number of samples at or below each power of
+        two number of milliseconds, keyed on the bucket's upper bound
+    """
+
+    if len(samples) == 0:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(int(math.ceil(p / 100 * len(ordered))) - 1,
+                           len(ordered) - 1)]
+
+    histogram = {}
+    for seconds in ordered:
+        bucket = 2 ** max(math.ceil(math.log2(max(seconds * 1000, 1e-9))), 0)
+        histogram[str(bucket)] = histogram.get(str(bucket), 0) + 1
+
+    return {'count': len(ordered),
+            'total': sum(ordered),
+            'min': ordered[0],
+            'max': ordered[-1],
+            'p50': percentile(50),
+            'p90': percentile(90),
+            'p99': percentile(99),
+            'histogram_ms': histogram}
+
+
+class RunMetrics:
+    """Metrics of the stages of a run, see the module documentation
+
+    Stages may run concurrently in several threads.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = []
+        self.latencies = {}
+        self.lock = threading.Lock()
+        # Records of the stages running in each thread, innermost last
+        self._running = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name, **counters):
+        """Time the stage `name`, run in a with block
+
+        Yields the stage's record, a dict. Counters passed as keyword
+        arguments, or added to the record within the block, are
+        reported with the stage.
+        """
+
+        record = {'stage': name}
+        record.update(counters)
+
+        running = self._running.__dict__.setdefault('stages', [])
+        # Wall and CPU time of the stages nested within this one
+        nested = [0.0, 0.0]
+        running.append(nested)
+
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - wall_start
+            cpu = time.process_time() - cpu_start
+            running.pop()
+            if running:
+                running[-1][0] += wall
+                running[-1][1] += cpu
+
+            record['wall_seconds'] = wall - nested[0]
+            record['cpu_seconds'] = cpu - nested[1]
+            record['peak_rss_bytes'] = peak_rss_bytes()
+            with self.lock:
+                self.stages.append(record)
+
+    def record_latency(self, name, seconds):
+        """Add a latency sample, in seconds, to the samples of `name`"""
+
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+
+    def report(self):
+        """The report, as a JSON serializable dict"""
+
+        with self.lock:
+            return {'started': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                             time.localtime(self.started)),
+                    'wall_seconds': time.time() - self.started,
+                    'cpu_seconds': time.process_time(),
+                    'peak_rss_bytes': peak_rss_bytes(),
+                    'pid': os.getpid(),
+                    'stages': list(self.stages),
+                    'latencies': {name: latency_summary(samples)
+                                  for name, samples in self.latencies.items()}}
+
+    def write(self, filename):
+        """Write the report to `filename` as JSON"""
+
+        with open(filename, 'w') as handle:
+            json.dump(self.report(), handle, indent=2)
+            handle.write('\n')
+
+
+def query_estimates(filename):
+    """Seconds per guide and share of guides rejected of the on/offtarget
+    stages of the run reported in `filename`
+
+    Parameters
+    ----------
+    filename : str
+        JSON report, as written by `RunMetrics.write`
+
+    Returns
+    -------
+    dict
+        (seconds per guide, share rejected) keyed on the stage, for
+        each stage with queries of guides in the report
+
+    Raises
+    ------
+    ValueError
+        if `filename` isn't a report
+    """
+
+    with open(filename) as handle:
+        try:
+            stages = json.load(handle)['stages']
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f'{filename} is not a --metrics_out report')
+
+    totals = {}
+    for record in stages:
+        stage = record.get('stage', '')
+        if not stage.endswith('_queries') or 'guides_out' not in record:
+            continue
+        seconds, guides_in, guides_out = totals.get(stage[:-len('_queries')],
+                                                    (0, 0, 0))
+        totals[stage[:-len('_queries')]] = (
+            seconds + record['wall_seconds'],
+            guides_in + record['guides_in'],
+            guides_out + record['guides_out'])
+
+    return {stage: (seconds / guides_in, 1 - guides_out / guides_in)
+            for stage, (seconds, guides_in, guides_out) in totals.items()
+            if guides_in > 0}
+
+
+@contextlib.contextmanager
+def profiled(filename):
+    """Profile the with block with cProfile, saving the statistics to
+    `filename` for `pstats`. Does nothing if `filename` is None."""
+
+    if filename is None:
+        yield
+        return
+
+    import cProfile
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(filename)
@@ -0,0 +1,452 @@
+"""
+Asynchronous client of offtarget servers.
+
+Guides are sent to the server in batches over a few keep-alive
+HTTP/1.1 connections, with at most `window` batches in flight at once.
+A batch that fails, because the connection dropped, the server answered
+with an error or didn't answer within the timeout, is retried with
+exponential backoff. Batches that completed are recorded in a
+`SearchProgress`, so when a search gives up, e.g. because the server
+died, it can be resumed once the server is back without searching
+those guides again.
+
+Batch sizes adapt to the server: each batch is sized to take about
+`TARGET_LATENCY` seconds at the throughput measured so far, so small
+radii that the server answers quickly get large batches and expensive
+ones get small batches that retry cheaply.
+
+The HTTP client is a minimal one on asyncio streams, so the only
+dependency is the standard library. It speaks to TCP endpoints
+(``http://host:port``) and Unix domain sockets (``http+unix://<quoted
+socket path>``), see `dashit_filter.endpoints`.
+"""
+import asyncio
+import bisect
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlencode, urlparse
+
+from dashit_filter.endpoints import UNIX_SCHEME
+
+log = logging.getLogger(__name__)
+
+# Seconds to wait for the server to answer one batch
+REQUEST_TIMEOUT = 600
+
+# Times a failed batch is retried, and seconds before the first retry,
+# doubled for each retry after that
+RETRIES = 5
+BACKOFF = 0.5
+MAX_BACKOFF = 30
+
+# Sizes of batches of guides, in guides: the first batch, and the range
+# adaptive batch sizes stay within
+INITIAL_BATCH_SIZE = 20000
+MIN_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 500000
+
+# Seconds adaptive batches should take the server to answer
+TARGET_LATENCY = 2.0
+
+# Most guides sent in one GET query, which carries them in its URL
+GET_BATCH_SIZE = 20000
+
+
+class OfftargetSearchError(IOError):
+    """A batch failed after all retries. `progress` holds the batches
+    that completed, so the search can be resumed."""
+
+    def __init__(self, message, progress):
+        super().__init__(message)
+        self.progress = progress
+
+
+def parse_offtargets(content):
+    """The guides answered `true` in the body of an offtarget server
+    response, see `parse_offtarget_server_response`
+
+    Returns
+    -------
+    set
+        set of the guides that matched an offtarget
+    """
+
+    offtargets = set()
+
+    end = content.find(b'true\n')
+    while end != -1:
+        start = content.rfind(b'\n', 0, end) + 1
+        offtargets.add(content[start:start + 20].decode('ascii'))
+        end = content.find(b'true\n', end + 5)
+
+    # The last line may not be terminated by a newline
+    if content.endswith(b'true'):
+        start = content.rfind(b'\n') + 1
+        offtargets.add(content[start:start + 20].decode('ascii'))
+
+    return offtargets
+
+
+class HTTPConnection:
+    """A keep-alive HTTP/1.1 connection, opened when first needed and
+    reopened after the server closes it
+
+    Parameters
+    ----------
+    url : str
+        base URL of the server, http:// or http+unix://
+    """
+
+    def __init__(self, url):
+        if url.startswith(UNIX_SCHEME):
+            self.socket_path = unquote(url[len(UNIX_SCHEME):].split('/')[0])
+            self.host = 'localhost'
+        else:
+            parsed = urlparse(url)
+            self.socket_path = None
+            self.host = parsed.hostname or 'localhost'
+            self.port = parsed.port or 80
+        self.reader = None
+        self.writer = None
+
+    async def _connect(self):
+        if self.socket_path is not None:
+            self.reader, self.writer = await asyncio.open_unix_connection(
+                self.socket_path)
+        else:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+
+    async def request(self, method, path, body=b'',
+                      content_type='application/x-www-form-urlencoded'):
+        """Send a request, returns (status, body)
+
+        Raises
+        ------
+        ConnectionError
+            if the connection drops or the response is malformed
+        """
+
+        if self.writer is None:
+            await self._connect()
+
+        try:
+            head = (f'{method} {path} HTTP/1.1\r\n'
+                    f'Host: {self.host}\r\n'
+                    f'Content-Length: {len(body)}\r\n')
+            if len(body) > 0:
+                head += f'Content-Type: {content_type}\r\n'
+            self.writer.write(head.encode('ascii') + b'\r\n' + body)
+            await self.writer.drain()
+
+            status_line = await self.reader.readline()
+            parts = status_line.split(None, 2)
+            if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+                raise ConnectionError('connection closed by the server'
+                                      if status_line == b''
+                                      else f'bad status line {status_line!r}')
+            status = int(parts[1])
+
+            headers = {}
+            while True:
+                line = await self.reader.readline()
+                if line in (b'\r\n', b'\n'):
+                    break
+                if line == b'':
+                    raise ConnectionError('connection closed in the headers')
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if headers.get('transfer-encoding', '').lower() == 'chunked':
+                content = await self._read_chunked()
+            elif 'content-length' in headers:
+                content = await self.reader.readexactly(
+                    int(headers['content-length']))
+            else:
+                content = await self.reader.read()
+                headers['connection'] = 'close'
+        except (asyncio.IncompleteReadError, ValueError) as e:
+            self.close()
+            raise ConnectionError(f'bad response: {e}')
+        except BaseException:
+            self.close()
+            raise
+
+        if (headers.get('connection', '').lower() == 'close' or
+                status_line.startswith(b'HTTP/1.0')):
+            self.close()
+
+        return status, content
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                # Trailers, if any, end with an empty line
+                while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readexactly(2)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = None
+        self.writer = None
+
+
+class SearchProgress:
+    """Batches of a search that completed
+
+    Batches are ranges [start, end) of indexes into the guides searched,
+    kept sorted, each with the set of its guides that matched.
+
+    Parameters
+    ----------
+    num_guides : int
+        number of guides searched
+    on_add : callable
+        if given, called with the start, end and matched guides of each
+        batch that completes, e.g. to checkpoint it
+    """
+
+    def __init__(self, num_guides, on_add=None):
+        self.num_guides = num_guides
+        self.on_add = on_add
+        self.starts = []
+        self.batches = []
+
+    def add(self, start, end, matched, recorded=False):
+        """Add a completed batch. `recorded` batches, e.g. read back from
+        a checkpoint, aren't passed to `on_add`."""
+
+        i = bisect.bisect(self.starts, start)
+        self.starts.insert(i, start)
+        self.batches.insert(i, (start, end, matched))
+        if self.on_add is not None and not recorded:
+            self.on_add(start, end, matched)
+
+    def num_done(self):
+        return sum(end - start for start, end, _ in self.batches)
+
+    def gaps(self):
+        """The ranges of guides not yet searched"""
+
+        position = 0
+        for start, end, _ in self.batches:
+            if start > position:
+                yield position, start
+            position = max(position, end)
+        if position < self.num_guides:
+            yield position, self.num_guides
+
+
+class OfftargetClient:
+    """Client searching guides on an offtarget server
+
+    Parameters
+    ----------
+    url : str
+        base URL of the server
+    limits : str
+        comma separated radius of match, e.g. 5,10,20
+    window : int
+        most batches in flight at once
+    retries : int
+        times a failed batch is retried before the search gives up
+    batch_size : int
+        guides per batch. If None, batch sizes adapt to the server's
+        latency.
+    use_post : bool
+        send guides in POST bodies. Set to False if the server only
+        answers GET queries, which happens by itself when a POST query
+        fails before any succeeded.
+    on_latency : callable
+        if given, called with the seconds each batch took
+    alive : callable
+        if given, called when a batch fails. If it returns False, the
+        server is known to be gone and the batch isn't retried.
+    """
+
+    def __init__(self, url, limits, window=1, retries=RETRIES,
+                 batch_size=None, use_post=True, on_latency=None,
+                 alive=None):
+        self.url = url
+        self.path = urlparse(url).path.rstrip('/') + '/search'
+        if url.startswith(UNIX_SCHEME):
+            self.path = '/search'
+        self.limits = limits
+        self.window = max(window, 1)
+        self.retries = retries
+        self.adaptive = batch_size is None
+        self.batch_size = INITIAL_BATCH_SIZE if batch_size is None else batch_size
+        self.use_post = use_post
+        # Whether a POST query succeeded, after which failed POST
+        # queries are errors of the server rather than a sign it only
+        # answers GET queries
+        self.post_answered = False
+        self.on_latency = on_latency
+        self.alive = alive
+
+    def _measured(self, size, seconds):
+        """Size later batches to take about TARGET_LATENCY seconds"""
+
+        if self.on_latency is not None:
+            self.on_latency(seconds)
+        # The last batch of a gap may be too small to tell anything
+        if not self.adaptive or size < MIN_BATCH_SIZE:
+            return
+        target = size * TARGET_LATENCY / max(seconds, 1e-3)
+        # Move halfway to the target, so one slow batch doesn't swing
+        # the size too far
+        self.batch_size = int(min(max((self.batch_size + target) / 2,
+                                      MIN_BATCH_SIZE), MAX_BATCH_SIZE))
+
+    async def _query(self, connection, batch):
+        """Send one batch, returns the set of its guides that matched"""
+
+        query = {'targets': ','.join(batch), 'limits': self.limits}
+
+        if self.use_post:
+            status, content = await asyncio.wait_for(
+                connection.request('POST', self.path,
+                                   urlencode(query).encode('ascii')),
+                REQUEST_TIMEOUT)
+            if status == 200 and (len(content) > 0 or len(batch) == 0):
+                self.post_answered = True
+                return parse_offtargets(content)
+            if self.post_answered:
+                raise ConnectionError(f'HTTP {status}')
+            log.warning('offtarget server did not answer a POST query '
+                        f'(HTTP {status}), falling back to GET')
+            self.use_post = False
+
+        # As the GET queries of the original client, with the guides
+        # and limits unquoted
+        matched = set()
+        for start in range(0, max(len(batch), 1), GET_BATCH_SIZE):
+            targets = ','.join(batch[start:start + GET_BATCH_SIZE])
+            status, content = await asyncio.wait_for(
+                connection.request('GET', f'{self.path}?targets={targets}'
+                                   f'&limits={self.limits}'),
+                REQUEST_TIMEOUT)
+            if status != 200:
+                raise ConnectionError(f'HTTP {status}')
+            matched |= parse_offtargets(content)
+        return matched
+
+    async def _query_with_retries(self, connection, batch):
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                matched = await self._query(connection, batch)
+                self._measured(len(batch), time.perf_counter() - start)
+                return matched
+            except (OSError, asyncio.TimeoutError) as e:
+                connection.close()
+                if attempt == self.retries or (self.alive is not None and
+                                               not self.alive()):
+                    raise
+                delay = min(BACKOFF * 2 ** attempt, MAX_BACKOFF)
+                # Jitter, so batches that failed together don't all
+                # retry at the same moment
+                delay *= random.uniform(0.5, 1)
+                log.warning(f'offtarget query of {len(batch)} guides failed '
+                            f'({e or type(e).__name__}), retrying in '
+                            f'{delay:.1f} s')
+                await asyncio.sleep(delay)
+
+    async def _search(self, targets, progress):
+        # Each worker keeps a connection open and takes the next batch
+        # off the gaps left in `progress` until none are left
+        gaps = list(progress.gaps())
+        failures = []
+
+        def next_batch():
+            while gaps:
+                start, end = gaps[0]
+                size = self.batch_size
+                if end - start <= size:
+                    gaps.pop(0)
+                    return start, end
+                gaps[0] = (start + size, end)
+                return start, start + size
+            return None
+
+        async def worker():
+            connection = HTTPConnection(self.url)
+            try:
+                while not failures:
+                    batch = next_batch()
+                    if batch is None:
+                        return
+                    start, end = batch
+                    try:
+                        matched = await self._query_with_retries(
+                            connection, targets[start:end])
+                    except (OSError, asyncio.TimeoutError) as e:
+                        failures.append(e)
+                        return
+                    progress.add(start, end, matched)
+            finally:
+                connection.close()
+
+        await asyncio.gather(*(worker() for _ in range(self.window)))
+
+        if failures:
+            error = failures[0]
+            raise OfftargetSearchError(
+                f'offtarget query failed: {error or type(error).__name__}',
+                progress)
+
+    def search(self, targets, progress=None):
+        """Search `targets`, a list of 20-mers
+
+        Blocks until the search is done, also when called from a
+        coroutine.
+
+        Parameters
+        ----------
+        targets : list
+            20-mers to search
+        progress : `SearchProgress`
+            progress of an earlier search of the same targets that
+            failed, to resume it
+
+        Returns
+        -------
+        dict
+            dict keyed on the targets that matched, in the same order as
+            `targets`, with value True
+
+        Raises
+        ------
+        OfftargetSearchError
+            if a batch failed after all retries
+        """
+
+        if progress is None:
+            progress = SearchProgress(len(targets))
+
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            asyncio.run(self._search(targets, progress))
+        else:
+            # Called from a coroutine, e.g. in Jupyter or an asyncio
+            # pipeline, where asyncio.run can't start another loop: the
+            # search runs on a loop of its own in a thread instead
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(asyncio.run,
+                                self._search(targets, progress)).result()
+
+        offtargets = {}
+        for start, end, matched in progress.batches:
+            if len(matched) > 0:
+                offtargets.update((guide, True) for guide in targets[start:end]
+                                  if guide in matched)
+        return offtargets
@@ -0,0 +1,360 @@
+"""
+In-process on/offtarget matching.
+
+`OfftargetIndex` answers the same queries as the external
+`special_ops_crispr_tools/offtarget` server, without a subprocess or
+HTTP: given a list of candidate guides, which of them match a CRISPR
+site from a sites file within a radius L_M_N, i.e. at least L, M and N
+nucleotides of the first 5, 10 and 20 positions of the guide match the
+site.
+
+Sites are packed 2 bits per base into `uint64` integers. A radius
+allowing up to k mismatches is searched with the pigeonhole principle:
+the 20 positions are split into k + 1 seeds, so any site within the
+radius matches the guide exactly on at least one seed. For every seed
+the sites are sorted by their seed value, candidate sites for a guide
+are found with a binary search and then verified by counting
+mismatches with xor and popcount. A radius allowing 20 mismatches or
+more leaves no position that must match, so it is searched by checking
+every site instead.
+
+This is meant for small and medium sized site files and small radii;
+very large site files are better served by the offtarget server.
+"""
+import itertools
+import logging
+import os
+
+import numpy as np
+
+from dashit_filter.encoding import encode_kmers, pack_codes, INVALID_BASE, GUIDE_LENGTH
+
+log = logging.getLogger(__name__)
+
+# Number of guides searched at once, bounds the size of the candidate arrays
+QUERY_CHUNK_SIZE = 1024
+
+# Number of lines of a sites file encoded at once
+READ_CHUNK_SIZE = 1000000
+
+# Number of sites checked at once against a chunk of guides when every
+# site is checked
+SCAN_CHUNK_SIZE = 1024
+
+if hasattr(np, 'bitwise_count'):
+    popcount = np.bitwise_count
+else:
+    _BYTE_POPCOUNT = np.array([bin(i).count('1') for i in range(256)],
+                              dtype=np.uint8)
+
+    def popcount(values):
+        """Number of set bits in each element of a `uint64` array"""
+        values = np.ascontiguousarray(values, dtype=np.uint64)
+        return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def position_mask(start, end, k=GUIDE_LENGTH):
+    """Mask selecting the low bit of the 2-bit codes of positions
+    [start, end) of a packed k-mer"""
+
+    mask = 0
+    for i in range(start, end):
+        mask |= 1 << (2 * (k - 1 - i))
+    return np.uint64(mask)
+
+
+def seed_bounds(num_seeds, k=GUIDE_LENGTH):
+    """Split positions 0..k into `num_seeds` contiguous, near equal seeds
+
+    Returns
+    -------
+    list
+        list of (start, end) positions of each seed
+    """
+
+    bounds = []
+    start = 0
+    for i in range(num_seeds):
+        end = start + (k - start) // (num_seeds - i)
+        bounds.append((start, end))
+        start = end
+    return bounds
+
+
+def encode_guides(guides):
+    """Pack guides for searching
+
+    Parameters
+    ----------
+    guides : list
+        list of 20-mers
+
+    Returns
+    -------
+    tuple
+        (packed, invalid) `uint64` arrays. `invalid` has the low bit
+        of a position's code set if that position isn't one of A, C,
+        G, T; such positions never match any site.
+    """
+
+    codes = encode_kmers(guides)
+    invalid_codes = codes == INVALID_BASE
+    codes[invalid_codes] = 0
+
+    return pack_codes(codes), pack_codes(invalid_codes.astype(np.uint8))
+
+
+def read_site_chunks(filename, skipped_sites=None):
+    """Read and pack the CRISPR sites in a sites file, a chunk at a time
+
+    Parameters
+    ----------
+    filename : str
+        file with one 20-mer CRISPR site per line, as generated by
+        `special_ops_crispr_tools/crispr_sites`
+    skipped_sites : list
+        if given, sites that can't be packed are appended to this list
+
+    Yields
+    ------
+    `numpy.ndarray`
+        packed sites of the next `READ_CHUNK_SIZE` lines. Sites containing
+        characters other than A, C, G, T are skipped.
+    """
+
+    num_skipped = 0
+
+    with open(filename, 'r') as handle:
+        while True:
+            lines = list(itertools.islice(handle, READ_CHUNK_SIZE))
+            if len(lines) == 0:
+                break
+
+            sites = [line[0:GUIDE_LENGTH] for line in lines if line.strip()]
+            try:
+                codes = encode_kmers(sites)
+            except ValueError:
+                raise ValueError(f'{filename} is not the right format, it '
+                                 'should contain one 20-mer per line')
+
+            valid = (codes != INVALID_BASE).all(axis=1)
+            num_skipped += len(codes) - int(valid.sum())
+
+            if skipped_sites is not None:
+                skipped_sites.extend(sites[i] for i in np.flatnonzero(~valid))
+
+            yield pack_codes(codes[valid])
+
+    if num_skipped > 0:
+        log.warning(f'skipped {num_skipped} sites in {filename} with bases '
+                    'other than A, C, G, T')
+
+
+def read_sites(filename, skipped_sites=None):
+    """Read and pack the CRISPR sites in a sites file
+
+    Parameters
+    ----------
+    filename : str
+        file with one 20-mer CRISPR site per line, as generated by
+        `special_ops_crispr_tools/crispr_sites`
+    skipped_sites : list
+        if given, sites that can't be packed are appended to this list
+
+    Returns
+    -------
+    `numpy.ndarray`
+        sorted array of the unique packed sites. Sites containing
+        characters other than A, C, G, T are skipped.
+    """
+
+    chunks = [np.unique(packed)
+              for packed in read_site_chunks(filename, skipped_sites)]
+
+    if len(chunks) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    return np.unique(np.concatenate(chunks))
+
+class OfftargetIndex:
+    """Index of CRISPR sites for matching guides within a radius
+
+    Parameters
+    ----------
+    sites : `numpy.ndarray`
+        sorted, unique packed sites, as returned by `read_sites`
+    radius : tuple
+        (c5, c10, c20) radius of match, see command line documentation
+    seed_tables : list
+        precomputed (sorted seed values, order) array pairs for each
+        seed, as saved by `save`. Computed from `sites` if not given.
+    """
+
+    def __init__(self, sites, radius, seed_tables=None):
+        self.sites = sites
+        self.radius = tuple(radius)
+
+        c5, c10, c20 = self.radius
+        self.max_mismatches = (5 - c5, 10 - c10, GUIDE_LENGTH - c20)
+        self.region_masks = (position_mask(0, 5), position_mask(0, 10),
+                             position_mask(0, GUIDE_LENGTH))
+
+        # Seeds for the pigeonhole search, as (shift, mask, sorted seed
+        # values, order of sites sorted by seed value). With no
+        # mismatches allowed the sorted sites themselves are the index,
+        # with 20 or more there are too few positions for seeds.
+        self.seeds = []
+
+        num_mismatches = self.max_mismatches[2]
+        if 0 < num_mismatches < GUIDE_LENGTH:
+            bounds = seed_bounds(num_mismatches + 1)
+            for i, (start, end) in enumerate(bounds):
+                shift = np.uint64(2 * (GUIDE_LENGTH - end))
+                mask = np.uint64((1 << (2 * (end - start))) - 1)
+                if seed_tables is None:
+                    keys = (sites >> shift) & mask
+                    order = np.argsort(keys, kind='stable')
+                    if len(sites) < 2**32:
+                        order = order.astype(np.uint32)
+                    self.seeds.append((shift, mask, keys[order], order))
+                else:
+                    self.seeds.append((shift, mask) + tuple(seed_tables[i]))
+
+    @classmethod
+    def from_file(cls, filename, radius):
+        """Build an index of the sites in `filename`, see `read_sites`"""
+
+        log.info(f'Reading sites from {filename}')
+        sites = read_sites(filename)
+        log.info(f'Indexing {len(sites)} unique sites for radius '
+                 '{}_{}_{}'.format(*radius))
+
+        return cls(sites, radius)
+
+    def save(self, directory):
+        """Save the index arrays as .npy files in `directory`"""
+
+        np.save(os.path.join(directory, 'sites.npy'), self.sites)
+        for i, (shift, mask, keys, order) in enumerate(self.seeds):
+            np.save(os.path.join(directory, f'seed{i}_keys.npy'), keys)
+            np.save(os.path.join(directory, f'seed{i}_order.npy'), order)
+
+    @classmethod
+    def load(cls, directory, radius, mmap_mode='r'):
+        """Load an index saved by `save`
+
+        By default the arrays are memory-mapped rather than read, so
+        loading is nearly instant and pages are shared between
+        processes using the same index.
+        """
+
+        def load_array(name):
+            return np.load(os.path.join(directory, name), mmap_mode=mmap_mode)
+
+        sites = load_array('sites.npy')
+        seed_tables = []
+        i = 0
+        while os.path.exists(os.path.join(directory, f'seed{i}_keys.npy')):
+            seed_tables.append((load_array(f'seed{i}_keys.npy'),
+                                load_array(f'seed{i}_order.npy')))
+            i += 1
+
+        return cls(sites, radius, seed_tables=seed_tables)
+
+    def search(self, guides):
+        """Find which guides match a site within the radius
+
+        Parameters
+        ----------
+        guides : list
+            list of 20-mers
+
+        Returns
+        -------
+        `numpy.ndarray`
+            boolean array, True for guides that match a site
+        """
+
+        matched = np.zeros(len(guides), dtype=bool)
+
+        if len(guides) == 0 or len(self.sites) == 0:
+            return matched
+
+        if min(self.max_mismatches) < 0:
+            # The radius asks for more matching positions than exist
+            return matched
+
+        packed, invalid = encode_guides(guides)
+
+        if self.max_mismatches[2] >= GUIDE_LENGTH:
+            for start in range(0, len(guides), QUERY_CHUNK_SIZE):
+                chunk = slice(start, start + QUERY_CHUNK_SIZE)
+                matched[chunk] = self._search_all(packed[chunk], invalid[chunk])
+            return matched
+
+        if len(self.seeds) == 0:
+            positions = np.searchsorted(self.sites, packed)
+            positions[positions == len(self.sites)] = 0
+            matched[:] = (self.sites[positions] == packed) & (invalid == 0)
+            return matched
+
+        for start in range(0, len(guides), QUERY_CHUNK_SIZE):
+            chunk = slice(start, start + QUERY_CHUNK_SIZE)
+            matched[chunk] = self._search_seeds(packed[chunk], invalid[chunk])
+
+        return matched
+
+    def _search_seeds(self, packed, invalid):
+        """Pigeonhole search for a chunk of packed guides"""
+
+        matched = np.zeros(len(packed), dtype=bool)
+
+        for shift, mask, keys, order in self.seeds:
+            query_keys = (packed >> shift) & mask
+            lo = np.searchsorted(keys, query_keys, side='left')
+            hi = np.searchsorted(keys, query_keys, side='right')
+            counts = hi - lo
+
+            # Guides already matched don't need checking again
+            counts[matched] = 0
+            total = int(counts.sum())
+            if total == 0:
+                continue
+
+            guide_idx = np.repeat(np.arange(len(packed)), counts)
+            first = np.cumsum(counts) - counts
+            site_pos = np.arange(total) - np.repeat(first - lo, counts)
+            candidates = self.sites[order[site_pos]]
+
+            within = self._within_radius(packed[guide_idx] ^ candidates,
+                                         invalid[guide_idx])
+            matched[guide_idx[within]] = True
+
+        return matched
+
+    def _search_all(self, packed, invalid):
+        """Check a chunk of packed guides against every site"""
+
+        matched = np.zeros(len(packed), dtype=bool)
+
+        for start in range(0, len(self.sites), SCAN_CHUNK_SIZE):
+            sites = np.asarray(self.sites[start:start + SCAN_CHUNK_SIZE])
+            within = self._within_radius(packed[:, None] ^ sites[None, :],
+                                         invalid[:, None])
+            matched |= within.any(axis=1)
+
+        return matched
+
+    def _within_radius(self, diff, invalid):
+        """Boolean array, True where the xor `diff` of packed guides and
+        sites, with the `invalid` positions of the guides, is within the
+        radius"""
+
+        low_bits = position_mask(0, GUIDE_LENGTH)
+        mismatches = ((diff | (diff >> np.uint64(1))) & low_bits) | invalid
+
+        within = np.ones(diff.shape, dtype=bool)
+        for region_mask, max_mismatches in zip(self.region_masks,
+                                               self.max_mismatches):
+            within &= popcount(mismatches & region_mask) <= max_mismatches
+        return within
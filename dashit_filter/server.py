@@ -0,0 +1,214 @@
+"""
+`dashit_filter serve`: long-lived on/offtarget servers.
+
+Hosts an `OfftargetIndex` of each given sites file on its own TCP port
+or Unix domain socket, so many `dashit_filter` runs can share indexes
+that are built once, via --offtarget_endpoint/--ontarget_endpoint.
+
+Each server answers ``/search`` queries exactly like the
+`special_ops_crispr_tools/offtarget` server, as a GET query string or
+a form-encoded POST body with ``targets`` and ``limits`` fields. It
+also answers ``/info`` with a JSON description of the sites file it
+serves, including the SHA-256 of its contents, so clients can check
+they are talking to the index they expect.
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+from dashit_filter.endpoints import parse_endpoint
+from dashit_filter.index_cache import IndexCache, file_digest
+from dashit_filter.offtarget_index import OfftargetIndex, read_sites
+
+log = logging.getLogger(__name__)
+
+
+class SitesService:
+    """The sites of one sites file, with an index per requested radius
+
+    Parameters
+    ----------
+    sites_filename : str
+        filename containing CRISPR sites
+    cache : `IndexCache`
+        if given, indexes are loaded from and saved to this cache
+    """
+
+    def __init__(self, sites_filename, cache=None):
+        self.sites_filename = str(Path(sites_filename).resolve())
+        self.cache = cache
+        self.digest = (cache.sites_digest(sites_filename) if cache is not None
+                       else file_digest(sites_filename))
+        self.sites = None
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def index(self, radius):
+        """Return the index for `radius`, building it if needed"""
+
+        with self.lock:
+            if radius not in self.indexes:
+                log.info(f'Indexing {self.sites_filename} for radius '
+                         '{}_{}_{}'.format(*radius))
+                if self.cache is not None:
+                    self.indexes[radius] = self.cache.load_index(
+                        self.sites_filename, radius)
+                else:
+                    if self.sites is None:
+                        self.sites = read_sites(self.sites_filename)
+                    self.indexes[radius] = OfftargetIndex(self.sites, radius)
+            return self.indexes[radius]
+
+    def info(self):
+        """Description of the sites file served, for ``/info``"""
+
+        return {'sites_file': self.sites_filename, 'sha256': self.digest}
+
+
+class SitesRequestHandler(BaseHTTPRequestHandler):
+    """Answers ``/search`` and ``/info`` for `self.server.service`"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        # Unix domain socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def send_body(self, status, body, content_type='text/plain'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def search(self, query):
+        try:
+            targets = query['targets'][0].split(',')
+            radius = tuple(map(int, query['limits'][0].split(',')))
+            matched = self.server.service.index(radius).search(targets)
+        except (KeyError, ValueError) as e:
+            self.send_body(400, f'bad query: {e}\n'.encode('utf-8'))
+            return
+
+        body = ''.join('{} {}\n'.format(target, 'true' if is_match else 'false')
+                       for target, is_match in zip(targets, matched.tolist()))
+        self.send_body(200, body.encode('ascii'))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/search':
+            self.search(parse_qs(url.query))
+        elif url.path == '/info':
+            self.send_body(200, json.dumps(self.server.service.info()).encode('utf-8'),
+                           content_type='application/json')
+        else:
+            self.send_body(404, b'not found\n')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urlparse(self.path).path == '/search':
+            self.search(parse_qs(body.decode('ascii')))
+        else:
+            self.send_body(404, b'not found\n')
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix domain socket"""
+
+    daemon_threads = True
+
+
+def make_server(endpoint, service):
+    """Create an HTTP server for `service` listening on `endpoint`"""
+
+    kind, address = parse_endpoint(endpoint)
+
+    if kind == 'unix':
+        if os.path.exists(address):
+            os.unlink(address)
+        server = ThreadingUnixHTTPServer(address, SitesRequestHandler)
+    else:
+        server = ThreadingHTTPServer(address, SitesRequestHandler)
+
+    server.service = service
+    return server
+
+
+def serve_main(argv):
+    """Entry point of ``dashit_filter serve``"""
+
+    parser = argparse.ArgumentParser(prog='dashit_filter serve',
+                                     description='Serve on/offtarget site '
+                                     'indexes to many dashit_filter runs')
+
+    parser.add_argument('--index', nargs=2, action='append', required=True,
+                        metavar=('SITES_FILE', 'ENDPOINT'),
+                        help='serve SITES_FILE, as generated by crispr_sites, '
+                        'on ENDPOINT: a port, host:port or unix:/path/to/socket. '
+                        'May be given several times.')
+
+    parser.add_argument('--radius', type=str, action='append',
+                        help='radius to index at startup, in the format of '
+                        '--offtarget_radius. Indexes for other radii are '
+                        'built on their first query.')
+
+    parser.add_argument('--index_cache', type=str,
+                        help='directory in which to cache built indexes')
+
+    parser.add_argument('--index_cache_size', type=float, default=20,
+                        help='maximum size of --index_cache in GB')
+
+    args = parser.parse_args(argv)
+
+    cache = None
+    if args.index_cache is not None:
+        cache = IndexCache(args.index_cache, int(args.index_cache_size * 1024**3))
+
+    try:
+        radii = [tuple(map(int, radius.split('_')))
+                 for radius in (args.radius or ['5_10_20'])]
+    except ValueError:
+        log.error(f'Invalid radius string in {args.radius}')
+        sys.exit(1)
+
+    servers = []
+    for sites_filename, endpoint in args.index:
+        try:
+            service = SitesService(sites_filename, cache=cache)
+            for radius in radii:
+                service.index(radius)
+            server = make_server(endpoint, service)
+        except (IOError, ValueError) as e:
+            log.error(f'Error serving {sites_filename} on {endpoint}: {e}')
+            sys.exit(1)
+
+        log.info(f'Serving {sites_filename} on {endpoint}')
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass
+
+    log.info('Shutting down')
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+        if isinstance(server, ThreadingUnixHTTPServer):
+            os.unlink(server.server_address)
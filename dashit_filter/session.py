@@ -0,0 +1,245 @@
+"""
+Filtering guides from Python, without the command line.
+
+A `DashitFilter` session starts the on/offtarget backends, opens the
+caches and prepares the quality filter once, then filters any number
+of batches of guides with them, so a pipeline calling dashit_filter
+many times doesn't relaunch servers or reread site files on each call::
+
+    from dashit_filter import DashitFilter
+
+    with DashitFilter(ontarget='ontarget.txt', offtarget='offtarget.txt',
+                      homopolymer=4) as session:
+        kept, reasons = session.filter(guides)
+
+Options are those of the dashit_filter command line, as keyword
+arguments named after the option and with the same defaults, given as
+the values the command line parses them to, e.g.
+``offtarget_radius='5_9_18'`` or ``offtarget_port='auto'``. Options
+about the input and output files and how a run is organized, such as
+--pipelined or --sweep, don't apply to sessions.
+
+Stages run in the fixed order, ontarget, offtarget then quality, and a
+guide is filtered for the reason of the first stage rejecting it, as
+with the command line.
+
+The stock offtarget server only listens on port 8080, so when both the
+ontarget and offtarget stages launch a server on that port they can't
+both stay up: each is then launched for its stage of every `filter`
+call and shut down after it. Pass ``offtarget_port='auto'``, with an
+offtarget build that reads the PORT environment variable, to keep both
+running.
+"""
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from dashit_filter.dashit_filter import (STAGES, CachedBackend, build_parser,
+                                         filter_offtargets, filter_ontargets,
+                                         filter_quality, launch_plan,
+                                         quality_filter_parms, sites_backend)
+from dashit_filter.flash_batch import hairpin_table
+from dashit_filter.guide_set import FilteredGuides, GuideSet
+from dashit_filter.verdict_cache import VerdictCache
+
+log = logging.getLogger(__name__)
+
+# Command line options about a whole run rather than how guides are
+# filtered, which sessions don't take
+RUN_OPTIONS = ('input', 'output', 'output_compression', 'keep_mask',
+               'filtered_explanation', 'pipelined', 'stage_order',
+               'plan_metrics', 'stream',
+               'stream_chunk_size', 'metrics_out', 'profile_quality',
+               'checkpoint_dir', 'sweep', 'sweep_report', 'sweep_select',
+               'features')
+
+
+def parse_radius(radius, name):
+    """(c5, c10, c20) of a radius given as L_M_N or a tuple
+
+    Raises
+    ------
+    ValueError
+        if `radius` isn't a radius
+    """
+
+    try:
+        c5, c10, c20 = (map(int, radius.split('_')) if isinstance(radius, str)
+                        else radius)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid {name} radius {radius}')
+
+    return int(c5), int(c10), int(c20)
+
+
+class DashitFilter:
+    """A filtering session, see the module documentation
+
+    Parameters
+    ----------
+    **options
+        dashit_filter command line options, e.g. ``ontarget``,
+        ``offtarget``, ``backend`` or ``gc_freq_min``
+
+    Raises
+    ------
+    TypeError
+        if an option isn't a filtering option of the command line
+    ValueError
+        if a radius is invalid, or can't be matched by the backend
+    RuntimeError
+        if an on/offtarget backend can't be started
+    """
+
+    def __init__(self, **options):
+        self.options = build_parser().parse_args([''])
+        for name, value in options.items():
+            if name in RUN_OPTIONS or not hasattr(self.options, name):
+                raise TypeError(f'{name} is not a dashit_filter filtering '
+                                'option')
+            setattr(self.options, name, value)
+
+        self.filter_parms = quality_filter_parms(vars(self.options))
+        self.radii = {stage: parse_radius(getattr(self.options,
+                                                  f'{stage}_radius'), stage)
+                      for stage in ('ontarget', 'offtarget')}
+
+        self.backends = {}
+        # Stages whose backend is started for each call to `filter`
+        self.deferred = []
+        self.verdict_cache = None
+        self.executor = None
+
+        try:
+            self._start()
+        except BaseException:
+            self.close()
+            raise
+
+    def _start(self):
+        if self.options.verdict_cache is not None:
+            self.verdict_cache = VerdictCache(self.options.verdict_cache)
+
+        stages = [stage for stage in ('ontarget', 'offtarget')
+                  if getattr(self.options, stage) is not None]
+        self.port_offsets, one_at_a_time = launch_plan(self.options, stages,
+                                                       self.radii)
+
+        if one_at_a_time:
+            log.info('The ontarget and offtarget servers would both listen on '
+                     'port 8080, so each is launched for its stage of every '
+                     'call to filter')
+            self.deferred = stages
+        else:
+            for stage in stages:
+                self.backends[stage] = self._start_backend(stage)
+
+        # Built once here rather than on the first call
+        hairpin_table(self.filter_parms['hairpin']['min_outer'],
+                      self.filter_parms['hairpin']['min_inner'])
+
+        if self.options.jobs > 1:
+            self.executor = ProcessPoolExecutor(max_workers=self.options.jobs)
+
+    def _start_backend(self, stage):
+        sites_filename = getattr(self.options, stage)
+        backend = sites_backend(
+            self.options, sites_filename, self.radii[stage], stage,
+            endpoint=getattr(self.options, f'{stage}_endpoint'),
+            port_offset=self.port_offsets[stage])
+        if not backend.start():
+            raise RuntimeError(f'Error starting {stage} filtering backend')
+
+        if self.verdict_cache is None:
+            return backend
+
+        key = self.verdict_cache.sites_stage_key(sites_filename,
+                                                 self.radii[stage])
+        cached = CachedBackend(backend, self.verdict_cache, key, stage)
+        cached.started = True
+        return cached
+
+    def filter(self, guides):
+        """Filter guides
+
+        Parameters
+        ----------
+        guides : iterable or `GuideSet`
+            20-mers, as strings or bytes, e.g. a list or
+            `numpy.ndarray`, or a `GuideSet`. Guides that aren't 20
+            bases of A, C, G, T go through the stages as any other.
+
+        Returns
+        -------
+        tuple
+            (kept, reasons). `kept` holds the guides that passed every
+            stage, in the order given: a list of strings, or a
+            `GuideSet` if `guides` is one. `reasons` is a dict keyed on
+            the guides filtered out, with the reason they were filtered
+            as value, as in --filtered_explanation.
+
+        Raises
+        ------
+        RuntimeError
+            if a backend launched for this call, see the module
+            documentation, can't be started
+        """
+
+        if isinstance(guides, GuideSet):
+            given = None
+            candidates = guides
+        else:
+            given = [guide.decode('ascii', 'replace') if isinstance(guide, bytes)
+                     else str(guide) for guide in guides]
+            candidates = GuideSet.from_strings(list(dict.fromkeys(given)))
+
+        filtered_guides = FilteredGuides()
+
+        for stage in STAGES:
+            if stage == 'quality':
+                candidates = filter_quality(
+                    candidates, filtered_guides, self.filter_parms,
+                    jobs=self.options.jobs, verdict_cache=self.verdict_cache,
+                    executor=self.executor)
+            elif stage in self.backends or stage in self.deferred:
+                filter_stage = (filter_ontargets if stage == 'ontarget'
+                                else filter_offtargets)
+                backend = self.backends.get(stage)
+                if backend is None:
+                    backend = self._start_backend(stage)
+                try:
+                    candidates = filter_stage(candidates, filtered_guides,
+                                              backend,
+                                              getattr(self.options, stage))
+                finally:
+                    if stage in self.deferred:
+                        log.info(f'Shutting down {stage} filtering backend')
+                        backend.close()
+
+        reasons = dict(filtered_guides.items())
+
+        if given is None:
+            return candidates, reasons
+
+        return [guide for guide in given if guide not in reasons], reasons
+
+    def close(self):
+        """Shut down the backends and release the caches"""
+
+        for stage, backend in self.backends.items():
+            log.info(f'Shutting down {stage} filtering backend')
+            backend.close()
+        self.backends = {}
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+        if self.verdict_cache is not None:
+            self.verdict_cache.close()
+            self.verdict_cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
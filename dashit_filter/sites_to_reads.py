@@ -0,0 +1,641 @@
+"""
+Binary sites-to-reads files.
+
+A text sites-to-reads file, as generated by ``crispr_sites -r``, has a
+header line with the total number of reads, then one line per guide:
+the 20-mer followed by the ids of the reads it hits. The binary format
+holds the same lines several times more compactly, and can be
+memory-mapped so guides are read without parsing any text:
+
+- a fixed size header (`HEADER`): magic, version, total number of
+  reads, number of lines, size of the read id data, length of the
+  original header line and the separators used between the guide and
+  its read ids and between read ids
+- the original header line
+- padding, so the arrays that follow are 8 byte aligned
+- the guide of each line, packed 2 bits per base into a `uint64`
+- CSR style offsets: `num_lines + 1` `uint64` offsets of each line's
+  read ids into the read id data
+- the read id data: each line's read ids as unsigned LEB128 varints
+
+Converting a text file to binary and back gives the identical text
+file. Filtering a file can produce a keep mask, a bitmap with a bit per
+line, instead of a filtered copy, see `write_keep_mask`.
+"""
+import argparse
+import io
+import itertools
+import logging
+import os
+import re
+import struct
+import sys
+
+import numpy as np
+
+from dashit_filter.compression import open_input, open_output
+from dashit_filter.encoding import (encode_bases, encode_kmers, pack_codes,
+                                    unpack_kmers, INVALID_BASE, GUIDE_LENGTH)
+from dashit_filter.guide_set import INVALID_GUIDE, GuideSet
+
+MAGIC = b'DASHS2R\x00'
+VERSION = 1
+
+# magic, version, total reads, number of lines, bytes of read id data,
+# length of the header line, guide separator, read id separator
+HEADER = struct.Struct('<8sIQQQI1s1s')
+
+KEEP_MASK_MAGIC = b'DASHKEEP'
+
+# magic, number of lines
+KEEP_MASK_HEADER = struct.Struct('<8sQ')
+
+# Number of lines converted at once
+CONVERT_CHUNK_SIZE = 1000000
+
+# Bytes of a text sites-to-reads file indexed at once
+READ_CHUNK_SIZE = 1 << 24
+
+# Most bytes copied by one read or sendfile call when copying the kept
+# lines of a text file
+COPY_CHUNK_SIZE = 1 << 24
+
+log = logging.getLogger(__name__)
+
+
+def is_binary(filename):
+    """True if `filename` is a binary sites-to-reads file"""
+
+    with open(filename, 'rb') as handle:
+        return handle.read(len(MAGIC)) == MAGIC
+
+
+def _padding(size):
+    """Bytes needed after `size` bytes to align the arrays that follow"""
+
+    return -size % 8
+
+
+def encode_varints(values):
+    """Encode a `uint64` array as concatenated unsigned LEB128 varints
+
+    Returns
+    -------
+    tuple
+        (encoded bytes as a `uint8` array, number of bytes of each value)
+    """
+
+    values = np.asarray(values, dtype=np.uint64)
+
+    num_bytes = np.ones(len(values), dtype=np.int64)
+    for k in range(1, 10):
+        num_bytes += values >= np.uint64(1 << (7 * k))
+
+    starts = np.cumsum(num_bytes) - num_bytes
+    encoded = np.zeros(int(num_bytes.sum()), dtype=np.uint8)
+
+    for k in range(int(num_bytes.max()) if len(values) > 0 else 0):
+        has_byte = num_bytes > k
+        byte = (values[has_byte] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (num_bytes[has_byte] > k + 1).astype(np.uint64) << np.uint64(7)
+        encoded[starts[has_byte] + k] = (byte | more).astype(np.uint8)
+
+    return encoded, num_bytes
+
+
+def decode_varints(encoded):
+    """Decode concatenated unsigned LEB128 varints into a `uint64` array"""
+
+    encoded = np.asarray(encoded, dtype=np.uint8)
+    if len(encoded) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    last = encoded < 0x80
+    # Index of the varint each byte belongs to, and the byte's position
+    # within it
+    value_index = np.concatenate(([0], np.cumsum(last[:-1])))
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    position = np.arange(len(encoded)) - starts[value_index]
+
+    parts = ((encoded & 0x7f).astype(np.uint64) <<
+             (np.uint64(7) * position.astype(np.uint64)))
+
+    return np.add.reduceat(parts, starts)
+
+
+class SitesToReads:
+    """A memory-mapped binary sites-to-reads file
+
+    Parameters
+    ----------
+    filename : str
+        binary sites-to-reads file, as written by `write`
+
+    Attributes
+    ----------
+    header_line : str
+        the header line of the original text file
+    total_reads : int
+        total number of reads
+    guides : `numpy.ndarray`
+        packed guide of each line
+    offsets : `numpy.ndarray`
+        offsets of each line's read ids into `read_data`
+    read_data : `numpy.ndarray`
+        varint encoded read ids
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        data = np.memmap(filename, dtype=np.uint8, mode='r')
+
+        if len(data) < HEADER.size:
+            raise ValueError(f'{filename} is not a binary sites-to-reads file')
+
+        (magic, version, self.total_reads, self.num_lines, num_read_bytes,
+         header_length, guide_separator, read_separator) = HEADER.unpack(
+             data[:HEADER.size].tobytes())
+
+        if magic != MAGIC:
+            raise ValueError(f'{filename} is not a binary sites-to-reads file')
+        if version != VERSION:
+            raise ValueError(f'{filename} is version {version} of the binary '
+                             f'sites-to-reads format, expected {VERSION}')
+
+        self.guide_separator = guide_separator.decode('ascii')
+        self.read_separator = read_separator.decode('ascii')
+
+        position = HEADER.size
+        self.header_line = data[position:position + header_length].tobytes().decode('utf-8')
+        position += header_length
+        position += _padding(position)
+
+        def array(count, dtype):
+            nonlocal position
+            size = count * np.dtype(dtype).itemsize
+            values = data[position:position + size].view(dtype)
+            position += size
+            return values
+
+        self.guides = array(self.num_lines, '<u8')
+        self.offsets = array(self.num_lines + 1, '<u8')
+        self.read_data = array(num_read_bytes, np.uint8)
+
+    def __len__(self):
+        return self.num_lines
+
+    def unique_guides(self):
+        """The distinct guides as a `GuideSet`, in order of first
+        appearance"""
+
+        _, first = np.unique(self.guides, return_index=True)
+        return GuideSet(self.guides[np.sort(first)])
+
+    def keep_mask(self, rejected_guides):
+        """Boolean array, True for lines whose guide isn't in the
+        `GuideSet` `rejected_guides`"""
+
+        return ~rejected_guides.contains(self.guides)
+
+    def line_counts(self):
+        """Number of lines with each guide of `unique_guides`"""
+
+        _, first, counts = np.unique(self.guides, return_index=True,
+                                     return_counts=True)
+        return counts[np.argsort(first)]
+
+    def text_lines(self, keep=None):
+        """The lines of the equivalent text file, without its header line
+
+        Parameters
+        ----------
+        keep : `numpy.ndarray`
+            if given, only lines where this boolean array is True
+        """
+
+        for start in range(0, self.num_lines, CONVERT_CHUNK_SIZE):
+            end = min(start + CONVERT_CHUNK_SIZE, self.num_lines)
+            lines = np.arange(start, end)
+            if keep is not None:
+                lines = lines[keep[start:end]]
+            if len(lines) == 0:
+                continue
+
+            first = int(self.offsets[start])
+            read_data = self.read_data[first:int(self.offsets[end])]
+            read_ids = decode_varints(read_data).astype(str).tolist()
+
+            # Each varint ends with a byte below 0x80, so counting those
+            # gives the index of each line's first read id
+            id_offsets = np.concatenate(([0], np.cumsum(read_data < 0x80)))[
+                self.offsets[start:end + 1].astype(np.int64) - first].tolist()
+
+            guides = unpack_kmers(self.guides[lines])
+
+            for guide, line in zip(guides, (lines - start).tolist()):
+                ids = read_ids[id_offsets[line]:id_offsets[line + 1]]
+                if len(ids) == 0:
+                    yield guide + '\n'
+                else:
+                    yield (guide + self.guide_separator +
+                           self.read_separator.join(ids) + '\n')
+
+    def write_subset(self, handle, keep):
+        """Write the lines where `keep` is True as a binary file, returns
+        the number of bytes written"""
+
+        lengths = np.diff(self.offsets.astype(np.int64))
+        keep_bytes = np.repeat(keep, lengths)
+
+        return write(handle, self.header_line, self.total_reads, self.guides[keep],
+              np.concatenate(([0], np.cumsum(lengths[keep]))),
+              self.read_data[keep_bytes],
+              self.guide_separator, self.read_separator)
+
+
+def _separators(line):
+    """The separators between the guide and read ids, and between read
+    ids, of a text sites-to-reads line"""
+
+    ids = line[GUIDE_LENGTH + 1:].rstrip('\n')
+    read_separator = next((c for c in ids if c.isspace()), ' ')
+    return line[GUIDE_LENGTH], read_separator
+
+
+def write(handle, header_line, total_reads, guides, offsets, read_data,
+          guide_separator='\t', read_separator=' '):
+    """Write a binary sites-to-reads file to the binary file `handle`,
+    returns the number of bytes written"""
+
+    header_bytes = header_line.encode('utf-8')
+
+    parts = [HEADER.pack(MAGIC, VERSION, total_reads, len(guides),
+                         len(read_data), len(header_bytes),
+                         guide_separator.encode('ascii'),
+                         read_separator.encode('ascii')),
+             header_bytes + b'\0' * _padding(HEADER.size + len(header_bytes)),
+             np.asarray(guides, dtype='<u8').tobytes(),
+             np.asarray(offsets, dtype='<u8').tobytes(),
+             np.asarray(read_data, dtype=np.uint8).tobytes()]
+    for part in parts:
+        handle.write(part)
+    return sum(len(part) for part in parts)
+
+
+def convert_text(input_handle, output_handle, keep=None):
+    """Convert a text sites-to-reads file to binary
+
+    Parameters
+    ----------
+    input_handle : file
+        the text file
+    output_handle : file
+        binary file the binary file is written to
+    keep : `numpy.ndarray`
+        if given, only lines where this boolean array is True are
+        converted
+
+    Raises
+    ------
+    ValueError
+        if the text file can't be converted without losing anything,
+        e.g. a guide has bases other than A, C, G, T
+    """
+
+    header_line = input_handle.readline()
+
+    match = re.search(r': (\d+)', header_line)
+    if match is None:
+        raise ValueError('the total number of reads is missing from line 1')
+    total_reads = int(match.group(1))
+
+    guide_chunks = []
+    length_chunks = []
+    read_data_chunks = []
+    separators = None
+    line_number = 0
+
+    while True:
+        lines = list(itertools.islice(input_handle, CONVERT_CHUNK_SIZE))
+        if len(lines) == 0:
+            break
+
+        if keep is not None:
+            kept = keep[line_number:line_number + len(lines)]
+            line_number += len(lines)
+            lines = [line for line, is_kept in zip(lines, kept) if is_kept]
+
+        guides = [line[0:GUIDE_LENGTH] for line in lines]
+        codes = encode_kmers(guides)
+        if (codes == INVALID_BASE).any():
+            raise ValueError('guides with bases other than A, C, G, T '
+                             "can't be stored in a binary sites-to-reads file")
+
+        if separators is None:
+            separators = next((_separators(line) for line in lines
+                               if len(line) > GUIDE_LENGTH + 1), None)
+        guide_separator, read_separator = separators or ('\t', ' ')
+
+        fields = []
+        lengths = []
+        for guide, line in zip(guides, lines):
+            ids = line[GUIDE_LENGTH + 1:].rstrip('\n').split(read_separator)
+            if ids == ['']:
+                ids = []
+            text = (guide + guide_separator + read_separator.join(ids) + '\n'
+                    if len(ids) > 0 else guide + '\n')
+            if text != line:
+                raise ValueError(f'line {line.rstrip()} is not in the '
+                                 'format <guide><separator><read ids>')
+            fields.extend(ids)
+            lengths.append(len(ids))
+
+        try:
+            read_ids = np.array(fields, dtype=np.uint64)
+        except ValueError:
+            raise ValueError('read ids should be non negative integers')
+
+        encoded, num_bytes = encode_varints(read_ids)
+        line_ends = np.cumsum(lengths)
+        byte_ends = np.concatenate(([0], np.cumsum(num_bytes)))[line_ends]
+
+        guide_chunks.append(pack_codes(codes))
+        length_chunks.append(np.diff(np.concatenate(([0], byte_ends))))
+        read_data_chunks.append(encoded)
+
+    if separators is None:
+        separators = ('\t', ' ')
+
+    guides = (np.concatenate(guide_chunks) if guide_chunks
+              else np.zeros(0, dtype=np.uint64))
+    lengths = (np.concatenate(length_chunks) if length_chunks
+               else np.zeros(0, dtype=np.int64))
+    read_data = (np.concatenate(read_data_chunks) if read_data_chunks
+                 else np.zeros(0, dtype=np.uint8))
+
+    write(output_handle, header_line, total_reads, guides,
+          np.concatenate(([0], np.cumsum(lengths))), read_data, *separators)
+
+
+def _line_guides(data, ends):
+    """Packed guides of the lines of `data`, whose lines end at `ends`
+
+    Returns
+    -------
+    tuple
+        (packed, invalid, invalid_guides): the `uint64` packed guide of
+        each line, a boolean array, True for the lines whose guide isn't
+        20 bases of A, C, G, T and whose packed guide is meaningless,
+        and the list of those guides as strings
+    """
+
+    starts = np.concatenate(([0], ends[:-1]))
+    buffer = np.frombuffer(data, dtype=np.uint8)
+
+    # A line shorter than a guide has its newline among the first bases,
+    # or is the last line and ends with the data
+    invalid = ends - starts < GUIDE_LENGTH
+    packed = np.zeros(len(starts), dtype=np.uint64)
+    for i in range(GUIDE_LENGTH):
+        codes = encode_bases(buffer[np.minimum(starts + i, len(buffer) - 1)])
+        invalid |= codes == INVALID_BASE
+        packed |= codes.astype(np.uint64) << np.uint64(2 * (GUIDE_LENGTH - 1 - i))
+
+    invalid_guides = [
+        data[start:min(start + GUIDE_LENGTH, end)].decode(
+            'ascii', 'replace').rstrip('\r\n')
+        for start, end in zip(starts[invalid].tolist(),
+                              ends[invalid].tolist())]
+
+    return packed, invalid, invalid_guides
+
+
+class TextLines:
+    """Index of the lines of a text sites-to-reads file, built in one
+    pass so the kept lines can be copied out without parsing them again
+
+    Guides that aren't 20 bases of A, C, G, T are held as strings, in
+    `guides.invalid_guides`, see `GuideSet`.
+
+    Parameters
+    ----------
+    handle : file
+        the text file, opened in binary mode, positioned after the
+        header line
+    position : int
+        byte offset of the handle in the file, needed if it can't tell
+    progress : callable
+        if given, called with the number of bytes read after each read
+
+    Attributes
+    ----------
+    guides : `GuideSet`
+        the distinct guides, in order of first appearance
+    line_guides : `numpy.ndarray`
+        index into `guides` of the guide of each line
+    offsets : `numpy.ndarray`
+        byte offset of the start of each line, and of the end of the
+        last line
+    """
+
+    def __init__(self, handle, position=None, progress=None):
+        if position is None:
+            position = handle.tell()
+
+        packed = []
+        # Index of each distinct invalid guide, in order of first appearance
+        invalid_ids = {}
+        offsets = [np.array([position], dtype=np.int64)]
+
+        def add_lines(data, ends):
+            chunk_packed, chunk_invalid, chunk_invalid_guides = _line_guides(
+                data, ends)
+            chunk_packed[chunk_invalid] = INVALID_GUIDE | np.fromiter(
+                (invalid_ids.setdefault(guide, len(invalid_ids))
+                 for guide in chunk_invalid_guides),
+                dtype=np.uint64, count=len(chunk_invalid_guides))
+            packed.append(chunk_packed)
+            offsets.append(position + ends)
+
+        tail = b''
+        while True:
+            block = handle.read(READ_CHUNK_SIZE)
+            if progress is not None:
+                progress(len(block))
+            if len(block) == 0:
+                break
+            data = tail + block
+            ends = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) ==
+                                  ord('\n')) + 1
+            if len(ends) == 0:
+                tail = data
+                continue
+            add_lines(data, ends)
+            position += int(ends[-1])
+            tail = data[int(ends[-1]):]
+
+        # Last line, without a newline
+        if len(tail) > 0:
+            add_lines(tail, np.array([len(tail)]))
+
+        packed = (np.concatenate(packed) if packed
+                  else np.zeros(0, dtype=np.uint64))
+
+        # Numbers each guide in order of first appearance
+        unique, first, inverse = np.unique(packed, return_index=True,
+                                           return_inverse=True)
+        order = np.argsort(first)
+        ids = np.empty(len(order), dtype=np.int64)
+        ids[order] = np.arange(len(order))
+
+        self.guides = GuideSet(unique[order], list(invalid_ids))
+        self.line_guides = ids[inverse.ravel()]
+        self.offsets = np.concatenate(offsets).astype(np.int64)
+
+    def __len__(self):
+        return len(self.line_guides)
+
+    def keep_mask(self, rejected_guides):
+        """Boolean array, True for lines whose guide isn't in the
+        `GuideSet` `rejected_guides`"""
+
+        return ~rejected_guides.contains(self.guides.packed)[self.line_guides]
+
+    def line_counts(self):
+        """Number of lines with each guide of `guides`"""
+
+        return np.bincount(self.line_guides, minlength=len(self.guides))
+
+    def kept_ranges(self, keep):
+        """Byte ranges of the runs of consecutive lines where `keep` is
+        True, as arrays of starts and ends"""
+
+        edges = np.diff(np.concatenate(([0], keep.astype(np.int8), [0])))
+        return (self.offsets[np.flatnonzero(edges == 1)],
+                self.offsets[np.flatnonzero(edges == -1)])
+
+
+def copy_ranges(input_handle, output_handle, starts, ends):
+    """Copy byte ranges of the binary file `input_handle` to the binary
+    file `output_handle`, with `os.sendfile` where the platform allows
+
+    `input_handle` may be a stream that can't seek, such as a
+    decompressed file, if it is positioned at the start of the file; it
+    is then read through once.
+
+    Returns
+    -------
+    int
+        number of bytes copied
+    """
+
+    output_handle.flush()
+
+    # Only plain files can sendfile, not e.g. compressing writers
+    use_sendfile = (hasattr(os, 'sendfile') and input_handle.seekable() and
+                    isinstance(output_handle, (io.BufferedWriter, io.FileIO)))
+
+    seekable = input_handle.seekable()
+    position = 0
+
+    copied = 0
+    for start, end in zip(starts.tolist(), ends.tolist()):
+        # Skip to the range in streams that can't seek
+        while not seekable and position < start:
+            skipped = len(input_handle.read(min(start - position,
+                                                COPY_CHUNK_SIZE)))
+            if skipped == 0:
+                break
+            position += skipped
+
+        while start < end:
+            size = min(end - start, COPY_CHUNK_SIZE)
+            if use_sendfile:
+                try:
+                    sent = os.sendfile(output_handle.fileno(),
+                                       input_handle.fileno(), start, size)
+                except OSError:
+                    # e.g. stdout is a terminal or the platform can't
+                    # sendfile between these kinds of files
+                    use_sendfile = False
+                    continue
+            else:
+                if seekable:
+                    input_handle.seek(start)
+                sent = output_handle.write(input_handle.read(size))
+                position = start + sent
+            if sent == 0:
+                raise IOError(f'{input_handle.name} is shorter than when it '
+                              'was read')
+            start += sent
+            copied += sent
+
+    output_handle.flush()
+    return copied
+
+
+def write_keep_mask(filename, keep):
+    """Write a keep mask: the number of lines, then a bit per line, set
+    if the line is kept, most significant bit first"""
+
+    with open(filename, 'wb') as handle:
+        handle.write(KEEP_MASK_HEADER.pack(KEEP_MASK_MAGIC, len(keep)))
+        handle.write(np.packbits(keep).tobytes())
+
+
+def read_keep_mask(filename):
+    """Read a keep mask written by `write_keep_mask` as a boolean array"""
+
+    with open(filename, 'rb') as handle:
+        magic, num_lines = KEEP_MASK_HEADER.unpack(
+            handle.read(KEEP_MASK_HEADER.size))
+        if magic != KEEP_MASK_MAGIC:
+            raise ValueError(f'{filename} is not a keep mask')
+        bits = np.frombuffer(handle.read(), dtype=np.uint8)
+
+    return np.unpackbits(bits, count=num_lines).astype(bool)
+
+
+def convert_main(argv):
+    """Entry point of ``dashit_filter convert``"""
+
+    parser = argparse.ArgumentParser(prog='dashit_filter convert',
+                                     description='Convert a sites-to-reads '
+                                     'file between the text format of '
+                                     'crispr_sites -r and the binary format. '
+                                     'Text files may be gzip or zstd '
+                                     'compressed.')
+
+    parser.add_argument('input', type=str, help='text or binary '
+                        'sites-to-reads file. Binary files are converted to '
+                        'text, text files to binary.')
+
+    parser.add_argument('output', type=str, help='converted file. Text files '
+                        'ending in .gz or .zst are compressed.')
+
+    parser.add_argument('--keep_mask', type=str,
+                        help='only convert the lines kept in this keep mask, '
+                        'as written by dashit_filter --keep_mask')
+
+    args = parser.parse_args(argv)
+
+    try:
+        keep = None
+        if args.keep_mask is not None:
+            keep = read_keep_mask(args.keep_mask)
+
+        if is_binary(args.input):
+            sites = SitesToReads(args.input)
+            if keep is not None and len(keep) != len(sites):
+                raise ValueError(f'{args.keep_mask} has {len(keep)} lines, '
+                                 f'{args.input} has {len(sites)}')
+            with open_output(args.output, mode='w') as output_handle:
+                output_handle.write(sites.header_line)
+                output_handle.writelines(sites.text_lines(keep))
+        else:
+            with open_input(args.input, 'r') as input_handle, \
+                    open(args.output, 'wb') as output_handle:
+                convert_text(input_handle, output_handle, keep)
+    except (IOError, ValueError) as e:
+        log.error(f'Error converting {args.input}: {e}')
+        sys.exit(1)
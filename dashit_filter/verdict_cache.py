@@ -0,0 +1,146 @@
+"""
+Persistent cache of per-guide filtering verdicts.
+
+Experiments often re-filter overlapping sets of guides against the same
+on/offtarget files and with the same quality parameters. `VerdictCache`
+remembers the verdict of every guide for every such stage in an SQLite
+database, so on a rerun guides already seen cost only a lookup and
+backends only need starting for new guides.
+
+A stage is identified by a key describing everything its verdicts
+depend on, see `sites_stage_key` and `quality_stage_key`. Verdicts are
+stored as JSON.
+"""
+import json
+import logging
+import sqlite3
+import threading
+from pathlib import Path
+
+from dashit_filter.index_cache import file_digest
+
+log = logging.getLogger(__name__)
+
+# Number of guides looked up in one query, below SQLite's default limit
+# on the number of parameters of a statement
+LOOKUP_CHUNK_SIZE = 900
+
+
+class VerdictCache:
+    """SQLite backed cache of filtering verdicts
+
+    Parameters
+    ----------
+    path : str
+        database file, created if it doesn't exist. Several runs may
+        share it at once, and several threads may use one instance.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, timeout=600,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS stages '
+                '(id INTEGER PRIMARY KEY, key TEXT UNIQUE NOT NULL)')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts '
+                '(stage INTEGER NOT NULL, guide TEXT NOT NULL, '
+                'verdict TEXT NOT NULL, PRIMARY KEY (stage, guide)) '
+                'WITHOUT ROWID')
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS digests '
+                '(path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, '
+                'digest TEXT)')
+
+    def sites_digest(self, filename):
+        """Content digest of a sites file, only recomputed when its size
+        or modification time change"""
+
+        path = Path(filename).resolve()
+        stat = path.stat()
+
+        with self.lock:
+            row = self.connection.execute(
+                'SELECT digest FROM digests WHERE path = ? AND size = ? '
+                'AND mtime = ?', (str(path), stat.st_size, stat.st_mtime_ns)
+            ).fetchone()
+        if row is not None:
+            return row[0]
+
+        log.info(f'Hashing {filename}')
+        digest = file_digest(path)
+
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO digests VALUES (?, ?, ?, ?)',
+                (str(path), stat.st_size, stat.st_mtime_ns, digest))
+
+        return digest
+
+    def sites_stage_key(self, sites_filename, radius):
+        """Key of matching guides against `sites_filename` within
+        `radius`. Ontarget and offtarget stages against the same sites
+        share verdicts."""
+
+        return json.dumps({'sites': self.sites_digest(sites_filename),
+                           'radius': list(radius)})
+
+    @staticmethod
+    def quality_stage_key(filter_parms):
+        """Key of filtering guides for poor structure with `filter_parms`"""
+
+        return json.dumps({'quality': filter_parms}, sort_keys=True)
+
+    def _stage_id(self, key):
+        """Row id of stage `key`, must be called holding `self.lock`"""
+
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR IGNORE INTO stages (key) VALUES (?)', (key,))
+        return self.connection.execute(
+            'SELECT id FROM stages WHERE key = ?', (key,)).fetchone()[0]
+
+    def lookup(self, key, guides):
+        """Cached verdicts of `guides` for stage `key`
+
+        Returns
+        -------
+        dict
+            dict keyed on the guides that have a cached verdict, with
+            the verdict as value
+        """
+
+        guides = list(guides)
+        verdicts = {}
+
+        with self.lock:
+            stage = self._stage_id(key)
+            for i in range(0, len(guides), LOOKUP_CHUNK_SIZE):
+                chunk = guides[i:i + LOOKUP_CHUNK_SIZE]
+                rows = self.connection.execute(
+                    'SELECT guide, verdict FROM verdicts WHERE stage = ? AND '
+                    'guide IN ({})'.format(','.join('?' * len(chunk))),
+                    [stage] + chunk)
+                verdicts.update((guide, json.loads(verdict))
+                                for guide, verdict in rows)
+
+        return verdicts
+
+    def store(self, key, verdicts):
+        """Remember `verdicts`, a dict keyed on guides, for stage `key`"""
+
+        with self.lock:
+            stage = self._stage_id(key)
+            with self.connection:
+                self.connection.executemany(
+                    'INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)',
+                    ((stage, guide, json.dumps(verdict))
+                     for guide, verdict in verdicts.items()))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,65 @@
+import random
+
+import pytest
+
+from dashit_filter.checkpoint import Checkpoint
+from dashit_filter.guide_set import FilteredGuides, GuideSet
+
+RUN = {'input': ['s2r.txt', 100, 1], 'offtarget_radius': (5, 10, 20)}
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def test_resume_stages_plan_and_batches(tmp_path):
+    guides = GuideSet.from_strings(random_guides(100) +
+                                   ['ACGTNACGTACGTACGTACG', 'ACGT'])
+    filtered = FilteredGuides()
+    filtered.add(guides[::3], 'not ontarget in on.txt')
+    filtered.add(guides[100:], [['gc_frequency'], ['homopolymer>5']])
+
+    checkpoint = Checkpoint(tmp_path, RUN)
+    checkpoint.record_stage('ontarget', filtered)
+    checkpoint.record_plan(['ontarget', 'quality'])
+    progress = checkpoint.search_progress('offtarget', guides.strings())
+    progress.add(0, 10, {guides.strings()[3]})
+    progress.add(20, 30, set())
+    checkpoint.close()
+
+    resumed = Checkpoint(tmp_path, RUN)
+    assert list(resumed.stage_verdicts('ontarget').items()) == list(
+        filtered.items())
+    assert resumed.stage_verdicts('quality') is None
+    assert resumed.planned_order() == ['ontarget', 'quality']
+    progress = resumed.search_progress('offtarget', guides.strings())
+    assert progress.num_done() == 20
+    assert list(progress.gaps()) == [(10, 20), (30, 102)]
+    assert progress.batches[0] == (0, 10, {guides.strings()[3]})
+    assert resumed.search_progress('offtarget',
+                                   guides.strings()[1:]).num_done() == 0
+
+
+def test_record_cut_short_is_discarded(tmp_path):
+    checkpoint = Checkpoint(tmp_path, RUN)
+    checkpoint.record_plan(['quality'])
+    checkpoint.record_plan(['ontarget', 'quality'])
+    checkpoint.close()
+
+    journal = tmp_path / 'journal'
+    journal.write_bytes(journal.read_bytes()[:-3])
+
+    resumed = Checkpoint(tmp_path, RUN)
+    assert resumed.planned_order() == ['quality']
+    resumed.record_plan(['offtarget', 'quality'])
+    resumed.close()
+    assert Checkpoint(tmp_path, RUN).planned_order() == ['offtarget',
+                                                         'quality']
+
+
+def test_checkpoint_of_a_different_run(tmp_path):
+    Checkpoint(tmp_path, RUN).close()
+
+    with pytest.raises(ValueError):
+        Checkpoint(tmp_path, dict(RUN, offtarget_radius=(5, 9, 18)))
@@ -0,0 +1,28 @@
+import pytest
+
+from dashit_filter.compression import detect_compression, open_input, open_output
+
+
+@pytest.mark.parametrize('compression', [None, 'gzip', 'zstd'])
+def test_round_trip(tmp_path, compression):
+    # Several read-ahead chunks, detected from the contents not the name
+    data = bytes(range(256)) * 40000
+    with open_output(str(tmp_path / 'data'), compression) as handle:
+        handle.write(data)
+
+    assert detect_compression(str(tmp_path / 'data')) == compression
+    with open_input(str(tmp_path / 'data')) as handle:
+        assert handle.read(1000) == data[:1000]
+        assert handle.read() == data[1000:]
+
+
+@pytest.mark.parametrize('name, compression',
+                         [('out.txt', None), ('out.txt.gz', 'gzip'),
+                          ('out.txt.zst', 'zstd')])
+def test_compression_from_name(tmp_path, name, compression):
+    with open_output(str(tmp_path / name), mode='w') as handle:
+        handle.write('text\n')
+
+    assert detect_compression(str(tmp_path / name)) == compression
+    with open_input(str(tmp_path / name), 'r') as handle:
+        assert handle.read() == 'text\n'
@@ -0,0 +1,296 @@
+import logging
+import random
+import sys
+
+import pytest
+
+from dashit_filter import dashit_filter
+from dashit_filter.checkpoint import RECORD, STAGE
+from dashit_filter.dashit_filter import (CachedBackend, EmbeddedBackend,
+                                         ExactBackend, build_parser,
+                                         filter_offtargets, filter_ontargets,
+                                         filter_quality, launch_plan,
+                                         plan_stages, quality_filter_parms)
+from dashit_filter.flash import poor_structure
+from dashit_filter.guide_set import FilteredGuides, GuideSet
+from dashit_filter.verdict_cache import VerdictCache
+
+EXACT = (5, 10, 20)
+MISMATCHES = (5, 9, 18)
+
+
+def parse(*argv):
+    return build_parser().parse_args(['input.txt', *argv])
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def mutate(guide, num_mismatches, rng):
+    bases = list(guide)
+    for i in rng.sample(range(20), num_mismatches):
+        bases[i] = rng.choice([base for base in 'ACGT' if base != bases[i]])
+    return ''.join(bases)
+
+
+def matches(guide, site, radius):
+    c5, c10, c20 = radius
+    same = [a == b for a, b in zip(guide, site)]
+    return sum(same[:5]) >= c5 and sum(same[:10]) >= c10 and sum(same) >= c20
+
+
+def guides_and_sites(seed=0):
+    """Guides, some near ontarget or offtarget sites, and the two lists
+    of sites"""
+
+    rng = random.Random(seed)
+    ontargets = random_guides(200, seed=seed + 1)
+    offtargets = random_guides(200, seed=seed + 2)
+    guides = random_guides(50, seed=seed + 3)
+    guides += [mutate(rng.choice(ontargets), rng.randint(0, 3), rng)
+               for _ in range(150)]
+    guides += [mutate(rng.choice(offtargets), rng.randint(0, 3), rng)
+               for _ in range(50)]
+    guides += ['ACGTNACGTACGTACGTACG', ontargets[0][:19] + 'N']
+    return list(dict.fromkeys(guides)), ontargets, offtargets
+
+
+def write_sites(path, sites):
+    path.write_text(''.join(site + '\n' for site in sites))
+    return str(path)
+
+
+def expected_filtering(guides, ontargets, offtargets, radius, filter_parms,
+                       ontarget_filename, offtarget_filename):
+    """Reasons each guide is filtered for, as a dict, checking every
+    site and guide one at a time"""
+
+    reasons = {}
+    for guide in guides:
+        if not any(matches(guide, site, radius) for site in ontargets):
+            reasons[guide] = f'not ontarget in {ontarget_filename}'
+    for guide in guides:
+        if guide not in reasons and any(matches(guide, site, radius)
+                                        for site in offtargets):
+            reasons[guide] = f'offtarget against {offtarget_filename}'
+    for guide in guides:
+        if guide not in reasons:
+            poor = poor_structure(guide, filter_parms, need_explanation=True)
+            if len(poor) > 0:
+                reasons[guide] = poor
+    return reasons
+
+
+@pytest.mark.parametrize('argv, radii, expected', [
+    # Only backends launching a server take a port
+    ([], {'ontarget': EXACT, 'offtarget': MISMATCHES},
+     ({'ontarget': 0, 'offtarget': 0}, False)),
+    (['--offtarget_port', '9000'],
+     {'ontarget': MISMATCHES, 'offtarget': MISMATCHES},
+     ({'ontarget': 0, 'offtarget': 1}, False)),
+    (['--offtarget_endpoint', 'http://host:8080'],
+     {'ontarget': MISMATCHES, 'offtarget': MISMATCHES},
+     ({'ontarget': 0, 'offtarget': 0}, False)),
+    # The stock server only listens on 8080
+    ([], {'ontarget': MISMATCHES, 'offtarget': MISMATCHES},
+     ({'ontarget': 0, 'offtarget': 0}, True)),
+    (['--backend', 'server'], {'ontarget': EXACT, 'offtarget': EXACT},
+     ({'ontarget': 0, 'offtarget': 0}, True)),
+])
+def test_launch_plan(argv, radii, expected):
+    assert launch_plan(parse(*argv), ['ontarget', 'offtarget'],
+                       radii) == expected
+
+
+def test_launch_plan_of_one_stage():
+    assert launch_plan(parse(), ['offtarget'],
+                       {'offtarget': MISMATCHES}) == ({'offtarget': 0}, False)
+
+
+class UnstartableBackend:
+    def start(self):
+        raise AssertionError('backend started')
+
+
+@pytest.mark.parametrize('backend_kind, radius', [
+    ('embedded', EXACT), ('embedded', MISMATCHES), ('embedded', (3, 6, 12)),
+    ('exact', EXACT), ('exact_bloom', EXACT), ('cached', MISMATCHES)])
+def test_backends_match_brute_force(tmp_path, backend_kind, radius):
+    guides, ontargets, offtargets = guides_and_sites()
+    ontarget_file = write_sites(tmp_path / 'on.txt', ontargets)
+    offtarget_file = write_sites(tmp_path / 'off.txt', offtargets)
+    filter_parms = quality_filter_parms(vars(parse()))
+
+    def backend(sites_file):
+        if backend_kind == 'embedded':
+            return EmbeddedBackend(sites_file, radius)
+        if backend_kind == 'exact':
+            return ExactBackend(sites_file, 1 << 30)
+        if backend_kind == 'exact_bloom':
+            return ExactBackend(sites_file, 0)
+        verdict_cache = VerdictCache(tmp_path / 'verdicts.db')
+        return CachedBackend(EmbeddedBackend(sites_file, radius), verdict_cache,
+                             verdict_cache.sites_stage_key(sites_file, radius),
+                             sites_file)
+
+    candidates = GuideSet.from_strings(guides)
+    filtered = FilteredGuides()
+    for filter_stage, sites_file in ((filter_ontargets, ontarget_file),
+                                     (filter_offtargets, offtarget_file)):
+        stage_backend = backend(sites_file)
+        assert stage_backend.start()
+        candidates = filter_stage(candidates, filtered, stage_backend,
+                                  sites_file)
+    candidates = filter_quality(candidates, filtered, filter_parms)
+
+    expected = expected_filtering(guides, ontargets, offtargets, radius,
+                                  filter_parms, ontarget_file, offtarget_file)
+    assert dict(filtered.items()) == expected
+    assert candidates.strings() == [guide for guide in guides
+                                    if guide not in expected]
+
+
+def test_cached_backend_reuses_verdicts(tmp_path):
+    guides, ontargets, _ = guides_and_sites()
+    sites_file = write_sites(tmp_path / 'on.txt', ontargets)
+    verdict_cache = VerdictCache(tmp_path / 'verdicts.db')
+    key = verdict_cache.sites_stage_key(sites_file, MISMATCHES)
+
+    backend = CachedBackend(EmbeddedBackend(sites_file, MISMATCHES),
+                            verdict_cache, key, 'ontarget')
+    matched = backend.search(guides[:200])
+    assert backend.started
+
+    # Guides already seen never start the backend
+    cached = CachedBackend(UnstartableBackend(), verdict_cache, key,
+                           'ontarget')
+    assert cached.search(guides[:200]) == matched
+    assert cached.search(guides[100:200]) == {
+        guide: True for guide in guides[100:200] if guide in matched}
+    assert not cached.started
+    assert matched == {guide: True for guide in guides[:200]
+                       if any(matches(guide, site, MISMATCHES)
+                              for site in ontargets)}
+
+
+def test_plan_stages_sorts_on_cost_per_rejection():
+    guides = GuideSet.from_strings(random_guides(500))
+    filter_parms = quality_filter_parms(vars(parse()))
+    radii = {'ontarget': MISMATCHES, 'offtarget': MISMATCHES}
+
+    # Quality filtering costs microseconds a guide
+    estimates = {'ontarget': (1.0, 0.5), 'offtarget': (1e-12, 0.5)}
+    assert plan_stages(['ontarget', 'offtarget', 'quality'], guides,
+                       filter_parms, radii, estimates=estimates) == [
+                           'offtarget', 'quality', 'ontarget']
+
+    # Without estimates, mismatch searches cost more than quality
+    assert plan_stages(['ontarget', 'offtarget', 'quality'], guides,
+                       filter_parms, radii)[0] == 'quality'
+
+
+def sites_to_reads_file(path, guides, seed=0):
+    """A text sites-to-reads file of `guides`, some on several lines"""
+
+    rng = random.Random(seed)
+    lines = [rng.choice(guides) + '\t' + ' '.join(
+        str(rng.randrange(1000)) for _ in range(rng.randint(1, 4))) + '\n'
+             for _ in range(2 * len(guides))]
+    path.write_text('Total number of reads: 1000\n' + ''.join(lines))
+    return str(path)
+
+
+def run(monkeypatch, tmp_path, *argv, name='run'):
+    """Run dashit_filter, returns the output and --filtered_explanation"""
+
+    output = tmp_path / f'{name}.txt'
+    explanation = tmp_path / f'{name}.csv'
+    monkeypatch.setattr(sys, 'argv', [
+        'dashit_filter', *argv, '--output', str(output),
+        '--filtered_explanation', str(explanation)])
+    dashit_filter.main()
+    return output.read_text(), explanation.read_text()
+
+
+@pytest.fixture
+def run_files(tmp_path):
+    guides, ontargets, offtargets = guides_and_sites()
+    return (sites_to_reads_file(tmp_path / 's2r.txt', guides),
+            write_sites(tmp_path / 'on.txt', ontargets),
+            write_sites(tmp_path / 'off.txt', offtargets))
+
+
+def test_main_matches_brute_force(monkeypatch, tmp_path, run_files):
+    input_file, ontarget_file, offtarget_file = run_files
+    guides, ontargets, offtargets = guides_and_sites()
+    radius_args = ['--ontarget_radius', '5_9_18', '--offtarget_radius',
+                   '5_9_18']
+
+    output, explanation = run(
+        monkeypatch, tmp_path, input_file, '--ontarget', ontarget_file,
+        '--offtarget', offtarget_file, '--backend', 'embedded', *radius_args)
+
+    reasons = expected_filtering(
+        list(dict.fromkeys(line[:20] for line in open(input_file).readlines()[1:])),
+        ontargets, offtargets, MISMATCHES,
+        quality_filter_parms(vars(parse())), ontarget_file, offtarget_file)
+    lines = open(input_file).readlines()
+    assert output == lines[0] + ''.join(line for line in lines[1:]
+                                        if line[:20] not in reasons)
+    assert explanation == 'candidate guide, why it was filtered out\n' + ''.join(
+        f'{guide}, {reason}\n' for guide, reason in reasons.items())
+
+    # The same guides are kept however stages are run
+    for options in (['--pipelined'], ['--stage_order', 'planned'],
+                    ['--jobs', '2'], ['--stream']):
+        assert run(monkeypatch, tmp_path, input_file, '--ontarget',
+                   ontarget_file, '--offtarget', offtarget_file, '--backend',
+                   'embedded', *radius_args, *options,
+                   name='other')[0] == output
+
+
+@pytest.mark.parametrize('completed_stages', [0, 1, 2])
+def test_resumed_checkpoint_matches_uninterrupted_run(monkeypatch, tmp_path,
+                                                       caplog, run_files,
+                                                       completed_stages):
+    input_file, ontarget_file, offtarget_file = run_files
+    argv = [input_file, '--ontarget', ontarget_file, '--offtarget',
+            offtarget_file, '--backend', 'embedded', '--checkpoint_dir',
+            str(tmp_path / 'checkpoint')]
+
+    uninterrupted = run(monkeypatch, tmp_path, *argv)
+
+    # Keep the first stages of the journal, as if the run was killed
+    # during the next one, with a record cut short
+    journal = tmp_path / 'checkpoint' / 'journal'
+    data = journal.read_bytes()
+    position = 0
+    for _ in range(completed_stages):
+        kind, length, _ = RECORD.unpack_from(data, position)
+        assert kind == STAGE
+        position += RECORD.size + length
+    journal.write_bytes(data[:position + 5])
+
+    caplog.clear()
+    caplog.set_level(logging.INFO)
+    assert run(monkeypatch, tmp_path, *argv, name='resumed') == uninterrupted
+    assert sum(message.startswith('Skipping') for message in
+               caplog.messages) == completed_stages
+
+
+def test_sweep_select_matches_filtering_with_the_setting(monkeypatch, tmp_path,
+                                                          run_files):
+    input_file, _, offtarget_file = run_files
+    argv = [input_file, '--offtarget', offtarget_file, '--backend', 'embedded']
+
+    expected = run(monkeypatch, tmp_path, *argv, '--homopolymer', '3',
+                   '--gc_freq_min', '6')
+
+    for _ in range(2):
+        # Structure features are computed, then read back from --features
+        assert run(monkeypatch, tmp_path, *argv, '--sweep', 'homopolymer=4,3',
+                   '--sweep', 'gc_freq_min=5,6', '--sweep_select', '3',
+                   '--features', str(tmp_path / 'features.npz'),
+                   name='sweep') == expected
@@ -0,0 +1,58 @@
+import random
+
+import numpy as np
+import pytest
+
+from dashit_filter.encoding import encode_kmers, pack_codes
+from dashit_filter.exact_match import BloomFilter, ExactMatcher, PackedHashSet
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def test_packed_hash_set_matches_python_set():
+    rng = np.random.default_rng(0)
+    keys = rng.integers(0, 2**40, 5000, dtype=np.uint64)
+    others = rng.integers(0, 2**40, 5000, dtype=np.uint64)
+
+    # Starting small, so the table grows as keys are added
+    hash_set = PackedHashSet(10)
+    for chunk in np.array_split(np.concatenate([keys, keys[:100]]), 7):
+        hash_set.add(chunk)
+
+    expected = set(keys.tolist())
+    assert len(hash_set) == len(expected)
+    assert hash_set.contains(keys).all()
+    assert hash_set.contains(others).tolist() == [key in expected
+                                                  for key in others.tolist()]
+
+
+def test_bloom_filter_has_no_false_negatives():
+    rng = np.random.default_rng(1)
+    keys = rng.integers(0, 2**40, 5000, dtype=np.uint64)
+    others = rng.integers(0, 2**40, 5000, dtype=np.uint64)
+
+    bloom = BloomFilter(len(keys))
+    bloom.add(keys)
+
+    assert bloom.contains(keys).all()
+    assert bloom.contains(others).mean() < 0.05
+
+
+@pytest.mark.parametrize('max_memory', [1 << 30, 0])
+def test_exact_matcher(tmp_path, max_memory):
+    sites = random_guides(2000)
+    (tmp_path / 'sites.txt').write_text(
+        ''.join(site + '\n' for site in sites + ['ACGTNACGTACGTACGTACG']))
+    guides = (random_guides(500, seed=1) + sites[::7] +
+              ['ACGTNACGTACGTACGTACG', 'ACGT'])
+
+    # With no memory for a hash set, matched with a Bloom filter
+    matcher = ExactMatcher(str(tmp_path / 'sites.txt'), max_memory)
+
+    expected = [guide in set(sites) for guide in guides]
+    assert matcher.search(guides).tolist() == expected
+    assert matcher.search_packed(
+        pack_codes(encode_kmers(guides[:-2]))).tolist() == expected[:-2]
@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+from dashit_filter.features import StructureFeatures
+from dashit_filter.flash_batch import poor_structure_batch
+from dashit_filter.guide_set import GuideSet
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def filter_params(gc_min=5, gc_max=15, homopolymer=5, dinucleotide=3,
+                  min_inner=3, min_outer=5):
+    return {'gc_frequency': (gc_min, gc_max), 'homopolymer': homopolymer,
+            'dinucleotide_repeats': dinucleotide,
+            'hairpin': {'min_inner': min_inner, 'min_outer': min_outer}}
+
+
+@pytest.mark.parametrize('params', [
+    filter_params(), filter_params(gc_min=7, gc_max=12),
+    filter_params(homopolymer=3, dinucleotide=2),
+    filter_params(min_inner=0, min_outer=0), filter_params(min_outer=4),
+    filter_params(min_inner=6, min_outer=3), filter_params(min_inner=21)])
+def test_poor_matches_poor_structure_batch(params):
+    guides = random_guides(2000)
+    features = StructureFeatures.extract(GuideSet.from_strings(guides))
+
+    assert (features.poor(params).tolist() ==
+            poor_structure_batch(guides, params).tolist())
+
+
+def test_save_and_load(tmp_path):
+    guides = GuideSet.from_strings(random_guides(300))
+    StructureFeatures.extract(guides).save(str(tmp_path / 'features'))
+
+    features = StructureFeatures.load(str(tmp_path / 'features'))
+
+    assert features.guides.strings() == guides.strings()
+    assert (features.poor(filter_params(homopolymer=3)).tolist() ==
+            poor_structure_batch(guides.strings(),
+                                 filter_params(homopolymer=3)).tolist())
@@ -0,0 +1,26 @@
+import random
+
+import pytest
+
+from dashit_filter.flash import find_hairpin, find_hairpin_strings
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+@pytest.mark.parametrize('min_outer, min_inner', [(5, 3), (0, 0), (4, 21)])
+def test_find_hairpin_matches_find_hairpin_strings(min_outer, min_inner):
+    for guide in random_guides(500):
+        assert (find_hairpin(guide, min_inner, min_outer) ==
+                find_hairpin_strings(guide, min_inner, min_outer))
+
+
+@pytest.mark.parametrize('kmer', ['ACGTACGTACGTACGTACG ',
+                                  ' ACGTACGTACGTACGTACG',
+                                  '+CGTACGTACGTACGTACGT',
+                                  'ACGTNACGTACGTACGTACG',
+                                  'ACGTACGTACGTACGTACG'])
+def test_find_hairpin_of_other_characters(kmer):
+    assert find_hairpin(kmer) == find_hairpin_strings(kmer)
@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from dashit_filter.encoding import encode_kmers
+from dashit_filter.flash import find_hairpin_strings, poor_structure
+from dashit_filter.flash_batch import hairpin_table, poor_structure_batch
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+@pytest.mark.parametrize('min_outer, min_inner',
+                         [(0, 0), (0, 3), (1, 0), (5, 3), (4, 21)])
+def test_first_hairpin_matches_find_hairpin_strings(min_outer, min_inner):
+    guides = random_guides(500)
+    table = hairpin_table(min_outer, min_inner)
+
+    windows = table.first_hairpin(encode_kmers(guides))
+
+    for guide, window in zip(guides, windows.tolist()):
+        expected = find_hairpin_strings(guide, min_inner, min_outer)
+        found = table.explanation(guide, window) if window >= 0 else ''
+        assert found == expected
+
+
+def test_poor_structure_batch_with_min_outer_0():
+    guides = random_guides(200, seed=1) + ['ACGTNACGTACGTACGTACG']
+    filter_params = {'gc_frequency': (5, 15), 'homopolymer': 5,
+                     'dinucleotide_repeats': 3,
+                     'hairpin': {'min_inner': 3, 'min_outer': 0}}
+
+    explanations = poor_structure_batch(guides, filter_params,
+                                        need_explanation=True)
+
+    assert explanations == [poor_structure(guide, filter_params,
+                                           need_explanation=True)
+                            for guide in guides]
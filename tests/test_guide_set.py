@@ -0,0 +1,85 @@
+import random
+
+import numpy as np
+
+from dashit_filter.guide_set import FilteredGuides, GuideSet
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+INVALID = ['ACGTNACGTACGTACGTACG', 'ACGT', 'NNNNNNNNNNNNNNNNNNNNNN']
+
+
+def test_strings_round_trip():
+    guides = random_guides(300) + INVALID
+
+    guide_set = GuideSet.from_strings(guides)
+
+    assert guide_set.strings() == guides
+    assert list(guide_set) == guides
+    assert guide_set.strings(290, 302) == guides[290:302]
+    assert guide_set.invalid_guides == INVALID
+    assert GuideSet.from_strings([guide.encode('ascii')
+                                  for guide in guides]).strings() == guides
+
+
+def test_set_operations_match_python_sets():
+    guides = random_guides(300) + INVALID
+    guide_set = GuideSet.from_strings(guides)
+    selected = guide_set[np.arange(0, len(guides), 3)]
+    expected = set(guides[::3])
+
+    assert selected.contains(guide_set.packed).tolist() == [
+        guide in expected for guide in guides]
+    assert guide_set.difference(selected).strings() == [
+        guide for guide in guides if guide not in expected]
+    assert guide_set.intersection(selected).strings() == guides[::3]
+
+
+def test_filtered_guides():
+    guides = random_guides(100) + INVALID
+    guide_set = GuideSet.from_strings(guides)
+
+    filtered = FilteredGuides()
+    filtered.add(guide_set[:10], 'first')
+    filtered.add(guide_set[100:], ['second', ['third', 'fourth'], 'second'])
+
+    expected = ([(guide, 'first') for guide in guides[:10]] +
+                list(zip(INVALID, ['second', ['third', 'fourth'], 'second'])))
+    assert list(filtered.items()) == expected
+    assert list(filtered.items(9)) == expected[9:]
+    assert list(filtered.since(10).items()) == expected[10:]
+    assert filtered.guides().strings() == guides[:10] + INVALID
+    assert list(filtered.subset(guide_set[5:101]).items()) == (
+        expected[5:11])
+
+    packed, codes = filtered.arrays()
+    copy = FilteredGuides.from_arrays(packed, codes, filtered.reasons,
+                                      filtered.invalid_guides)
+    assert list(copy.items()) == expected
+
+
+def test_filtered_guides_update():
+    guides = random_guides(50) + INVALID
+    guide_set = GuideSet.from_strings(guides)
+
+    first = FilteredGuides()
+    first.add(guide_set[[0, 51]], 'first')
+    second = FilteredGuides()
+    second.add(guide_set[[1, 50]], 'second')
+
+    filtered = FilteredGuides()
+    filtered.update(first)
+    filtered.update(second)
+    # Guides of another set, listing its invalid guides differently
+    filtered.update({INVALID[2]: 'third', 'ACG': 'third'})
+
+    assert list(filtered.items()) == [
+        (guides[0], 'first'), (INVALID[1], 'first'),
+        (guides[1], 'second'), (INVALID[0], 'second'),
+        (INVALID[2], 'third'), ('ACG', 'third')]
+    assert guide_set.contains(filtered.guides().packed).tolist() == [
+        True, True, True, True, True, False]
@@ -0,0 +1,87 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from dashit_filter import index_cache
+from dashit_filter.index_cache import IndexCache, directory_size
+from dashit_filter.offtarget_index import OfftargetIndex
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+@pytest.fixture
+def sites_file(tmp_path):
+    sites = random_guides(500)
+    path = tmp_path / 'sites.txt'
+    path.write_text(''.join(site + '\n' for site in
+                            sites + sites[:50] + ['ACGTNACGTACGTACGTACG']))
+    return str(path)
+
+
+def test_load_index_from_cache(tmp_path, sites_file, monkeypatch):
+    radius = (5, 9, 18)
+    guides = random_guides(300, seed=1)
+    expected = OfftargetIndex.from_file(sites_file, radius).search(guides)
+
+    cache = IndexCache(tmp_path / 'cache', 1 << 30)
+    assert cache.load_index(sites_file, radius).search(guides).tolist() == (
+        expected.tolist())
+
+    # Reused, memory-mapped, rather than built again
+    def build(*args):
+        raise AssertionError('index built again')
+
+    monkeypatch.setattr(index_cache.OfftargetIndex, 'from_file', build)
+    index = IndexCache(tmp_path / 'cache', 1 << 30).load_index(sites_file,
+                                                               radius)
+    assert isinstance(index.sites, np.memmap)
+    assert index.search(guides).tolist() == expected.tolist()
+
+
+def test_changed_sites_file_is_indexed_again(tmp_path, sites_file):
+    radius = (5, 10, 20)
+    cache = IndexCache(tmp_path / 'cache', 1 << 30)
+    site = random_guides(1, seed=2)[0]
+
+    assert cache.load_index(sites_file, radius).search([site]).tolist() == [
+        False]
+
+    with open(sites_file, 'a') as handle:
+        handle.write(site + '\n')
+
+    assert cache.load_index(sites_file, radius).search([site]).tolist() == [
+        True]
+
+
+def test_sites_file(tmp_path, sites_file):
+    cache = IndexCache(tmp_path / 'cache', 1 << 30)
+
+    with open(cache.sites_file(sites_file)) as handle:
+        cached_sites = handle.read().split()
+
+    with open(sites_file) as handle:
+        sites = handle.read().split()
+    assert sorted(cached_sites) == sorted(set(sites))
+
+
+def test_evict_least_recently_used(tmp_path, sites_file):
+    cache = IndexCache(tmp_path / 'cache', 1 << 30)
+    radii = [(5, 10, 20), (5, 9, 18), (4, 8, 16)]
+    for i, radius in enumerate(radii):
+        cache.load_index(sites_file, radius)
+        entry = tmp_path / 'cache' / '{}_{}_{}_{}'.format(
+            cache.sites_digest(sites_file), *radius)
+        os.utime(entry, (i, i))
+
+    entries = {radius: tmp_path / 'cache' / '{}_{}_{}_{}'.format(
+        cache.sites_digest(sites_file), *radius) for radius in radii}
+    cache.max_bytes = (directory_size(entries[(5, 9, 18)]) +
+                       directory_size(entries[(4, 8, 16)]))
+    cache.evict()
+
+    assert [entries[radius].is_dir() for radius in radii] == [False, True, True]
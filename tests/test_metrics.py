@@ -0,0 +1,35 @@
+import time
+
+from dashit_filter.metrics import RunMetrics, query_estimates
+
+
+def test_nested_stage_time_is_left_out_of_the_outer_stage():
+    metrics = RunMetrics()
+
+    with metrics.stage('queries'):
+        with metrics.stage('startup'):
+            time.sleep(0.2)
+        time.sleep(0.05)
+
+    wall = {record['stage']: record['wall_seconds']
+            for record in metrics.report()['stages']}
+    assert [record['stage'] for record in metrics.stages] == ['startup',
+                                                              'queries']
+    assert wall['startup'] >= 0.2
+    assert 0.05 <= wall['queries'] < 0.2
+
+
+def test_query_estimates_of_a_report(tmp_path):
+    metrics = RunMetrics()
+    with metrics.stage('ontarget_queries', guides_in=100) as record:
+        record['guides_out'] = 25
+    with metrics.stage('quality', guides_in=25) as record:
+        record['guides_out'] = 20
+    metrics.write(tmp_path / 'metrics.json')
+
+    estimates = query_estimates(tmp_path / 'metrics.json')
+
+    assert list(estimates) == ['ontarget']
+    seconds, rejected = estimates['ontarget']
+    assert seconds >= 0
+    assert rejected == 0.75
@@ -0,0 +1,138 @@
+import asyncio
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from dashit_filter import offtarget_client
+from dashit_filter.offtarget_client import (OfftargetClient,
+                                            OfftargetSearchError)
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+SITES = set(random_guides(50, seed=1))
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Exact matching against `SITES`, as the offtarget server answers it"""
+
+    # Status POST queries are answered with, and number of queries to
+    # fail with HTTP 500 before answering again
+    post_status = 200
+    failures = 0
+    requests = []
+
+    def log_message(self, *args):
+        pass
+
+    def answer(self, query):
+        type(self).requests.append(self.command)
+        if type(self).failures > 0:
+            type(self).failures -= 1
+            return self.reply(500, b'')
+        targets = query['targets'][0].split(',')
+        self.reply(200, ''.join(f'{target} {str(target in SITES).lower()}\n'
+                                for target in targets).encode('ascii'))
+
+    def reply(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if self.post_status != 200:
+            type(self).requests.append(self.command)
+            return self.reply(self.post_status, b'')
+        self.answer(parse_qs(body.decode('ascii')))
+
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setattr(offtarget_client, 'BACKOFF', 0.01)
+
+    handler = type('TestHandler', (Handler,), {'requests': []})
+    httpd = ThreadingHTTPServer(('localhost', 0), handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield handler, f'http://localhost:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def guides_to_search():
+    return random_guides(500, seed=2) + sorted(SITES)[:20]
+
+
+def expected(guides):
+    return {guide: True for guide in guides if guide in SITES}
+
+
+def test_search(server):
+    handler, url = server
+    guides = guides_to_search()
+
+    client = OfftargetClient(url, '5,10,20', window=2, batch_size=100)
+
+    assert client.search(guides) == expected(guides)
+    assert set(handler.requests) == {'POST'}
+
+
+@pytest.mark.parametrize('status', [405, 500, 501])
+def test_search_falls_back_to_get(server, status):
+    handler, url = server
+    handler.post_status = status
+    guides = guides_to_search()
+
+    client = OfftargetClient(url, '5,10,20', batch_size=100)
+
+    assert client.search(guides) == expected(guides)
+    assert handler.requests.count('POST') == 1
+
+
+def test_search_retries_failed_batches(server):
+    handler, url = server
+    guides = guides_to_search()
+
+    client = OfftargetClient(url, '5,10,20', batch_size=100)
+    client.search(guides[:10])
+    handler.failures = 2
+
+    assert client.search(guides) == expected(guides)
+    assert client.use_post
+
+
+def test_search_gives_up_after_retries(server):
+    handler, url = server
+    guides = guides_to_search()
+
+    client = OfftargetClient(url, '5,10,20', retries=1, batch_size=100)
+    client.search(guides[:10])
+    handler.failures = 2
+
+    with pytest.raises(OfftargetSearchError) as error:
+        client.search(guides)
+
+    # Resuming searches the batches that didn't complete
+    assert (client.search(guides, progress=error.value.progress) ==
+            expected(guides))
+
+
+def test_search_in_running_event_loop(server):
+    handler, url = server
+    guides = guides_to_search()
+
+    async def search():
+        return OfftargetClient(url, '5,10,20').search(guides)
+
+    assert asyncio.run(search()) == expected(guides)
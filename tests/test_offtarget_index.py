@@ -0,0 +1,58 @@
+import random
+
+import numpy as np
+import pytest
+
+from dashit_filter.encoding import encode_kmers, pack_codes
+from dashit_filter.offtarget_index import OfftargetIndex
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def mutate(guide, num_mismatches, rng):
+    bases = list(guide)
+    for i in rng.sample(range(20), num_mismatches):
+        bases[i] = rng.choice([base for base in 'ACGT' if base != bases[i]])
+    return ''.join(bases)
+
+
+def matches(guide, site, radius):
+    c5, c10, c20 = radius
+    same = [a == b for a, b in zip(guide, site)]
+    return sum(same[:5]) >= c5 and sum(same[:10]) >= c10 and sum(same) >= c20
+
+
+def guides_and_sites(seed=0):
+    """Random sites, and guides near some of them"""
+
+    rng = random.Random(seed)
+    sites = random_guides(300, seed=seed)
+    guides = random_guides(100, seed=seed + 1)
+    guides += [mutate(rng.choice(sites), rng.randint(0, 8), rng)
+               for _ in range(200)]
+    guides += ['ACGTNACGTACGTACGTACG', sites[0][:19] + 'N']
+    return guides, sites
+
+
+@pytest.mark.parametrize('radius', [(5, 10, 20), (5, 9, 18), (4, 8, 16),
+                                    (3, 6, 12), (0, 0, 1), (2, 4, 0),
+                                    (0, 0, 0), (0, 0, -3)])
+def test_search_matches_brute_force(radius):
+    guides, sites = guides_and_sites()
+    index = OfftargetIndex(np.unique(pack_codes(encode_kmers(sites))), radius)
+
+    expected = [any(matches(guide, site, radius) for site in sites)
+                for guide in guides]
+
+    assert index.search(guides).tolist() == expected
+
+
+def test_search_with_no_matching_position_needed():
+    sites = ['A' * 20, 'C' * 20]
+    index = OfftargetIndex(np.unique(pack_codes(encode_kmers(sites))),
+                           (0, 0, 0))
+
+    assert index.search(['G' * 20, 'T' * 20, 'N' * 20]).tolist() == [True] * 3
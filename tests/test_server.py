@@ -0,0 +1,137 @@
+import asyncio
+import random
+import threading
+
+import pytest
+
+from dashit_filter.dashit_filter import RemoteBackend, offtarget_session
+from dashit_filter.endpoints import endpoint_url, free_port, parse_endpoint
+from dashit_filter.index_cache import file_digest
+from dashit_filter.offtarget_client import (OfftargetClient,
+                                            OfftargetSearchError,
+                                            SearchProgress)
+from dashit_filter.server import SitesService, make_server
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def matches(guide, site, radius):
+    c5, c10, c20 = radius
+    same = [a == b for a, b in zip(guide, site)]
+    return sum(same[:5]) >= c5 and sum(same[:10]) >= c10 and sum(same) >= c20
+
+
+SITES = random_guides(300)
+
+
+@pytest.fixture(params=['tcp', 'unix'])
+def served(request, tmp_path):
+    """Endpoint of a server of a sites file, and the sites file"""
+
+    sites_file = tmp_path / 'sites.txt'
+    sites_file.write_text(''.join(site + '\n' for site in SITES))
+
+    if request.param == 'unix':
+        endpoint = f'unix:{tmp_path}/sites.sock'
+    else:
+        endpoint = f'localhost:{free_port()}'
+
+    server = make_server(endpoint, SitesService(str(sites_file)))
+    thread = threading.Thread(target=server.serve_forever, args=(0.01,),
+                              daemon=True)
+    thread.start()
+    yield endpoint, str(sites_file)
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.mark.parametrize('endpoint, expected', [
+    ('8081', ('tcp', ('localhost', 8081))),
+    ('host:8081', ('tcp', ('host', 8081))),
+    ('http://host:8081', ('tcp', ('host', 8081))),
+    ('unix:/tmp/offtarget.sock', ('unix', '/tmp/offtarget.sock')),
+])
+def test_parse_endpoint(endpoint, expected):
+    assert parse_endpoint(endpoint) == expected
+
+
+def test_info(served):
+    endpoint, sites_file = served
+
+    info = offtarget_session().get(endpoint_url(endpoint) + '/info').json()
+
+    assert info['sha256'] == file_digest(sites_file)
+
+
+@pytest.mark.parametrize('radius', [(5, 10, 20), (5, 9, 18), (3, 6, 12)])
+def test_remote_backend_matches_brute_force(served, radius):
+    endpoint, sites_file = served
+    guides = random_guides(200, seed=1) + SITES[::10]
+
+    backend = RemoteBackend(endpoint, sites_file, radius, batch_size=50)
+    assert backend.start()
+
+    assert backend.search(guides) == {
+        guide: True for guide in guides
+        if any(matches(guide, site, radius) for site in SITES)}
+
+
+def test_search_get_and_post(served):
+    endpoint, _ = served
+    url = endpoint_url(endpoint) + '/search'
+    guides = SITES[:3] + random_guides(3, seed=2)
+    expected = ''.join(f'{guide} {str(i < 3).lower()}\n'
+                       for i, guide in enumerate(guides))
+
+    query = {'targets': ','.join(guides), 'limits': '5,10,20'}
+    assert offtarget_session().post(url, data=query).text == expected
+    assert offtarget_session().get(url, params=query).text == expected
+    assert offtarget_session().get(url, params={
+        'targets': guides[0]}).status_code == 400
+
+
+def test_remote_backend_checks_sites_file(served, tmp_path):
+    endpoint, _ = served
+    other = tmp_path / 'other.txt'
+    other.write_text(''.join(site + '\n' for site in SITES[1:]))
+
+    assert not RemoteBackend(endpoint, str(other), (5, 10, 20)).start()
+
+
+def test_client_matches_brute_force(served):
+    endpoint, _ = served
+    guides = random_guides(200, seed=3) + SITES[::10]
+    expected = {guide: True for guide in guides if guide in SITES}
+
+    # Batches spread over several connections
+    client = OfftargetClient(endpoint_url(endpoint), '5,10,20', window=3,
+                             batch_size=17)
+    assert client.search(guides) == expected
+
+    # Also when called from a coroutine
+    async def search():
+        return client.search(guides)
+
+    assert asyncio.run(search()) == expected
+
+
+def test_client_resumes_failed_search(served):
+    endpoint, _ = served
+    guides = random_guides(100, seed=4) + SITES[::10]
+
+    with pytest.raises(OfftargetSearchError) as error:
+        OfftargetClient(f'http://localhost:{free_port()}', '5,10,20',
+                        retries=0, batch_size=20).search(guides)
+    progress = error.value.progress
+    assert list(progress.gaps()) == [(0, len(guides))]
+
+    # Batches that completed aren't searched again
+    progress = SearchProgress(len(guides))
+    progress.add(0, 50, set(guides[:50]))
+    resumed = OfftargetClient(endpoint_url(endpoint), '5,10,20',
+                              batch_size=20).search(guides, progress)
+    assert resumed == {guide: True for guide in guides[:50]} | {
+        guide: True for guide in guides[50:] if guide in SITES}
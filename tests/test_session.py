@@ -0,0 +1,88 @@
+import random
+import sys
+
+import pytest
+
+from dashit_filter import dashit_filter
+from dashit_filter.guide_set import GuideSet
+from dashit_filter.session import DashitFilter
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def mutate(guide, num_mismatches, rng):
+    bases = list(guide)
+    for i in rng.sample(range(20), num_mismatches):
+        bases[i] = rng.choice([base for base in 'ACGT' if base != bases[i]])
+    return ''.join(bases)
+
+
+@pytest.fixture
+def files(tmp_path):
+    """Guides, a sites-to-reads file of them and ontarget and offtarget
+    sites files"""
+
+    rng = random.Random(0)
+    ontargets = random_guides(200, seed=1)
+    offtargets = random_guides(200, seed=2)
+    guides = random_guides(50, seed=3)
+    guides += [mutate(rng.choice(ontargets), rng.randint(0, 3), rng)
+               for _ in range(150)]
+    guides += [mutate(rng.choice(offtargets), rng.randint(0, 3), rng)
+               for _ in range(50)]
+    guides += ['ACGTNACGTACGTACGTACG', ontargets[0][:19] + 'N', guides[0]]
+
+    (tmp_path / 's2r.txt').write_text('Total number of reads: 1000\n' + ''.join(
+        f'{guide}\t{i}\n' for i, guide in enumerate(guides)))
+    for name, sites in (('on.txt', ontargets), ('off.txt', offtargets)):
+        (tmp_path / name).write_text(''.join(site + '\n' for site in sites))
+
+    return (guides, str(tmp_path / 's2r.txt'), str(tmp_path / 'on.txt'),
+            str(tmp_path / 'off.txt'))
+
+
+@pytest.mark.parametrize('options', [
+    {'backend': 'embedded'},
+    {'backend': 'embedded', 'ontarget_radius': '5_9_18',
+     'offtarget_radius': '4_8_16', 'homopolymer': 4},
+    {'jobs': 2, 'verdict_cache': 'verdicts.db'},
+])
+def test_session_matches_command_line(monkeypatch, tmp_path, files, options):
+    guides, input_file, ontarget_file, offtarget_file = files
+    monkeypatch.chdir(tmp_path)
+
+    argv = [input_file, '--ontarget', ontarget_file, '--offtarget',
+            offtarget_file]
+    for name, value in options.items():
+        argv += [f'--{name}', str(value)]
+    monkeypatch.setattr(sys, 'argv', [
+        'dashit_filter', *argv, '--output', 'out.txt',
+        '--filtered_explanation', 'explanation.csv'])
+    dashit_filter.main()
+    kept_lines = (tmp_path / 'out.txt').read_text().splitlines()[1:]
+    explanation = (tmp_path / 'explanation.csv').read_text()
+
+    if 'homopolymer' in options:
+        options = dict(options, homopolymer=int(options['homopolymer']))
+    with DashitFilter(ontarget=ontarget_file, offtarget=offtarget_file,
+                      **options) as session:
+        for _ in range(2):
+            kept, reasons = session.filter(guides)
+            assert kept == [line[:20] for line in kept_lines]
+            assert explanation == (
+                'candidate guide, why it was filtered out\n' +
+                ''.join(f'{guide}, {reason}\n'
+                        for guide, reason in reasons.items()))
+
+        kept_set, set_reasons = session.filter(
+            GuideSet.from_strings(list(dict.fromkeys(guides))))
+        assert kept_set.strings() == list(dict.fromkeys(kept))
+        assert set_reasons == reasons
+
+
+def test_session_rejects_run_options():
+    with pytest.raises(TypeError):
+        DashitFilter(pipelined=True)
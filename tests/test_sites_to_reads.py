@@ -0,0 +1,147 @@
+import io
+import random
+
+import numpy as np
+import pytest
+
+from dashit_filter.compression import open_input, open_output
+from dashit_filter.guide_set import GuideSet
+from dashit_filter.sites_to_reads import (SitesToReads, TextLines, convert_main,
+                                          convert_text, copy_ranges,
+                                          read_keep_mask, write_keep_mask)
+
+
+def random_guides(n, seed=0):
+    rng = random.Random(seed)
+    return [''.join(rng.choice('ACGT') for _ in range(20)) for _ in range(n)]
+
+
+def sites_to_reads_text(num_lines=500, seed=0, guide_separator='\t',
+                        read_separator=' '):
+    """A text sites-to-reads file, with repeated guides and lines
+    without read ids"""
+
+    rng = random.Random(seed)
+    guides = random_guides(num_lines // 2, seed=seed)
+    lines = []
+    for _ in range(num_lines):
+        ids = [str(rng.randrange(2**rng.choice([7, 14, 40])))
+               for _ in range(rng.randint(0, 5))]
+        guide = rng.choice(guides)
+        lines.append(guide + guide_separator + read_separator.join(ids) + '\n'
+                     if ids else guide + '\n')
+    return 'Total number of reads: 1234\n' + ''.join(lines)
+
+
+@pytest.mark.parametrize('guide_separator, read_separator',
+                         [('\t', ' '), (' ', ' '), ('\t', '\t')])
+def test_convert_text_round_trip(tmp_path, guide_separator, read_separator):
+    text = sites_to_reads_text(guide_separator=guide_separator,
+                               read_separator=read_separator)
+    with open(tmp_path / 's2r.bin', 'wb') as handle:
+        convert_text(io.StringIO(text), handle)
+
+    sites = SitesToReads(tmp_path / 's2r.bin')
+
+    assert sites.total_reads == 1234
+    assert sites.header_line + ''.join(sites.text_lines()) == text
+
+
+def test_convert_text_rejects_other_bases(tmp_path):
+    text = 'Total number of reads: 1\nACGTNACGTACGTACGTACG\t0\n'
+
+    with pytest.raises(ValueError):
+        convert_text(io.StringIO(text), io.BytesIO())
+
+
+@pytest.mark.parametrize('extension', ['', '.gz', '.zst'])
+def test_convert_main_round_trip(tmp_path, extension):
+    text = sites_to_reads_text()
+    with open_output(str(tmp_path / ('s2r.txt' + extension)),
+                     mode='w') as handle:
+        handle.write(text)
+
+    convert_main([str(tmp_path / ('s2r.txt' + extension)),
+                  str(tmp_path / 's2r.bin')])
+    convert_main([str(tmp_path / 's2r.bin'),
+                  str(tmp_path / ('back.txt' + extension))])
+
+    with open_input(str(tmp_path / ('back.txt' + extension)), 'r') as handle:
+        assert handle.read() == text
+
+
+def test_convert_main_keep_mask(tmp_path):
+    text = sites_to_reads_text()
+    lines = text.splitlines(keepends=True)
+    keep = np.random.default_rng(0).random(len(lines) - 1) < 0.5
+    (tmp_path / 's2r.txt').write_text(text)
+    write_keep_mask(tmp_path / 'keep.mask', keep)
+
+    assert read_keep_mask(tmp_path / 'keep.mask').tolist() == keep.tolist()
+
+    convert_main([str(tmp_path / 's2r.txt'), str(tmp_path / 's2r.bin'),
+                  '--keep_mask', str(tmp_path / 'keep.mask')])
+    convert_main([str(tmp_path / 's2r.bin'), str(tmp_path / 'back.txt')])
+
+    assert (tmp_path / 'back.txt').read_text() == lines[0] + ''.join(
+        line for line, is_kept in zip(lines[1:], keep) if is_kept)
+
+
+def test_sites_to_reads_subset(tmp_path):
+    text = sites_to_reads_text()
+    lines = text.splitlines(keepends=True)[1:]
+    with open(tmp_path / 's2r.bin', 'wb') as handle:
+        convert_text(io.StringIO(text), handle)
+    sites = SitesToReads(tmp_path / 's2r.bin')
+    guides = [line[:20] for line in lines]
+    distinct = list(dict.fromkeys(guides))
+
+    assert sites.unique_guides().strings() == distinct
+    assert sites.line_counts().tolist() == [guides.count(guide)
+                                            for guide in distinct]
+
+    rejected = GuideSet.from_strings(distinct[::2])
+    keep = sites.keep_mask(rejected)
+    assert keep.tolist() == [guide not in distinct[::2] for guide in guides]
+
+    with open(tmp_path / 'subset.bin', 'wb') as handle:
+        sites.write_subset(handle, keep)
+    assert list(SitesToReads(tmp_path / 'subset.bin').text_lines()) == [
+        line for line, is_kept in zip(lines, keep) if is_kept]
+
+
+@pytest.mark.parametrize('extension', ['', '.gz', '.zst'])
+def test_text_lines(tmp_path, extension):
+    lines = sites_to_reads_text().splitlines(keepends=True)
+    # Guides that aren't 20 bases of A, C, G, T, and a last line
+    # without a newline
+    lines[3:3] = ['ACGTNACGTACGTACGTACG\t1 2\n', 'ACGT\n',
+                  'ACGTNACGTACGTACGTACG\t3\n']
+    lines[-1] = lines[-1].rstrip('\n')
+    text = ''.join(lines)
+    with open_output(str(tmp_path / ('s2r.txt' + extension)),
+                     mode='w') as handle:
+        handle.write(text)
+
+    with open_input(str(tmp_path / ('s2r.txt' + extension))) as handle:
+        header_size = len(handle.readline())
+        text_lines = TextLines(handle, header_size)
+
+    guides = [line[:20].rstrip('\n') for line in lines[1:]]
+    distinct = list(dict.fromkeys(guides))
+    assert len(text_lines) == len(guides)
+    assert text_lines.guides.strings() == distinct
+    assert text_lines.guides.invalid_guides == ['ACGTNACGTACGTACGTACG', 'ACGT']
+    assert text_lines.line_counts().tolist() == [guides.count(guide)
+                                                 for guide in distinct]
+
+    rejected = text_lines.guides[1::2]
+    keep = text_lines.keep_mask(rejected)
+    assert keep.tolist() == [guide not in distinct[1::2] for guide in guides]
+
+    starts, ends = text_lines.kept_ranges(keep)
+    output = io.BytesIO()
+    with open_input(str(tmp_path / ('s2r.txt' + extension))) as handle:
+        copy_ranges(handle, output, starts, ends)
+    assert output.getvalue().decode('ascii') == ''.join(
+        line for line, is_kept in zip(lines[1:], keep) if is_kept)
@@ -0,0 +1,39 @@
+import json
+
+from dashit_filter.verdict_cache import VerdictCache
+
+
+def test_store_and_lookup(tmp_path):
+    cache = VerdictCache(tmp_path / 'verdicts.db')
+    key = cache.quality_stage_key({'homopolymer': 5})
+    other_key = cache.quality_stage_key({'homopolymer': 4})
+    guides = [f'{i:020b}'.replace('0', 'A').replace('1', 'C')
+              for i in range(2000)]
+
+    cache.store(key, {guide: ['homopolymer>5'] if i % 3 == 0 else []
+                      for i, guide in enumerate(guides)})
+
+    # Looked up in several queries, from another connection
+    cached = VerdictCache(tmp_path / 'verdicts.db').lookup(
+        key, guides + ['GGGGGGGGGGGGGGGGGGGG'])
+    assert cached == {guide: ['homopolymer>5'] if i % 3 == 0 else []
+                      for i, guide in enumerate(guides)}
+    assert cache.lookup(other_key, guides) == {}
+
+
+def test_sites_stage_key(tmp_path):
+    sites = tmp_path / 'sites.txt'
+    sites.write_text('ACGTACGTACGTACGTACGT\n')
+    copy = tmp_path / 'copy.txt'
+    copy.write_text(sites.read_text())
+    cache = VerdictCache(tmp_path / 'verdicts.db')
+
+    key = cache.sites_stage_key(sites, (5, 10, 20))
+
+    # Keyed on the contents and radius, not the file name
+    assert cache.sites_stage_key(copy, (5, 10, 20)) == key
+    assert cache.sites_stage_key(sites, (5, 9, 18)) != key
+    assert json.loads(key)['radius'] == [5, 10, 20]
+
+    sites.write_text('ACGTACGTACGTACGTACGA\n')
+    assert cache.sites_stage_key(sites, (5, 10, 20)) != key